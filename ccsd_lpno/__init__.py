@@ -9,11 +9,15 @@ from . import cc_lambda
 from . import cc_pert
 from . import local
 from . import mollib
+from . import store
 
 from .helper_cc import HelperCCEnergy
 from .cc_hbar import HelperHbar
 from .cc_lambda import HelperLambda
 from .cc_pert import HelperPert
 from .cc_pert import HelperResp
+from .cc_pert import HelperRespTensor
+from .cc_pert import HelperPertBatch
 from .linresp import do_linresp
 from .local import HelperLocal
+from .store import HelperStore
@@ -3,12 +3,41 @@ HelperHbar class definition and function definitions
 For building spin-adapted CC Hbar matrix elements
 '''
 
+import time
 import numpy as np
 import psi4
 from opt_einsum import contract
 
 
+def hbar_element(name):
+    # Lazily built, cached Hbar element, see HelperHbar.get_element
+    return property(lambda self: self.get_element(name))
+
+def hbar_reference(name):
+    # Hbar element of the HelperHbar object held by a solver, built on first use
+    return property(lambda self: getattr(self.hbar, name))
+
+HBAR_ELEMENTS = ['tau', 'Lmnef', 'Lmnie', 'Lamef', 'Hoo', 'Hvv', 'Hov', 'Hoooo', 'Hvvvv', 'Hvovv', 'Hooov', 'Hovvo', 'Hovov', 'Hvvvo', 'Hovoo']
+
+
 class HelperHbar(object):
+    # Intermediates and 1- and 2-body Hbar elements, built on first access
+    tau = hbar_element('tau')
+    Lmnef = hbar_element('Lmnef')
+    Lmnie = hbar_element('Lmnie')
+    Lamef = hbar_element('Lamef')
+    Hoo = hbar_element('Hoo')
+    Hvv = hbar_element('Hvv')
+    Hov = hbar_element('Hov')
+    Hoooo = hbar_element('Hoooo')
+    Hvvvv = hbar_element('Hvvvv')
+    Hvovv = hbar_element('Hvovv')
+    Hooov = hbar_element('Hooov')
+    Hovvo = hbar_element('Hovvo')
+    Hovov = hbar_element('Hovov')
+    Hvvvo = hbar_element('Hvvvo')
+    Hovoo = hbar_element('Hovoo')
+
     def __init__(self, hcc, ccsd_e):
 
         # Get fock matrix, MOs(ERIs), t amplitudes from ccsd
@@ -22,25 +51,45 @@ class HelperHbar(object):
 
         self.Ecc = ccsd_e
 
-        # Setting up intermediates
-        self.Lmnef = self.make_Lmnef()
-        self.Lmnie = self.make_Lmnie()
-        self.Lamef = self.make_Lamef()
-
-        # Creating 1-body Hbar elements
-        self.Hoo = self.make_Hoo()
-        self.Hvv = self.make_Hvv()
-        self.Hov = self.make_Hov()
-
-        # Creating 2-body Hbar elements
-        self.Hoooo = self.make_Hoooo()
-        self.Hvvvv = self.make_Hvvvv()
-        self.Hvovv = self.make_Hvovv()
-        self.Hooov = self.make_Hooov()
-        self.Hovvo = self.make_Hovvo()
-        self.Hovov = self.make_Hovov()
-        self.Hvvvo = self.make_Hvvvo()
-        self.Hovoo = self.make_Hovoo()
+        # Built elements, and the memory (bytes) and build time (s) of each
+        self.elements = {}
+        self.registry = {}
+        # Time spent in nested builds, one entry per element being built
+        self.build_stack = []
+
+    def get_element(self, name):
+        # Build an Hbar element with make_<name> on first access and cache it
+        # The build time excludes the elements built on the way, which report their own
+        if name not in self.elements:
+            self.build_stack.append(0.0)
+            start = time.time()
+            try:
+                self.elements[name] = getattr(self, 'make_' + name)()
+            finally:
+                elapsed = time.time() - start
+                nested = self.build_stack.pop()
+                if self.build_stack:
+                    self.build_stack[-1] += elapsed
+            self.registry[name] = {'memory': self.elements[name].nbytes, 'time': elapsed - nested}
+        return self.elements[name]
+
+    def report(self):
+        # Memory and build time of the Hbar elements built so far
+        print('Hbar element\tMemory (MB)\tBuild time (s)\tIn memory')
+        for name in HBAR_ELEMENTS:
+            if name in self.registry:
+                print('{}\t\t{:.3f}\t\t{:.3f}\t\t{}'.format(name, self.registry[name]['memory'] / 1e6, self.registry[name]['time'], name in self.elements))
+        print('Total in memory (MB): {:.3f}'.format(sum(element.nbytes for element in self.elements.values()) / 1e6))
+
+    def release(self, names=None):
+        # Free built elements (all if names is None), they are rebuilt if accessed again
+        if names is None:
+            names = list(self.elements.keys())
+        freed = 0
+        for name in names:
+            if name in self.elements:
+                freed += self.elements.pop(name).nbytes
+        print('Released Hbar elements: {:.3f} MB'.format(freed / 1e6))
 
     # Functions to build 1-body Hbar
     # F_mi = f_mi + t_ie f_me + (t_inef + t_ie *t_nf) * (2<mn|ef> - <mn|fe>) + t_ne (2<mn|ie> - <mn|ei>)
@@ -89,6 +138,26 @@ class HelperHbar(object):
         H_vvvv += contract('ma,nb,mnef->abef', self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
         return H_vvvv
 
+    # Contractions with W_abef in factorized form, so that the v^4 Hbar is never formed:
+    # the ladder with the bare <ab|ef>, plus o^3v^3 (t1) and o^4v^2 (tau) corrections
+    # sum_ef W_abef X_ijef, X may carry leading (batch) axes
+    def Hvvvv_right(self, X_ijef):
+        o = self.no_occ
+        R_ijab = contract('abef,...ijef->...ijab', self.MO[o:, o:, o:, o:], X_ijef)
+        R_ijab -= contract('nb,...ijan->...ijab', self.t_ia, contract('anef,...ijef->...ijan', self.MO[o:, :o, o:, o:], X_ijef))
+        R_ijab -= contract('na,...ijnb->...ijab', self.t_ia, contract('nbef,...ijef->...ijnb', self.MO[:o, o:, o:, o:], X_ijef))
+        R_ijab += contract('mnab,...ijmn->...ijab', self.tau, contract('mnef,...ijef->...ijmn', self.MO[:o, :o, o:, o:], X_ijef))
+        return R_ijab
+
+    # sum_ef Z_ijef W_efab
+    def Hvvvv_left(self, Z_ijef):
+        o = self.no_occ
+        R_ijab = contract('...ijef,efab->...ijab', Z_ijef, self.MO[o:, o:, o:, o:])
+        R_ijab -= contract('...ijen,enab->...ijab', contract('...ijef,nf->...ijen', Z_ijef, self.t_ia), self.MO[o:, :o, o:, o:])
+        R_ijab -= contract('...ijnf,nfab->...ijab', contract('...ijef,ne->...ijnf', Z_ijef, self.t_ia), self.MO[:o, o:, o:, o:])
+        R_ijab += contract('...ijmn,mnab->...ijab', contract('...ijef,mnef->...ijmn', Z_ijef, self.tau), self.MO[:o, :o, o:, o:])
+        return R_ijab
+
     # W_amef = <am|ef> - t_na <nm|ef>
     def make_Hvovv(self):
         H_vovv = self.MO[self.no_occ:, :self.no_occ, self.no_occ:, self.no_occ:].copy()
@@ -123,49 +192,58 @@ class HelperHbar(object):
     # Wabei = <ab|ei> + t_if <ab|ef> - t_mb <am|ei> - t_ma <bm|ie> - (t_imfb + t_if t_mb) <am|ef> - (t_imfa + t_if t_ma) <mb|ef> + (t_mnab + t_ma t_nb) <mn|ei> - t_miab f_me
     # Wabei += t_mifb self.Lamef + (t_if t_mnab + t_ma t_nibf + t_nb t_miaf) <mn|ef> - (t_mf t_niab + t_na t_mifb) Lmnfe + t_if t_ma t_nb <nm|fe>
     def make_Hvvvo(self):
-        H_vvvo = self.MO[self.no_occ:, self.no_occ:, self.no_occ:, :self.no_occ].copy()
-        H_vvvo += contract('if,abef->abei', self.t_ia, self.MO[self.no_occ:, self.no_occ:, self.no_occ:, self.no_occ:])
-        H_vvvo -= contract('mb,amei->abei', self.t_ia, self.MO[self.no_occ:, :self.no_occ, self.no_occ:, :self.no_occ])
-        H_vvvo -= contract('ma,bmie->abei', self.t_ia, self.MO[self.no_occ:, :self.no_occ, :self.no_occ, self.no_occ:])
-        H_vvvo -= contract('imfb,amef->abei', self.t_ijab, self.MO[self.no_occ:, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_vvvo -= contract('if,mb,amef->abei', self.t_ia, self.t_ia, self.MO[self.no_occ:, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_vvvo -= contract('imfa,mbef->abei', self.t_ijab, self.MO[:self.no_occ, self.no_occ:, self.no_occ:, self.no_occ:])
-        H_vvvo -= contract('if,ma,mbef->abei', self.t_ia, self.t_ia, self.MO[:self.no_occ, self.no_occ:, self.no_occ:, self.no_occ:])
-        H_vvvo += contract('mnab,mnei->abei', self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, :self.no_occ])
-        H_vvvo += contract('ma,nb,mnei->abei', self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, :self.no_occ])
-        H_vvvo -= contract('miab,me->abei', self.t_ijab, self.F[:self.no_occ, self.no_occ:])
-        H_vvvo += contract('mifb,amef->abei', self.t_ijab, self.Lamef)
-        H_vvvo += contract('if,mnab,mnef->abei', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_vvvo += contract('ma,nibf,mnef->abei', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_vvvo += contract('nb,miaf,mnef->abei', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_vvvo -= contract('mf,niab,mnfe->abei', self.t_ia, self.t_ijab, self.Lmnef)
-        H_vvvo -= contract('na,mifb,mnfe->abei', self.t_ia, self.t_ijab, self.Lmnef)
-        H_vvvo += contract('if,ma,nb,nmfe->abei', self.t_ia, self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
+        o = self.no_occ
+        V_oovv = self.MO[:o, :o, o:, o:]
+        H_vvvo = self.MO[o:, o:, o:, :o].copy()
+        H_vvvo += contract('if,abef->abei', self.t_ia, self.MO[o:, o:, o:, o:])
+        # t_mb (<am|ei> - t_niaf <nm|ef>) and t_ma (<mb|ei> - t_nibf <mn|ef>)
+        Z_amei = self.MO[o:, :o, o:, :o] - contract('niaf,nmef->amei', self.t_ijab, V_oovv)
+        H_vvvo -= contract('mb,amei->abei', self.t_ia, Z_amei)
+        Z_mbei = self.MO[:o, o:, o:, :o] - contract('nibf,mnef->mbei', self.t_ijab, V_oovv)
+        H_vvvo -= contract('ma,mbei->abei', self.t_ia, Z_mbei)
+        # tau_imfb <am|ef> and tau_imfa <mb|ef>
+        H_vvvo -= contract('imfb,amef->abei', self.tau, self.MO[o:, :o, o:, o:])
+        H_vvvo -= contract('imfa,mbef->abei', self.tau, self.MO[:o, o:, o:, o:])
+        # tau_mnab (<mn|ei> + t_if <mn|ef>)
+        Z_mnei = self.MO[:o, :o, o:, :o] + contract('if,mnef->mnei', self.t_ia, V_oovv)
+        H_vvvo += contract('mnab,mnei->abei', self.tau, Z_mnei)
+        # t_miab F_me, F_me = f_me + t_nf Lmnef
+        H_vvvo -= contract('miab,me->abei', self.t_ijab, self.Hov)
+        # t_mifb (Lamef - t_na Lmnfe)
+        Z_amef = self.Lamef - contract('na,mnfe->amef', self.t_ia, self.Lmnef)
+        H_vvvo += contract('mifb,amef->abei', self.t_ijab, Z_amef)
         return H_vvvo
 
     # Wmbij = <mb|ij> + t_je <mb|ie> -t_nb <mn|ij> + t_ie <bm|je> - (t_ineb + t_ie t_nb) <nm|je> - (t_jneb + t_je t_nb) <mn|ie> + (t_ijef + t_ie t_jf) <mb|ef> + t_ijeb fme 
     # Wmbij += t_njeb Lmnie - (t_je t_infb + t_if t_jneb + t_nb t_jief) <mn|ef> + t_ie t_njfb Lmnef + t_nf t_ijeb Lmnef - t_je t_if t_nb <mn|ef>
     def make_Hovoo(self):
-        H_ovoo = self.MO[:self.no_occ, self.no_occ:, :self.no_occ, :self.no_occ].copy()
-        H_ovoo += contract('je,mbie->mbij', self.t_ia, self.MO[:self.no_occ, self.no_occ:, :self.no_occ, self.no_occ:])
-        H_ovoo -= contract('nb,mnij->mbij', self.t_ia, self.MO[:self.no_occ, :self.no_occ, :self.no_occ, :self.no_occ])
-        H_ovoo += contract('ie,mbej->mbij', self.t_ia, self.MO[:self.no_occ, self.no_occ:, self.no_occ:, :self.no_occ])
-        H_ovoo -= contract('ineb,mnej->mbij', self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, :self.no_occ])
-        H_ovoo -= contract('ie,nb,mnej->mbij', self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, :self.no_occ])
-        H_ovoo -= contract('jneb,mnie->mbij', self.t_ijab, self.MO[:self.no_occ, :self.no_occ, :self.no_occ, self.no_occ:])
-        H_ovoo -= contract('je,nb,mnie->mbij', self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, :self.no_occ, self.no_occ:])
-        H_ovoo += contract('ijef,mbef->mbij', self.t_ijab, self.MO[:self.no_occ, self.no_occ:, self.no_occ:, self.no_occ:])
-        H_ovoo += contract('ie,jf,mbef->mbij', self.t_ia, self.t_ia, self.MO[:self.no_occ, self.no_occ:, self.no_occ:, self.no_occ:])
-        H_ovoo += contract('ijeb,me->mbij', self.t_ijab, self.F[:self.no_occ, self.no_occ:])
-        H_ovoo += contract('jnbe,mnie->mbij',self.t_ijab, self.Lmnie)
-        H_ovoo -= contract('je,infb,mnfe->mbij', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_ovoo -= contract('if,jneb,mnfe->mbij', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_ovoo -= contract('nb,ijef,mnef->mbij', self.t_ia, self.t_ijab, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
-        H_ovoo += contract('ie,njfb,mnef->mbij', self.t_ia, self.t_ijab, self.Lmnef)
-        H_ovoo += contract('nf,ijeb,mnef->mbij', self.t_ia, self.t_ijab, self.Lmnef)
-        H_ovoo -= contract('ie,jf,nb,mnef->mbij', self.t_ia, self.t_ia, self.t_ia, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:])
+        o = self.no_occ
+        V_oovv = self.MO[:o, :o, o:, o:]
+        H_ovoo = self.MO[:o, o:, :o, :o].copy()
+        # t_je (<mb|ie> - t_infb <mn|fe>) and t_ie (<mb|ej> + t_njfb Lmnef)
+        Z_mbie = self.MO[:o, o:, :o, o:] - contract('infb,mnfe->mbie', self.t_ijab, V_oovv)
+        H_ovoo += contract('je,mbie->mbij', self.t_ia, Z_mbie)
+        Z_mbej = self.MO[:o, o:, o:, :o] + contract('njfb,mnef->mbej', self.t_ijab, self.Lmnef)
+        H_ovoo += contract('ie,mbej->mbij', self.t_ia, Z_mbej)
+        # t_nb (<mn|ij> + tau_ijef <mn|ef>)
+        Z_mnij = self.MO[:o, :o, :o, :o] + contract('ijef,mnef->mnij', self.tau, V_oovv)
+        H_ovoo -= contract('nb,mnij->mbij', self.t_ia, Z_mnij)
+        # tau_ineb <nm|je> and tau_jneb <mn|ie>
+        H_ovoo -= contract('ineb,nmje->mbij', self.tau, self.MO[:o, :o, :o, o:])
+        H_ovoo -= contract('jneb,mnie->mbij', self.tau, self.MO[:o, :o, :o, o:])
+        # tau_ijef <mb|ef>
+        H_ovoo += contract('ijef,mbef->mbij', self.tau, self.MO[:o, o:, o:, o:])
+        # t_ijeb F_me, F_me = f_me + t_nf Lmnef
+        H_ovoo += contract('ijeb,me->mbij', self.t_ijab, self.Hov)
+        # t_jnbe Lmnie - t_jneb t_if <mn|fe>
+        H_ovoo += contract('jnbe,mnie->mbij', self.t_ijab, self.Lmnie)
+        H_ovoo -= contract('jneb,mnie->mbij', self.t_ijab, contract('if,mnfe->mnie', self.t_ia, V_oovv))
         return H_ovoo
-       
+
+    # tau_mnab = t_mnab + t_ma t_nb, shared by Hvvvo, Hovoo and the factorized W_abef contractions
+    def make_tau(self):
+        return self.t_ijab + contract('ma,nb->mnab', self.t_ia, self.t_ia)
+
     def make_Lmnef(self):
         tmp = self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:].copy()
         Lmnef = 2.0 * tmp - tmp.swapaxes(2, 3) 
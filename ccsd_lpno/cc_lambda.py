@@ -8,8 +8,13 @@ after completing a CCSD calculation and building Hbar matrix elements
 import numpy as np
 import psi4
 from .diis import *
+from .cc_hbar import hbar_reference
 from opt_einsum import contract
 
+def lambda_element(name):
+    # Intermediate of the lambdas and Hbar, built once with make_<name>, see HelperLambda.get_element
+    return property(lambda self: self.get_element(name))
+
 class HelperLambda(object):
     '''
     Class for setting up and running a left hand CCSD amplitude calculation.
@@ -22,6 +27,26 @@ class HelperLambda(object):
     :param hbar: HelperHbar object instantiated using cc_hbar
     :type hbar: class 'ccsd_lpno.HelperHbar'
     '''
+    # Hbar elements, built on first use
+    Lmnef = hbar_reference('Lmnef')
+    Lmnie = hbar_reference('Lmnie')
+    Lamef = hbar_reference('Lamef')
+    Hoo = hbar_reference('Hoo')
+    Hvv = hbar_reference('Hvv')
+    Hov = hbar_reference('Hov')
+    Hoooo = hbar_reference('Hoooo')
+    Hvovv = hbar_reference('Hvovv')
+    Hooov = hbar_reference('Hooov')
+    Hovvo = hbar_reference('Hovvo')
+    Hovov = hbar_reference('Hovov')
+    Hvvvo = hbar_reference('Hvvvo')
+    Hovoo = hbar_reference('Hovoo')
+
+    # Lambda-dressed Hbar intermediates of the perturbed lambda equations,
+    # built once after the lambda iterations and shared by all HelperPert objects
+    L1H_miae = lambda_element('L1H_miae')
+    L2H_iema = lambda_element('L2H_iema')
+
     def __init__(self, hcc, hbar):
 
         # Get fock matrix, ERIs, T amplitudes from CCSD
@@ -37,31 +62,27 @@ class HelperLambda(object):
         self.d_ia = hcc.d_ia
         self.d_ijab = hcc.d_ijab
 
-        # Setting up intermediates
-        self.Lmnef = hbar.Lmnef
-        self.Lmnie = hbar.Lmnie
-        self.Lamef = hbar.Lamef
-
-        # Get 1-body Hbar elements
-        self.Hoo = hbar.Hoo
-        self.Hvv = hbar.Hvv
-        self.Hov = hbar.Hov
-
-        # Get 2-body Hbar elements
-        self.Hoooo = hbar.Hoooo
-        self.Hvvvv = hbar.Hvvvv
-        self.Hvovv = hbar.Hvovv
-        self.Hooov = hbar.Hooov
-        self.Hovvo = hbar.Hovvo
-        self.Hovov = hbar.Hovov
-        self.Hvvvo = hbar.Hvvvo
-        self.Hovoo = hbar.Hovoo
+        # Hbar elements are taken from hbar when first used
+        self.hbar = hbar
 
         # Init guesses, 2.0 * t1 -> l1, 4.0 * t2 - 2.0 t2.swap(2,3) -> l2
         self.l_ia = 2.0 * self.t_ia.copy()
         self.l_ijab = 4.0 * self.t_ijab.copy()
         self.l_ijab -= 2.0 * self.t_ijab.swapaxes(2,3)
 
+        # Intermediates built from the lambdas, and the lambdas they were built from
+        self.elements = {}
+        self.elements_from = (None, None)
+
+    def get_element(self, name):
+        # Build an intermediate on first access, rebuilt if the lambdas were replaced since
+        if self.elements_from[0] is not self.l_ia or self.elements_from[1] is not self.l_ijab:
+            self.elements = {}
+            self.elements_from = (self.l_ia, self.l_ijab)
+        if name not in self.elements:
+            self.elements[name] = getattr(self, 'make_' + name)()
+        return self.elements[name]
+
     def make_Goo(self):
         Goo = contract('mjab,ijab->mi', self.t_ijab, self.l_ijab)
         return Goo
@@ -70,6 +91,39 @@ class HelperLambda(object):
         Gvv = -1.0 * contract('ijab,ijeb->ae', self.l_ijab, self.t_ijab)
         return Gvv
 
+    def make_L1H_miae(self):
+        # <0|L1[Hbar, X1]|i a> = L1H_miae x_me
+        L1H = -1.0 * contract('ma,ie->miae', self.Hov, self.l_ia)
+        L1H -= contract('ie,ma->miae', self.Hov, self.l_ia)
+        L1H -= 2.0 * contract('mina,ne->miae', self.Hooov, self.l_ia)
+        L1H += contract('imna,ne->miae', self.Hooov, self.l_ia)
+        L1H -= 2.0 * contract('imne,na->miae', self.Hooov, self.l_ia)
+        L1H += contract('mine,na->miae', self.Hooov, self.l_ia)
+        L1H += 2.0 * contract('fmae,if->miae', self.Hvovv, self.l_ia)
+        L1H -= contract('fmea,if->miae', self.Hvovv, self.l_ia)
+        L1H += 2.0 * contract('fiea,mf->miae', self.Hvovv, self.l_ia)
+        L1H -= contract('fiae,mf->miae', self.Hvovv, self.l_ia)
+        return L1H
+
+    def make_L2H_iema(self):
+        # <0|L2[Hbar, X1]|i a> = L2H_iema x_me
+        L2H = -1.0 * contract('mfna,nief->iema', self.Hovov, self.l_ijab)
+        L2H -= contract('ifne,nmaf->iema', self.Hovov, self.l_ijab)
+        L2H -= contract('mfan,inef->iema', self.Hovvo, self.l_ijab)
+        L2H -= contract('ifen,nmfa->iema', self.Hovvo, self.l_ijab)
+        L2H += 0.5 * self.hbar.Hvvvv_left(self.l_ijab).transpose(0, 3, 1, 2)
+        L2H += 0.5 * self.hbar.Hvvvv_left(self.l_ijab.swapaxes(2, 3)).transpose(0, 2, 1, 3)
+        L2H += 0.5 * contract('imno,onea->iema', self.Hoooo, self.l_ijab)
+        L2H += 0.5 * contract('mino,noea->iema', self.Hoooo, self.l_ijab)
+        # G intermediates, Gvv here is the transpose of the one in the perturbed equations
+        Goo = self.make_Goo()
+        Gvv = self.make_Gvv()
+        L2H += contract('imaf,ef->iema', self.Lmnef, Gvv)
+        L2H += contract('mief,af->iema', self.Lmnef, Gvv)
+        L2H -= contract('mnea,ni->iema', self.Lmnef, Goo)
+        L2H -= contract('inae,nm->iema', self.Lmnef, Goo)
+        return L2H
+
     def update_ls(self, l_ia, l_ijab, local=None):
         '''
         Update L1 and L2 amplitudes
@@ -113,7 +167,7 @@ class HelperLambda(object):
         Rijab += contract('ijeb,ea->ijab', l_ijab, self.Hvv)
         Rijab -= contract('mjab,im->ijab', l_ijab, self.Hoo)
         Rijab += 0.5 * contract('mnab,ijmn->ijab', l_ijab, self.Hoooo)
-        Rijab += 0.5 * contract('ijef,efab->ijab', l_ijab, self.Hvvvv)
+        Rijab += 0.5 * self.hbar.Hvvvv_left(l_ijab)
         Rijab += 2.0 * contract('ie,ejab->ijab', l_ia, self.Hvovv)
         Rijab -= contract('ie,ejba->ijab', l_ia, self.Hvovv)
         Rijab -= 2.0 * contract('mb,jima->ijab', l_ia, self.Hooov)
@@ -131,7 +185,7 @@ class HelperLambda(object):
         new_lijab = l_ijab.copy()
 
         if local:
-            inc1, inc2 = local.increment(Ria, Rijab, self.F_occ)
+            inc1, inc2 = local.increment(Ria, Rijab, self.F_occ, freeze=True)
             #inc2 = local.increment(Ria, Rijab, self.F_occ)
             #new_lia += Ria / self.d_ia
             new_lia += inc1
@@ -158,7 +212,13 @@ class HelperLambda(object):
         E_pseudo = 0.5 * contract('abij,ijab->', self.MO[v, v, o, o], l_ijab)
         return E_pseudo
 
-    def iterate(self, local=None, e_conv=1e-8, r_conv=1e-7, maxiter=40, max_diis=8, start_diis=0):
+    def pair_pseudo_energy(self, l_ijab):
+        # Pair contributions to the pseudoenergy, for pair freezing
+        o = slice(0, self.no_occ)
+        v = slice(self.no_occ, self.no_mo)
+        return 0.5 * contract('abij,ijab->ij', self.MO[v, v, o, o], l_ijab)
+
+    def iterate(self, local=None, e_conv=1e-8, r_conv=1e-7, maxiter=40, max_diis=8, start_diis=0, freeze_conv=None, recheck=5):
         '''
         Do Lambda iterations with DIIS and local options
 
@@ -174,10 +234,16 @@ class HelperLambda(object):
         :type max_diis: integer
         :param start_diis: Which iteration to start storing error vectors for DIIS
         :type start_diis: integer
+        :param freeze_conv: If given, pairs whose increment norm and pair pseudoenergy change are below freeze_conv are frozen (local only)
+        :type freeze_conv: double
+        :param recheck: Every recheck-th iteration all pairs are updated and drifting pairs unfrozen
+        :type recheck: integer
 
         :return: Converged CCSD energy
         :rtype: double
         '''
+        if local:
+            local.init_freeze(freeze_conv, recheck)
         self.old_pe = self.pseudo_energy(self.l_ijab)
         print('Iteration\t\t Pseudoenergy\t\tDifference\tRMS')
         # Set up DIIS
@@ -188,18 +254,26 @@ class HelperLambda(object):
             new_pe = self.pseudo_energy(new_lijab)
             rms = np.linalg.norm(new_lia - self.l_ia)
             rms += np.linalg.norm(new_lijab - self.l_ijab)
-            print('CC Iteration: {:3d}\t {:2.12f}\t{:1.12f} \t{:1.12f}\tDIIS size: {}'.format(i, new_pe, abs(new_pe - self.old_pe), rms, diis.diis_size))
+            frozen = ''
+            if local and local.freeze_conv is not None:
+                frozen = local.update_freeze(self.pair_pseudo_energy(new_lijab))
+            print('CC Iteration: {:3d}\t {:2.12f}\t{:1.12f} \t{:1.12f}\tDIIS size: {}{}'.format(i, new_pe, abs(new_pe - self.old_pe), rms, diis.diis_size, frozen))
             if(abs(new_pe - self.old_pe) < e_conv and abs(rms) < r_conv):
-                print('Convergence reached.\n Pseudoenergy: {}\n'.format(new_pe))
-                self.l_ia = new_lia
-                self.l_ijab = new_lijab
-                break
+                if local and local.thaw_pairs():
+                    print('Unfreezing all pairs before convergence.')
+                else:
+                    print('Convergence reached.\n Pseudoenergy: {}\n'.format(new_pe))
+                    self.l_ia = new_lia
+                    self.l_ijab = new_lijab
+                    break
             # Update error vectors for DIIS
             diis.update_err_list(new_lia, new_lijab)
 
             # Extrapolate using DIIS
             if(i >= start_diis):
                 new_lia, new_lijab = diis.extrapolate(new_lia, new_lijab)
+            if local:
+                new_lijab = local.keep_frozen(self.l_ijab, new_lijab)
 
             self.l_ia = new_lia
             self.l_ijab = new_lijab
@@ -11,8 +11,50 @@ import numpy as np
 import psi4
 from opt_einsum import contract
 from .diis import *
+from .krylov import gmres
+from .cc_hbar import hbar_reference
+
+def pert_element(name):
+    # Iteration-invariant intermediate, built once with make_<name>, see HelperPert.get_element
+    return property(lambda self: self.get_element(name))
+
+def pert_amplitude(name):
+    # Ground state amplitudes, the cached intermediates are rebuilt when they are replaced
+    def set_amplitude(self, value):
+        self.__dict__['_' + name] = value
+        self.elements = {}
+    return property(lambda self: self.__dict__['_' + name], set_amplitude)
 
 class HelperPert(object):
+    # Hbar elements, built on first use
+    Lmnef = hbar_reference('Lmnef')
+    Lmnie = hbar_reference('Lmnie')
+    Lamef = hbar_reference('Lamef')
+    Hoo = hbar_reference('Hoo')
+    Hvv = hbar_reference('Hvv')
+    Hov = hbar_reference('Hov')
+    Hoooo = hbar_reference('Hoooo')
+    Hvovv = hbar_reference('Hvovv')
+    Hooov = hbar_reference('Hooov')
+    Hovvo = hbar_reference('Hovvo')
+    Hovov = hbar_reference('Hovov')
+    Hvvvo = hbar_reference('Hvvvo')
+    Hovoo = hbar_reference('Hovoo')
+
+    # Matrix elements of the perturbation and lambda intermediates, built on first use
+    Aoo = pert_element('Aoo')
+    Aov = pert_element('Aov')
+    Avv = pert_element('Avv')
+    Avo = pert_element('Avo')
+    Aovoo = pert_element('Aovoo')
+    Avvvo = pert_element('Avvvo')
+    Avvoo = pert_element('Avvoo')
+
+    t_ia = pert_amplitude('t_ia')
+    t_ijab = pert_amplitude('t_ijab')
+    l_ia = pert_amplitude('l_ia')
+    l_ijab = pert_amplitude('l_ijab')
+
     def __init__(self, ccsd, hbar, lda, A, omega, local=None):
 
         # Get MOs from lda
@@ -23,27 +65,11 @@ class HelperPert(object):
         self.no_vir = ccsd.no_vir
         self.F_occ = ccsd.F_occ
         
-        # L intermediates
-        self.Lmnef = hbar.Lmnef
-        self.Lmnie = hbar.Lmnie
-        self.Lamef = hbar.Lamef
-
-        # Get 1-body Hbar elements
-        self.Hoo = hbar.Hoo
-        self.Hvv = hbar.Hvv
-        self.Hov = hbar.Hov
-
-        # Get 2-body Hbar elements
-        self.Hoooo = hbar.Hoooo
-        self.Hvvvv = hbar.Hvvvv
-        self.Hvovv = hbar.Hvovv
-        self.Hooov = hbar.Hooov
-        self.Hovvo = hbar.Hovvo
-        self.Hovov = hbar.Hovov
-        self.Hvvvo = hbar.Hvvvo
-        self.Hovoo = hbar.Hovoo
+        # Hbar elements are taken from hbar when first used
+        self.hbar = hbar
 
-        # Get lambdas
+        # Get lambdas, the lambda-dressed Hbar intermediates are shared through lda
+        self.lda = lda
         self.l_ia = lda.l_ia
         self.l_ijab = lda.l_ijab
     
@@ -58,14 +84,14 @@ class HelperPert(object):
         self.D_ijab += omega
 
         # Guesses for X1 and X2 amplitudes (First order perturbed T amplitudes)
-        self.pertbar_ijab = self.make_Avvoo().swapaxes(0,2).swapaxes(1,3)
+        self.pertbar_ijab = self.Avvoo.swapaxes(0,2).swapaxes(1,3).copy()
         self.pertbar_ijab += self.pertbar_ijab.swapaxes(0,1).swapaxes(2,3)
 
         if local:
-            self.x_ia, self.x_ijab = local.increment(self.make_Avo().swapaxes(0,1), self.pertbar_ijab, self.F_occ)
-            #self.x_ijab = local.increment(self.make_Avo().swapaxes(0,1), self.pertbar_ijab, self.F_occ)
+            self.x_ia, self.x_ijab = local.increment(self.Avo.swapaxes(0,1), self.pertbar_ijab, self.F_occ)
+            #self.x_ijab = local.increment(self.Avo.swapaxes(0,1), self.pertbar_ijab, self.F_occ)
         else:
-            self.x_ia = self.make_Avo().swapaxes(0,1)/self.D_ia
+            self.x_ia = self.Avo.swapaxes(0,1)/self.D_ia
             self.x_ijab = self.pertbar_ijab.copy()
             self.x_ijab = self.x_ijab/self.D_ijab
 
@@ -75,30 +101,49 @@ class HelperPert(object):
         self.y_ijab =  4.0 * self.x_ijab.copy()
         self.y_ijab -= 2.0 * self.x_ijab.swapaxes(2,3)
 
-    def make_Zvv(self):
+        # Equations solved at the current frequency ('right', 'left'), see linresp.solve_perts
+        self.solved = set()
+        # Whether the last iterate call converged
+        self.converged = False
+
+    def set_omega(self, omega):
+        # Move to a new frequency, the current X and Y are kept as the starting guess
+        self.D_ia += omega - self.omega
+        self.D_ijab += omega - self.omega
+        self.omega = omega
+        self.solved = set()
+
+    # The X and Y amplitudes in the residuals may carry a leading axis, see HelperPertBatch
+    def make_Zvv(self, x_ia, x_ijab):
         Zvv = 0
-        Zvv += 2.0 * contract('amef,mf->ae', self.Hvovv, self.x_ia)
-        Zvv -= contract('amfe,mf->ae', self.Hvovv, self.x_ia)
-        Zvv -= contract('mnaf,mnef->ae', self.x_ijab, self.Lmnef)
+        Zvv += 2.0 * contract('amef,...mf->...ae', self.Hvovv, x_ia)
+        Zvv -= contract('amfe,...mf->...ae', self.Hvovv, x_ia)
+        Zvv -= contract('...mnaf,mnef->...ae', x_ijab, self.Lmnef)
         return Zvv
 
-    def make_Zoo(self):
+    def make_Zoo(self, x_ia, x_ijab):
         Zoo = 0
-        Zoo -= 2.0 * contract('mnie,ne->mi', self.Hooov, self.x_ia)
-        Zoo += contract('nmie,ne->mi', self.Hooov, self.x_ia)
-        Zoo -= contract('mnef,inef->mi', self.Lmnef, self.x_ijab)
+        Zoo -= 2.0 * contract('mnie,...ne->...mi', self.Hooov, x_ia)
+        Zoo += contract('nmie,...ne->...mi', self.Hooov, x_ia)
+        Zoo -= contract('mnef,...inef->...mi', self.Lmnef, x_ijab)
         return Zoo
 
+    def get_element(self, name):
+        # Build an intermediate on first access, cached until the amplitudes are replaced
+        if name not in self.elements:
+            self.elements[name] = getattr(self, 'make_' + name)()
+        return self.elements[name]
+
     def make_Goo(self, t_ijab, l_ijab):
         Goo = 0
-        Goo += contract('mjab,ijab->mi', t_ijab, l_ijab)
+        Goo += contract('...mjab,...ijab->...mi', t_ijab, l_ijab)
         return Goo
 
     def make_Gvv(self, t_ijab, l_ijab):
         Gvv = 0
-        Gvv -= contract('ijab,ijeb->ae', t_ijab, l_ijab)
+        Gvv -= contract('...ijab,...ijeb->...ae', t_ijab, l_ijab)
         return Gvv
-    
+
 
     # Matrix elements of the perturbation
     def make_Aoo(self):
@@ -137,80 +182,78 @@ class HelperPert(object):
 
     def make_Avvoo(self):
         Avvoo = 0
-        Avvoo += contract('ijeb,ae->abij', self.t_ijab, self.make_Avv())
-        Avvoo -= contract('mjab,mi->abij', self.t_ijab, self.make_Aoo())
+        Avvoo += contract('ijeb,ae->abij', self.t_ijab, self.Avv)
+        Avvoo -= contract('mjab,mi->abij', self.t_ijab, self.Aoo)
         return Avvoo
 
     def update_xs(self, x_ia, x_ijab, local=None):
-    # X1 equations
-        r_ia = self.make_Avo().swapaxes(0,1).copy()
-        r_ia -= self.omega * x_ia.copy()
-        r_ia += contract('ae,ie->ia', self.Hvv, x_ia)
-        r_ia -= contract('mi,ma->ia', self.Hoo, x_ia)
-        r_ia += 2.0 * contract('maei,me->ia', self.Hovvo, x_ia)
-        r_ia -= contract('maie,me->ia', self.Hovov, x_ia)
-        r_ia += 2.0 * contract('me,miea->ia', self.Hov, x_ijab)
-        r_ia -= contract('me,imea->ia', self.Hov, x_ijab)
-        r_ia += 2.0 * contract('amef,imef->ia', self.Hvovv, x_ijab)
-        r_ia -= contract('amfe,imef->ia', self.Hvovv, x_ijab)
-        r_ia -= 2.0 * contract('mnie,mnae->ia', self.Hooov, x_ijab)
-        r_ia += contract('nmie,mnae->ia', self.Hooov, x_ijab)
+        r_ia, r_ijab = self.residual_xs(x_ia, x_ijab)
 
-    # X2 equations
-        r_ijab = self.make_Avvoo().swapaxes(0,2).swapaxes(1,3).copy()
-        r_ijab -= 0.5 * self.omega * self.x_ijab
-        r_ijab += contract('abej,ie->ijab', self.Hvvvo, x_ia)
-        r_ijab -= contract('mbij,ma->ijab', self.Hovoo, x_ia)
-        r_ijab += contract('ae,ijeb->ijab', self.Hvv, x_ijab)
-        r_ijab -= contract('mi,mjab->ijab', self.Hoo, x_ijab)
-        r_ijab += 0.5 * contract('mnij,mnab->ijab', self.Hoooo, x_ijab)
-        r_ijab += 0.5 * contract('abef,ijef->ijab', self.Hvvvv, x_ijab)
-        r_ijab += 2.0 * contract('mbej,miea->ijab', self.Hovvo, x_ijab)
-        r_ijab -= contract('mbje,miea->ijab', self.Hovov, x_ijab)
-        r_ijab -= contract('maje,imeb->ijab', self.Hovov, x_ijab)
-        r_ijab -= contract('mbej,imea->ijab', self.Hovvo, x_ijab)
-        r_ijab += contract('mi,mjab->ijab', self.make_Zoo(), self.t_ijab)
-        r_ijab += contract('ijeb,ae->ijab', self.t_ijab, self.make_Zvv())
-        
         new_xia = x_ia.copy()
         new_xijab = x_ijab.copy()
 
-        if local:
-            inc1, inc2 = local.increment(r_ia, r_ijab, self.F_occ)
-            #inc2 = local.increment(r_ia, r_ijab, self.F_occ)
-            #new_xia += r_ia/self.D_ia
-            new_xia += inc1
-        else:    
-            inc2 = r_ijab/self.D_ijab
-            new_xia += r_ia/self.D_ia
-        new_xijab += inc2 + inc2.swapaxes(0,1).swapaxes(2,3)
+        inc1, inc2 = self.increment(r_ia, r_ijab, local=local)
+        new_xia += inc1
+        new_xijab += inc2 + inc2.swapaxes(-4,-3).swapaxes(-2,-1)
         
         return new_xia, new_xijab
 
+    def residual_xs(self, x_ia, x_ijab):
+    # X1 equations
+        r_ia = self.Avo.swapaxes(-2,-1).copy()
+        r_ia -= self.omega * x_ia
+        r_ia += contract('ae,...ie->...ia', self.Hvv, x_ia)
+        r_ia -= contract('mi,...ma->...ia', self.Hoo, x_ia)
+        r_ia += 2.0 * contract('maei,...me->...ia', self.Hovvo, x_ia)
+        r_ia -= contract('maie,...me->...ia', self.Hovov, x_ia)
+        r_ia += 2.0 * contract('me,...miea->...ia', self.Hov, x_ijab)
+        r_ia -= contract('me,...imea->...ia', self.Hov, x_ijab)
+        r_ia += 2.0 * contract('amef,...imef->...ia', self.Hvovv, x_ijab)
+        r_ia -= contract('amfe,...imef->...ia', self.Hvovv, x_ijab)
+        r_ia -= 2.0 * contract('mnie,...mnae->...ia', self.Hooov, x_ijab)
+        r_ia += contract('nmie,...mnae->...ia', self.Hooov, x_ijab)
+
+    # X2 equations
+        r_ijab = self.Avvoo.swapaxes(-4,-2).swapaxes(-3,-1).copy()
+        r_ijab -= 0.5 * self.omega * x_ijab
+        r_ijab += contract('abej,...ie->...ijab', self.Hvvvo, x_ia)
+        r_ijab -= contract('mbij,...ma->...ijab', self.Hovoo, x_ia)
+        r_ijab += contract('ae,...ijeb->...ijab', self.Hvv, x_ijab)
+        r_ijab -= contract('mi,...mjab->...ijab', self.Hoo, x_ijab)
+        r_ijab += 0.5 * contract('mnij,...mnab->...ijab', self.Hoooo, x_ijab)
+        r_ijab += 0.5 * self.hbar.Hvvvv_right(x_ijab)
+        r_ijab += 2.0 * contract('mbej,...miea->...ijab', self.Hovvo, x_ijab)
+        r_ijab -= contract('mbje,...miea->...ijab', self.Hovov, x_ijab)
+        r_ijab -= contract('maje,...imeb->...ijab', self.Hovov, x_ijab)
+        r_ijab -= contract('mbej,...imea->...ijab', self.Hovvo, x_ijab)
+        r_ijab += contract('...mi,mjab->...ijab', self.make_Zoo(x_ia, x_ijab), self.t_ijab)
+        r_ijab += contract('ijeb,...ae->...ijab', self.t_ijab, self.make_Zvv(x_ia, x_ijab))
+
+        return r_ia, r_ijab
+
+    def increment(self, r_ia, r_ijab, local=None):
+        # Amplitude increments from the residuals, in the pair spaces if local
+        if local:
+            return local.increment(r_ia, r_ijab, self.F_occ, freeze=True)
+        return r_ia/self.D_ia, r_ijab/self.D_ijab
+
     def inhomogeneous_ys(self, x_ia, x_ijab):
+        # X2-dependent G intermediates, each used more than once
+        Goo_xl = self.make_Goo(x_ijab, self.l_ijab)
+        Gvv_lx = self.make_Gvv(self.l_ijab, x_ijab)
     # Y1 equations, inhomogeneous terms
-        r_ia = 2.0 * self.make_Aov().copy()
-        r_ia -= contract('ma,im->ia', self.l_ia, self.make_Aoo())
-#        r_ia += contract('ie,ae->ia', self.l_ia, self.make_Avv())
-        r_ia += contract('ie,ea->ia', self.l_ia, self.make_Avv())
-        r_ia += contract('imef,efam->ia', self.l_ijab, self.make_Avvvo())
+        r_ia = 2.0 * self.Aov.copy()
+        r_ia -= contract('ma,im->ia', self.l_ia, self.Aoo)
+#        r_ia += contract('ie,ae->ia', self.l_ia, self.Avv)
+        r_ia += contract('ie,ea->ia', self.l_ia, self.Avv)
+        r_ia += contract('imef,efam->ia', self.l_ijab, self.Avvvo)
         # above should be okay
-        r_ia -= 0.5 * contract('mnea,ienm->ia', self.l_ijab, self.make_Aovoo())
-        r_ia -= 0.5 * contract('mnae,iemn->ia', self.l_ijab, self.make_Aovoo())
+        r_ia -= 0.5 * contract('mnea,ienm->ia', self.l_ijab, self.Aovoo)
+        r_ia -= 0.5 * contract('mnae,iemn->ia', self.l_ijab, self.Aovoo)
         # <0|[Hbar, X1]|i a>
         r_ia += 2.0 * contract('imae,me->ia', self.Lmnef, x_ia)
         # <0|L1[Hbar, X1]|i a>
-        temp = -1.0 * contract('ma,ie->miae', self.Hov, self.l_ia)
-        temp -= contract('ie,ma->miae', self.Hov, self.l_ia)
-        temp -= 2.0 * contract('mina,ne->miae', self.Hooov, self.l_ia)
-        temp += contract('imna,ne->miae', self.Hooov, self.l_ia)
-        temp -= 2.0 * contract('imne,na->miae', self.Hooov, self.l_ia)
-        temp += contract('mine,na->miae', self.Hooov, self.l_ia)
-        temp += 2.0 * contract('fmae,if->miae', self.Hvovv, self.l_ia)
-        temp -= contract('fmea,if->miae', self.Hvovv, self.l_ia)
-        temp += 2.0 * contract('fiea,mf->miae', self.Hvovv, self.l_ia)
-        temp -= contract('fiae,mf->miae', self.Hvovv, self.l_ia)
-        r_ia += contract('miae,me->ia', temp, x_ia)
+        r_ia += contract('miae,me->ia', self.lda.L1H_miae, x_ia)
         # <0|L1[Hbar, X2]|i a>
         r_ia += 2.0 * contract('imae,mnef,nf->ia', self.Lmnef, x_ijab, self.l_ia)
         r_ia -= contract('imae,mnfe,nf->ia', self.Lmnef, x_ijab, self.l_ia)
@@ -219,44 +262,32 @@ class HelperPert(object):
         r_ia += contract('ie,ea->ia', self.l_ia, self.make_Gvv(x_ijab, self.Lmnef))
 
         # <0|L2[Hbar, X1]|i a>
-        temp = -1.0 * contract('mfna,nief->iema', self.Hovov, self.l_ijab)
-        temp -= contract('ifne,nmaf->iema', self.Hovov, self.l_ijab)
-        temp -= contract('mfan,inef->iema', self.Hovvo, self.l_ijab)
-        temp -= contract('ifen,nmfa->iema', self.Hovvo, self.l_ijab)
-        temp += 0.5 * contract('fgae,imfg->iema', self.Hvvvv, self.l_ijab)
-        temp += 0.5 * contract('fgea,imgf->iema', self.Hvvvv, self.l_ijab)
-        temp += 0.5 * contract('imno,onea->iema', self.Hoooo, self.l_ijab)
-        temp += 0.5 * contract('mino,noea->iema', self.Hoooo, self.l_ijab)
-        r_ia += contract('iema,me->ia', temp, x_ia)
-        r_ia += contract('imaf,fe,me->ia', self.Lmnef, self.make_Gvv(self.t_ijab, self.l_ijab), x_ia)
-        r_ia += contract('mief,fa,me->ia', self.Lmnef, self.make_Gvv(self.t_ijab, self.l_ijab), x_ia)
-        r_ia -= contract('mnea,ni,me->ia', self.Lmnef, self.make_Goo(self.t_ijab, self.l_ijab), x_ia)
-        r_ia -= contract('inae,nm,me->ia', self.Lmnef, self.make_Goo(self.t_ijab, self.l_ijab), x_ia)
+        r_ia += contract('iema,me->ia', self.lda.L2H_iema, x_ia)
         # <0|L2[Hbar, X2]|i a>
-        r_ia -= contract('ma,mi->ia', self.Hov, self.make_Goo(x_ijab, self.l_ijab))
+        r_ia -= contract('ma,mi->ia', self.Hov, Goo_xl)
         r_ia += contract('ie,ea->ia', self.Hov, self.make_Gvv(x_ijab, self.l_ijab))
         r_ia -= contract('gnea,mnef,imfg->ia', self.Hvovv, x_ijab, self.l_ijab)
         r_ia -= contract('gnae,mnef,mifg->ia', self.Hvovv, x_ijab, self.l_ijab)
         r_ia -= contract('gief,mnef,mnga->ia', self.Hvovv, x_ijab, self.l_ijab)
         r_ia += 2.0 * contract('gmae,nifg,mnef->ia', self.Hvovv, self.l_ijab, x_ijab)
         r_ia -= contract('gmea,nifg,mnef->ia', self.Hvovv, self.l_ijab, x_ijab)
-        r_ia -= 2.0 * contract('fiea,fe->ia', self.Hvovv, self.make_Gvv(self.l_ijab, x_ijab))
-        r_ia += contract('fiae,fe->ia', self.Hvovv, self.make_Gvv(self.l_ijab, x_ijab))
+        r_ia -= 2.0 * contract('fiea,fe->ia', self.Hvovv, Gvv_lx)
+        r_ia += contract('fiae,fe->ia', self.Hvovv, Gvv_lx)
         r_ia += contract('mnoa,mnef,oief->ia', self.Hooov, x_ijab, self.l_ijab)
         r_ia += contract('inoe,mnef,mofa->ia', self.Hooov, x_ijab, self.l_ijab)
         r_ia += contract('miof,mnef,onea->ia', self.Hooov, x_ijab, self.l_ijab)
-        r_ia -= 2.0 * contract('mioa,mo->ia', self.Hooov, self.make_Goo(x_ijab, self.l_ijab))
-        r_ia += contract('imoa,mo->ia', self.Hooov, self.make_Goo(x_ijab, self.l_ijab))
+        r_ia -= 2.0 * contract('mioa,mo->ia', self.Hooov, Goo_xl)
+        r_ia += contract('imoa,mo->ia', self.Hooov, Goo_xl)
         r_ia -= 2.0 * contract('imoe,nofa,mnef->ia', self.Hooov, self.l_ijab, x_ijab)
         r_ia += contract('mioe,nofa,mnef->ia', self.Hooov, self.l_ijab, x_ijab)
         
     # Y2 equations, inhomogeneous terms
         # <0|L1 Abar|ij ab>
-        r_ijab = 2.0 * contract('jb,ia->ijab', self.make_Aov(), self.l_ia)
-        r_ijab -= contract('ib,ja->ijab', self.make_Aov(), self.l_ia)
+        r_ijab = 2.0 * contract('jb,ia->ijab', self.Aov, self.l_ia)
+        r_ijab -= contract('ib,ja->ijab', self.Aov, self.l_ia)
         # <0|L2 Abar|ij ab>
-        r_ijab += contract('ijeb,ea->ijab', self.l_ijab, self.make_Avv())
-        r_ijab -= contract('mjab,im->ijab', self.l_ijab, self.make_Aoo())
+        r_ijab += contract('ijeb,ea->ijab', self.l_ijab, self.Avv)
+        r_ijab -= contract('mjab,im->ijab', self.l_ijab, self.Aoo)
         # <0|L1[Hbar, X1]|ij ab>
         r_ijab -= contract('mieb,ja,me->ijab', self.Lmnef, self.l_ia, x_ia)
         r_ijab -= contract('ijae,mb,me->ijab', self.Lmnef, self.l_ia, x_ia)
@@ -293,7 +324,7 @@ class HelperPert(object):
         r_ijab -= contract('inae,mjfb,mnef->ijab', self.Lmnef, self.l_ijab, x_ijab)
         r_ijab -= contract('jnba,in->ijab', self.l_ijab, self.make_Goo(self.Lmnef, x_ijab))
         r_ijab += contract('ijfb,af->ijab', self.l_ijab, self.make_Gvv(self.Lmnef, x_ijab))
-        r_ijab += contract('ijae,be->ijab', self.Lmnef, self.make_Gvv(self.l_ijab, x_ijab))
+        r_ijab += contract('ijae,be->ijab', self.Lmnef, Gvv_lx)
         r_ijab -= contract('imab,jm->ijab', self.Lmnef, self.make_Goo(self.l_ijab, x_ijab))
         r_ijab -= contract('mjea,nifb,mnef->ijab', self.Lmnef, self.l_ijab, x_ijab)
         r_ijab += 2.0 * contract('imae,njfb,mnef->ijab', self.Lmnef, self.l_ijab, x_ijab)
@@ -304,22 +335,38 @@ class HelperPert(object):
         return r_ia, r_ijab
 
     def update_ys(self, y_ia, y_ijab, local=None):
+        r_ia, r_ijab = self.residual_ys(y_ia, y_ijab)
+
+        new_yia = y_ia.copy()
+        new_yijab = y_ijab.copy()
+
+        inc1, inc2 = self.increment(r_ia, r_ijab, local=local)
+        new_yia += inc1
+        new_yijab += inc2 + inc2.swapaxes(-4,-3).swapaxes(-2,-1)
+
+        #print("Checking y2 here: \n{}".format(new_yijab[0]))
+
+        return new_yia, new_yijab
+
+    def residual_ys(self, y_ia, y_ijab):
     # Y1 equations, homogeneous terms
 
         # y_ia = 2 * Hov + y_ie H_ea - y_ma H_im + y_me (2 * H_ieam - H_iema) + y_imef H_efam - y_mnae Hiemn
         #       - G_ef (2 * H_eifa - H_eiaf) - G_mn (2 * Hmina - H_imna)
         r_ia = self.inhmy_ia.copy()
-        r_ia += self.omega * y_ia.copy()
-        r_ia += contract('ie,ea->ia', y_ia, self.Hvv)
-        r_ia -= contract('ma,im->ia', y_ia, self.Hoo)
-        r_ia += 2.0 * contract('me,ieam->ia', y_ia, self.Hovvo)
-        r_ia -= contract('me,iema->ia', y_ia, self.Hovov)
-        r_ia += contract('imef,efam->ia', y_ijab, self.Hvvvo)
-        r_ia -= contract('mnae,iemn->ia', y_ijab, self.Hovoo)
-        r_ia -= 2.0 * contract('eifa,ef->ia', self.Hvovv, self.make_Gvv(self.y_ijab, self.t_ijab))
-        r_ia += contract('eiaf,ef->ia', self.Hvovv, self.make_Gvv(self.y_ijab, self.t_ijab))
-        r_ia -= 2.0 * contract('mina,mn->ia', self.Hooov, self.make_Goo(self.t_ijab, self.y_ijab))
-        r_ia += contract('imna,mn->ia', self.Hooov, self.make_Goo(self.t_ijab, self.y_ijab))
+        r_ia += self.omega * y_ia
+        r_ia += contract('...ie,ea->...ia', y_ia, self.Hvv)
+        r_ia -= contract('...ma,im->...ia', y_ia, self.Hoo)
+        r_ia += 2.0 * contract('...me,ieam->...ia', y_ia, self.Hovvo)
+        r_ia -= contract('...me,iema->...ia', y_ia, self.Hovov)
+        r_ia += contract('...imef,efam->...ia', y_ijab, self.Hvvvo)
+        r_ia -= contract('...mnae,iemn->...ia', y_ijab, self.Hovoo)
+        Gvv = self.make_Gvv(y_ijab, self.t_ijab)
+        Goo = self.make_Goo(self.t_ijab, y_ijab)
+        r_ia -= 2.0 * contract('eifa,...ef->...ia', self.Hvovv, Gvv)
+        r_ia += contract('eiaf,...ef->...ia', self.Hvovv, Gvv)
+        r_ia -= 2.0 * contract('mina,...mn->...ia', self.Hooov, Goo)
+        r_ia += contract('imna,...mn->...ia', self.Hooov, Goo)
 
     # Y2 equations, homogeneous terms
 
@@ -330,54 +377,53 @@ class HelperPert(object):
         # y_ijab = y_ijab + y_jiba
 
         r_ijab = self.inhmy_ijab.copy()
-        r_ijab += 0.5 * self.omega * y_ijab.copy()
-        r_ijab += 2.0 * contract('ia,jb->ijab', y_ia, self.Hov)
-        r_ijab -= contract('ja,ib->ijab', y_ia, self.Hov)
-        r_ijab += contract('ijeb,ea->ijab', y_ijab, self.Hvv)
-        r_ijab -= contract('mjab,im->ijab', y_ijab, self.Hoo)
-        r_ijab += 0.5 * contract('mnab,ijmn->ijab', y_ijab, self.Hoooo)
-        r_ijab += 0.5 * contract('ijef,efab->ijab', y_ijab, self.Hvvvv)
-        r_ijab += 2.0 * contract('ie,ejab->ijab', y_ia, self.Hvovv)
-        r_ijab -= contract('ie,ejba->ijab', y_ia, self.Hvovv)
-        r_ijab -= 2.0 * contract('mb,jima->ijab', y_ia, self.Hooov)
-        r_ijab += contract('mb,ijma->ijab', y_ia, self.Hooov)
-        r_ijab += 2.0 * contract('mjeb,ieam->ijab', y_ijab, self.Hovvo)
-        r_ijab -= contract('mjeb,iema->ijab', y_ijab, self.Hovov)
-        r_ijab -= contract('mibe,jema->ijab', y_ijab, self.Hovov)
-        r_ijab -= contract('mieb,jeam->ijab', y_ijab, self.Hovvo)
-        r_ijab += contract('ae,ijeb->ijab', self.make_Gvv(y_ijab, self.t_ijab), self.Lmnef)
-        r_ijab -= contract('mi,mjab->ijab', self.make_Goo(self.t_ijab, y_ijab), self.Lmnef)
-
-        new_yia = y_ia.copy()
-        new_yijab = y_ijab.copy()
-
-        if local:
-            inc1, inc2 = local.increment(r_ia, r_ijab, self.F_occ)
-            #inc2 = local.increment(r_ia, r_ijab, self.F_occ)
-            new_yia += inc1
-            #new_yia += r_ia/self.D_ia
-        else:    
-            inc2 = r_ijab/self.D_ijab
-            new_yia += r_ia/self.D_ia
-        new_yijab += inc2 + inc2.swapaxes(0,1).swapaxes(2,3)
+        r_ijab += 0.5 * self.omega * y_ijab
+        r_ijab += 2.0 * contract('...ia,jb->...ijab', y_ia, self.Hov)
+        r_ijab -= contract('...ja,ib->...ijab', y_ia, self.Hov)
+        r_ijab += contract('...ijeb,ea->...ijab', y_ijab, self.Hvv)
+        r_ijab -= contract('...mjab,im->...ijab', y_ijab, self.Hoo)
+        r_ijab += 0.5 * contract('...mnab,ijmn->...ijab', y_ijab, self.Hoooo)
+        r_ijab += 0.5 * self.hbar.Hvvvv_left(y_ijab)
+        r_ijab += 2.0 * contract('...ie,ejab->...ijab', y_ia, self.Hvovv)
+        r_ijab -= contract('...ie,ejba->...ijab', y_ia, self.Hvovv)
+        r_ijab -= 2.0 * contract('...mb,jima->...ijab', y_ia, self.Hooov)
+        r_ijab += contract('...mb,ijma->...ijab', y_ia, self.Hooov)
+        r_ijab += 2.0 * contract('...mjeb,ieam->...ijab', y_ijab, self.Hovvo)
+        r_ijab -= contract('...mjeb,iema->...ijab', y_ijab, self.Hovov)
+        r_ijab -= contract('...mibe,jema->...ijab', y_ijab, self.Hovov)
+        r_ijab -= contract('...mieb,jeam->...ijab', y_ijab, self.Hovvo)
+        r_ijab += contract('...ae,ijeb->...ijab', Gvv, self.Lmnef)
+        r_ijab -= contract('...mi,mjab->...ijab', Goo, self.Lmnef)
 
-        #print("Checking y2 here: \n{}".format(new_yijab[0]))
-
-        return new_yia, new_yijab
+        return r_ia, r_ijab
 
     # compute pseudoresponse
     def pseudo_response(self, z_ia, z_ijab):
         polar1 = 0
         polar2 = 0
-        polar1 = 2.0 * contract('ia,ai->', z_ia, self.make_Avo())
-        temp = self.pertbar_ijab + self.pertbar_ijab.swapaxes(0,1).swapaxes(2,3)
-        polar2 = 2.0 * contract('ijab,ijab->', z_ijab, temp)
-        polar2 -= contract('ijba,ijab->', z_ijab, temp)
+        polar1 = 2.0 * contract('...ia,...ai->...', z_ia, self.Avo)
+        temp = self.pertbar_ijab + self.pertbar_ijab.swapaxes(-4,-3).swapaxes(-2,-1)
+        polar2 = 2.0 * contract('...ijab,...ijab->...', z_ijab, temp)
+        polar2 -= contract('...ijba,...ijab->...', z_ijab, temp)
 
         return -2.0 * (polar1 + polar2)
 
+    def pair_pseudo_response(self, z_ijab):
+        # Pair contributions of the doubles to the pseudoresponse, for pair freezing
+        temp = self.pertbar_ijab + self.pertbar_ijab.swapaxes(-4,-3).swapaxes(-2,-1)
+        polar2 = 2.0 * contract('ijab,ijab->ij', z_ijab, temp)
+        polar2 -= contract('ijba,ijab->ij', z_ijab, temp)
+        return -2.0 * polar2
+
     # iterate until convergence
-    def iterate(self, hand, local=None, r_conv=1e-7, maxiter=100, max_diis=8, start_diis=0): 
+    def iterate(self, hand, local=None, r_conv=1e-7, maxiter=100, max_diis=8, start_diis=0, freeze_conv=None, recheck=5, solver='jacobi', restart=20): 
+        # solver='gmres' solves the same equations with preconditioned GMRES, see iterate_gmres
+        if solver == 'gmres':
+            return self.iterate_gmres(hand, local=local, r_conv=r_conv, maxiter=maxiter, restart=restart)
+        # Pairs with increment norms and pair pseudoresponse changes below freeze_conv are frozen, see HelperLocal.init_freeze
+        if local:
+            local.init_freeze(freeze_conv, recheck)
+        self.converged = False
         print('Iteration\t\t Pseudoresponse\t\tRMS')
         if hand == 'right':
             new_presp = self.pseudo_response(self.x_ia, self.x_ijab)
@@ -404,16 +450,23 @@ class HelperPert(object):
                 rms = np.linalg.norm(new_yia - self.y_ia)
                 rms += np.linalg.norm(new_yijab - self.y_ijab)
 
-            print('CCPert {} Iteration: {:3d}\t {:2.12f}\t{:1.12f}'.format(hand, i+1, new_presp, rms))
+            frozen = ''
+            if local and local.freeze_conv is not None:
+                frozen = local.update_freeze(self.pair_pseudo_response(new_xijab if hand == 'right' else new_yijab))
+            print('CCPert {} Iteration: {:3d}\t {:2.12f}\t{:1.12f}{}'.format(hand, i+1, new_presp, rms, frozen))
             if(abs(rms) < r_conv):
-                print('{}-hand convergence reached.\n Pseudoresponse: {}\n'.format(hand, new_presp))
-                if hand == 'right':
-                    self.x_ia = new_xia
-                    self.x_ijab = new_xijab
+                if local and local.thaw_pairs():
+                    print('Unfreezing all pairs before convergence.')
                 else:
-                    self.y_ia = new_yia
-                    self.y_ijab = new_yijab
-                break
+                    print('{}-hand convergence reached.\n Pseudoresponse: {}\n'.format(hand, new_presp))
+                    self.converged = True
+                    if hand == 'right':
+                        self.x_ia = new_xia
+                        self.x_ijab = new_xijab
+                    else:
+                        self.y_ia = new_yia
+                        self.y_ijab = new_yijab
+                    break
 
             if hand == 'right':
                 # Update error vectors for DIIS
@@ -421,6 +474,8 @@ class HelperPert(object):
                 # Extrapolate using DIIS
                 if(i >= start_diis):
                     new_xia, new_xijab = diis.extrapolate(new_xia, new_xijab)
+                if local:
+                    new_xijab = local.keep_frozen(self.x_ijab, new_xijab)
                 self.x_ia = new_xia
                 self.x_ijab = new_xijab
             else:
@@ -429,11 +484,209 @@ class HelperPert(object):
                 # Extrapolate using DIIS
                 if(i >= start_diis):
                     new_yia, new_yijab = diis.extrapolate(new_yia, new_yijab)
+                if local:
+                    new_yijab = local.keep_frozen(self.y_ijab, new_yijab)
                 self.y_ia = new_yia
                 self.y_ijab = new_yijab
+        else:
+            print('{}-hand equations did not converge in {} iterations.\n Pseudoresponse: {}\n'.format(hand, maxiter, new_presp))
 
         return new_presp
 
+    def iterate_gmres(self, hand, local=None, r_conv=1e-7, maxiter=100, restart=20):
+        # The residuals are linear in X (Y): r(X) = r(0) + A X, and the Jacobi increments
+        # (diagonal Hbar denominators, or the pair spaces if local) are the preconditioner
+        if local:
+            # Pair freezing is a Jacobi-iteration device, not used here
+            local.init_freeze()
+        if hand == 'right':
+            residual = self.residual_xs
+            z_ia, z_ijab = self.x_ia, self.x_ijab
+        else:
+            # Prep inhomogeneous terms before iterations start
+            self.inhmy_ia, self.inhmy_ijab = self.inhomogeneous_ys(self.x_ia, self.x_ijab)
+            residual = self.residual_ys
+            z_ia, z_ijab = self.y_ia, self.y_ijab
+
+        size1 = z_ia.size
+        def unpack(v):
+            return v[:size1].reshape(z_ia.shape), v[size1:].reshape(z_ijab.shape)
+
+        r0_ia, r0_ijab = residual(np.zeros_like(z_ia), np.zeros_like(z_ijab))
+        r0 = np.concatenate((r0_ia.ravel(), r0_ijab.ravel()))
+
+        def matvec(v):
+            r_ia, r_ijab = residual(*unpack(v))
+            return np.concatenate((r_ia.ravel(), r_ijab.ravel())) - r0
+
+        def precond(r):
+            inc1, inc2 = self.increment(*unpack(r), local=local)
+            inc2 = inc2 + inc2.swapaxes(-4,-3).swapaxes(-2,-1)
+            return np.concatenate((inc1.ravel(), inc2.ravel()))
+
+        def report(niter, norm):
+            print('CCPert {} GMRES Iteration: {:3d}\t{:1.12f}'.format(hand, niter, norm))
+
+        # In local mode the residual norm is that of the pair-space part, as for the Jacobi increments
+        print('Iteration\t\t Residual norm')
+        z, converged = gmres(matvec, precond, -r0, np.concatenate((z_ia.ravel(), z_ijab.ravel())), r_conv=r_conv, maxiter=maxiter, restart=restart, callback=report)
+        z_ia, z_ijab = unpack(z)
+        new_presp = self.pseudo_response(z_ia, z_ijab)
+        self.converged = converged
+        if converged:
+            print('{}-hand convergence reached.\n Pseudoresponse: {}\n'.format(hand, new_presp))
+        else:
+            print('{}-hand equations did not converge in {} iterations.\n Pseudoresponse: {}\n'.format(hand, maxiter, new_presp))
+
+        if hand == 'right':
+            self.x_ia, self.x_ijab = z_ia, z_ijab
+        else:
+            self.y_ia, self.y_ijab = z_ia, z_ijab
+
+        return new_presp
+
+class HelperPertBatch(HelperPert):
+    '''
+    Solves the response equations of several perturbations at one frequency together.
+
+    The X and Y amplitudes of all perturbations are stacked along a leading axis, so that
+    each residual term is one contraction over the whole batch and the Hbar elements are
+    read once per iteration. DIIS extrapolation is done per perturbation, perturbations are
+    removed from the batch once converged, and the amplitudes are copied back to the HelperPert objects.
+
+    :param perts: HelperPert objects built from the same hbar and lambdas, at the same frequency
+    :type perts: list of class 'ccsd_lpno.HelperPert'
+    '''
+    def __init__(self, perts):
+        pert = perts[0]
+        self.perts = perts
+        self.MO = pert.MO
+        self.t_ia = pert.t_ia
+        self.t_ijab = pert.t_ijab
+        self.l_ia = pert.l_ia
+        self.l_ijab = pert.l_ijab
+        self.no_occ = pert.no_occ
+        self.no_vir = pert.no_vir
+        self.F_occ = pert.F_occ
+        self.hbar = pert.hbar
+        self.lda = pert.lda
+        self.omega = pert.omega
+        self.D_ia = pert.D_ia
+        self.D_ijab = pert.D_ijab
+
+        # Perturbation-dependent pieces of the residuals, stacked on first use, see get_element
+        self.elements = {}
+        self.pertbar_ijab = np.array([p.pertbar_ijab for p in perts])
+
+        self.x_ia = np.array([p.x_ia for p in perts])
+        self.x_ijab = np.array([p.x_ijab for p in perts])
+        self.y_ia = np.array([p.y_ia for p in perts])
+        self.y_ijab = np.array([p.y_ijab for p in perts])
+
+    def get_element(self, name):
+        # The batch has no single A to build from, the elements of the perturbations are stacked
+        if name not in self.elements:
+            self.elements[name] = np.array([getattr(p, name) for p in self.perts])
+        return self.elements[name]
+
+    def increment(self, r_ia, r_ijab, local=None):
+        # The local increments are taken one perturbation at a time
+        if local:
+            incs = [local.increment(r_ia[n], r_ijab[n], self.F_occ) for n in range(len(self.perts))]
+            return np.array([inc[0] for inc in incs]), np.array([inc[1] for inc in incs])
+        return r_ia/self.D_ia, r_ijab/self.D_ijab
+
+    def select(self, keep):
+        # Restrict the batch to the perturbations in keep (boolean mask), converged ones are dropped
+        self.perts = [p for p, k in zip(self.perts, keep) if k]
+        self.elements = {name: element[keep] for name, element in self.elements.items()}
+        self.pertbar_ijab = self.pertbar_ijab[keep]
+        if hasattr(self, 'inhmy_ia'):
+            self.inhmy_ia = self.inhmy_ia[keep]
+            self.inhmy_ijab = self.inhmy_ijab[keep]
+
+    def iterate(self, hand, local=None, r_conv=1e-7, maxiter=100, max_diis=8, start_diis=0):
+        # Iterate until every perturbation in the batch is converged, a converged
+        # perturbation is removed from the batch and no longer updated
+        # Returns the pseudoresponses and the convergence flags of the perturbations
+        print('Iteration\t\t Pseudoresponse\t\tRMS')
+        members = self.perts
+        if hand == 'right':
+            z_ia, z_ijab = self.x_ia, self.x_ijab
+        else:
+            # Prep inhomogeneous terms before iterations start
+            inhm = [p.inhomogeneous_ys(p.x_ia, p.x_ijab) for p in self.perts]
+            self.inhmy_ia = np.array([r[0] for r in inhm])
+            self.inhmy_ijab = np.array([r[1] for r in inhm])
+            z_ia, z_ijab = self.y_ia, self.y_ijab
+        all_ia, all_ijab = z_ia.copy(), z_ijab.copy()
+        new_presp = self.pseudo_response(z_ia, z_ijab)
+        # One DIIS per perturbation
+        diis = [HelperDIIS(z_ia[n], z_ijab[n], max_diis) for n in range(len(self.perts))]
+        active = np.arange(len(members))
+        converged = np.zeros(len(members), dtype=bool)
+
+        print('CCPert {} Iteration: 0\t {}'.format(hand, new_presp))
+        for i in range(maxiter):
+            if hand == 'right':
+                new_zia, new_zijab = self.update_xs(z_ia, z_ijab, local=local)
+            else:
+                new_zia, new_zijab = self.update_ys(z_ia, z_ijab, local=local)
+            new_presp = self.pseudo_response(new_zia, new_zijab)
+            rms = np.sqrt(np.sum((new_zia - z_ia)**2, axis=(1, 2)))
+            rms += np.sqrt(np.sum((new_zijab - z_ijab)**2, axis=(1, 2, 3, 4)))
+
+            done = rms < r_conv
+            print('CCPert {} Iteration: {:3d}\t {}\t{:1.12f}\tConverged: {}'.format(hand, i+1, new_presp, np.max(rms), np.sum(converged) + np.sum(done)))
+            all_ia[active[done]] = new_zia[done]
+            all_ijab[active[done]] = new_zijab[done]
+            converged[active[done]] = True
+            if np.all(done):
+                break
+            if np.any(done):
+                keep = ~done
+                self.select(keep)
+                new_zia, new_zijab = new_zia[keep], new_zijab[keep]
+                diis = [d for d, k in zip(diis, keep) if k]
+                active = active[keep]
+
+            for n in range(len(self.perts)):
+                # Update error vectors for DIIS
+                diis[n].update_err_list(new_zia[n], new_zijab[n])
+                # Extrapolate using DIIS
+                if(i >= start_diis):
+                    new_zia[n], new_zijab[n] = diis[n].extrapolate(new_zia[n], new_zijab[n])
+            z_ia, z_ijab = new_zia, new_zijab
+        else:
+            all_ia[active] = z_ia
+            all_ijab[active] = z_ijab
+
+        # Back to the whole batch
+        self.perts = members
+        self.elements = {}
+        self.pertbar_ijab = np.array([p.pertbar_ijab for p in members])
+        if hand == 'left':
+            self.inhmy_ia = np.array([r[0] for r in inhm])
+            self.inhmy_ijab = np.array([r[1] for r in inhm])
+        new_presp = self.pseudo_response(all_ia, all_ijab)
+        if np.all(converged):
+            print('{}-hand convergence reached.\n Pseudoresponse: {}\n'.format(hand, new_presp))
+        else:
+            print('{}-hand equations did not converge in {} iterations.\n Pseudoresponse: {}\n'.format(hand, maxiter, new_presp))
+
+        for n, p in enumerate(self.perts):
+            if hand == 'right':
+                p.x_ia, p.x_ijab = all_ia[n].copy(), all_ijab[n].copy()
+            else:
+                p.y_ia, p.y_ijab = all_ia[n].copy(), all_ijab[n].copy()
+            p.converged = converged[n]
+        if hand == 'right':
+            self.x_ia, self.x_ijab = all_ia, all_ijab
+        else:
+            self.y_ia, self.y_ijab = all_ia, all_ijab
+
+        return new_presp, converged
+
 class HelperResp(object):
     def __init__(self, lda, B, pertA):
 
@@ -452,32 +705,41 @@ class HelperResp(object):
         self.y_ia = pertA.y_ia
         self.y_ijab = pertA.y_ijab
 
-    def linear_resp(self):
+    def linear_resp(self, B_neg=None):
+        # With B_neg, the HelperPert of B solved at -omega, the Y-free (asymmetric) form is used:
+        # <0|Y(A) B_bar|0> is replaced by [eta^A + F X(A)] X(B, -omega), with [eta^A + F X(A)]
+        # the left-hand inhomogeneous terms of A (pertA.inhmy_ia, pertA.inhmy_ijab)
         linresp = 0.0
         # <0| B_bar X1 |0>
-        linresp += 2.0 * contract('ia,ia->', self.B.make_Aov(), self.x_ia)
+        linresp += 2.0 * contract('ia,ia->', self.B.Aov, self.x_ia)
         # <0| L1 B_bar X1 |0>
-        linresp += contract('ca,ia,ic->', self.B.make_Avv(), self.x_ia, self.l_ia) #*
-        linresp -= contract('ik,ia,ka->', self.B.make_Aoo(), self.x_ia, self.l_ia) #*
+        linresp += contract('ca,ia,ic->', self.B.Avv, self.x_ia, self.l_ia) #*
+        linresp -= contract('ik,ia,ka->', self.B.Aoo, self.x_ia, self.l_ia) #*
         # <0| L2 B_bar X1 |0>
-        linresp -= 0.5 * contract('kbij,ka,ijab->', self.B.make_Aovoo(), self.x_ia, self.l_ijab)
-        linresp += contract('bcaj,ia,ijbc->', self.B.make_Avvvo(), self.x_ia, self.l_ijab)
-        linresp -= 0.5 * contract('kaji,kb,ijab->', self.B.make_Aovoo(), self.x_ia, self.l_ijab)
+        linresp -= 0.5 * contract('kbij,ka,ijab->', self.B.Aovoo, self.x_ia, self.l_ijab)
+        linresp += contract('bcaj,ia,ijbc->', self.B.Avvvo, self.x_ia, self.l_ijab)
+        linresp -= 0.5 * contract('kaji,kb,ijab->', self.B.Aovoo, self.x_ia, self.l_ijab)
         # <0| Y1 B_bar |0>
-        linresp += contract('ai,ia->', self.B.make_Avo(), self.y_ia)
+        if B_neg is None:
+            linresp += contract('ai,ia->', self.B.Avo, self.y_ia)
+        else:
+            linresp += contract('ia,ia->', self.pertA.inhmy_ia, B_neg.x_ia)
         #singles_val += linresp
         # <0| L1 B_bar X2 |0>
-        linresp += 2.0 * contract('jb,ijab,ia->', self.B.make_Aov(), self.x_ijab, self.l_ia)
-        linresp -= contract('jb,ijba,ia->', self.B.make_Aov(), self.x_ijab, self.l_ia)
+        linresp += 2.0 * contract('jb,ijab,ia->', self.B.Aov, self.x_ijab, self.l_ia)
+        linresp -= contract('jb,ijba,ia->', self.B.Aov, self.x_ijab, self.l_ia)
         # <0| L2 B_bar X2 |0>
-        linresp -= 0.5 * contract('ki,kjab,ijab->', self.B.make_Aoo(), self.x_ijab, self.l_ijab)
-        linresp -= 0.5 * contract('kj,kiba,ijab->', self.B.make_Aoo(), self.x_ijab, self.l_ijab)
-        linresp += 0.5 * contract('ac,ijcb,ijab->', self.B.make_Avv(), self.x_ijab, self.l_ijab)
-        linresp += 0.5 * contract('bc,ijac,ijab->', self.B.make_Avv(), self.x_ijab, self.l_ijab)
+        linresp -= 0.5 * contract('ki,kjab,ijab->', self.B.Aoo, self.x_ijab, self.l_ijab)
+        linresp -= 0.5 * contract('kj,kiba,ijab->', self.B.Aoo, self.x_ijab, self.l_ijab)
+        linresp += 0.5 * contract('ac,ijcb,ijab->', self.B.Avv, self.x_ijab, self.l_ijab)
+        linresp += 0.5 * contract('bc,ijac,ijab->', self.B.Avv, self.x_ijab, self.l_ijab)
         #print("Polar2 : {}".format(linresp))
         # <0| Y2 B_bar |0>
-        linresp += 0.5 * contract('abij,ijab->', self.B.make_Avvoo(), self.y_ijab)
-        linresp += 0.5 * contract('baji,ijab->', self.B.make_Avvoo(), self.y_ijab)
+        if B_neg is None:
+            linresp += 0.5 * contract('abij,ijab->', self.B.Avvoo, self.y_ijab)
+            linresp += 0.5 * contract('baji,ijab->', self.B.Avvoo, self.y_ijab)
+        else:
+            linresp += contract('ijab,ijab->', self.pertA.inhmy_ijab, B_neg.x_ijab)
         #doubles_val = linresp - singles_val
 
         #print("Singles contribution: {}".format(singles_val))
@@ -486,3 +748,91 @@ class HelperResp(object):
         linresp *= -1.0
 
         return linresp
+
+class HelperRespTensor(object):
+    '''
+    Linear response functions <<B;A>> for every pair of operators from two sets at once.
+
+    The X and Y amplitudes of the A operators are contracted with the lambdas into one
+    density per perturbed Bbar block, and each term of HelperResp.linear_resp is then a
+    single contraction of the stacked Bbar blocks of all B operators with the stacked densities.
+
+    :param lda: HelperLambda object with converged lambdas
+    :type lda: class 'ccsd_lpno.HelperLambda'
+    :param Bs: HelperPert objects of the operators whose expectation values are the response functions
+    :type Bs: list of class 'ccsd_lpno.HelperPert'
+    :param pertAs: Solved HelperPert objects providing the X and Y amplitudes
+    :type pertAs: list of class 'ccsd_lpno.HelperPert'
+    '''
+    def __init__(self, lda, Bs, pertAs):
+
+        # Get lambdas
+        self.l_ia = lda.l_ia
+        self.l_ijab = lda.l_ijab
+
+        self.Bs = Bs
+        self.pertAs = pertAs
+        self.x_ia = np.array([A.x_ia for A in pertAs])
+        self.x_ijab = np.array([A.x_ijab for A in pertAs])
+
+    def stack(self, perts, name):
+        return np.array([getattr(pert, name) for pert in perts])
+
+    def linear_resp(self, B_negs=None, components='full'):
+        '''
+        Response tensor, see HelperResp.linear_resp for the terms
+
+        :param B_negs: HelperPert objects of the Bs solved at -omega, for the Y-free form
+        :type B_negs: list of class 'ccsd_lpno.HelperPert'
+        :param components: 'full' for the whole tensor, 'diag' for its diagonal and 'trace' for its trace,
+                           the last two need the same number of Bs and As
+        :type components: string
+
+        :returns: tensor[b, a] = <<B_b;A_a>>, its diagonal or its trace
+        '''
+        def term(blocks, b_idx, density, a_idx):
+            # One term for all pairs of operators, or only pairs with b == a
+            if components == 'full':
+                return contract('B' + b_idx + ',A' + a_idx + '->BA', blocks, density)
+            elif components == 'diag':
+                return contract('A' + b_idx + ',A' + a_idx + '->A', blocks, density)
+            return contract('A' + b_idx + ',A' + a_idx + '->', blocks, density)
+
+        x_ia = self.x_ia
+        x_ijab = self.x_ijab
+
+        # <0| B_bar X1 |0> + <0| L1 B_bar X2 |0>
+        Dov = 2.0 * x_ia
+        Dov += 2.0 * contract('...ijab,ia->...jb', x_ijab, self.l_ia)
+        Dov -= contract('...ijba,ia->...jb', x_ijab, self.l_ia)
+        # <0| L1 B_bar X1 |0> + <0| L2 B_bar X2 |0>
+        Dvv = contract('...ia,ic->...ca', x_ia, self.l_ia)
+        Dvv += 0.5 * contract('...ijcb,ijab->...ac', x_ijab, self.l_ijab)
+        Dvv += 0.5 * contract('...ijac,ijab->...bc', x_ijab, self.l_ijab)
+        Doo = -1.0 * contract('...ia,ka->...ik', x_ia, self.l_ia)
+        Doo -= 0.5 * contract('...kjab,ijab->...ki', x_ijab, self.l_ijab)
+        Doo -= 0.5 * contract('...kiba,ijab->...kj', x_ijab, self.l_ijab)
+        # <0| L2 B_bar X1 |0>
+        Dovoo = -0.5 * contract('...ka,ijab->...kbij', x_ia, self.l_ijab)
+        Dovoo -= 0.5 * contract('...kb,ijab->...kaji', x_ia, self.l_ijab)
+        Dvvvo = contract('...ia,ijbc->...bcaj', x_ia, self.l_ijab)
+
+        linresp = term(self.stack(self.Bs, 'Aov'), 'jb', Dov, 'jb')
+        linresp += term(self.stack(self.Bs, 'Avv'), 'ca', Dvv, 'ca')
+        linresp += term(self.stack(self.Bs, 'Aoo'), 'ik', Doo, 'ik')
+        linresp += term(self.stack(self.Bs, 'Aovoo'), 'kbij', Dovoo, 'kbij')
+        linresp += term(self.stack(self.Bs, 'Avvvo'), 'bcaj', Dvvvo, 'bcaj')
+        # <0| Y1 B_bar |0> + <0| Y2 B_bar |0>
+        if B_negs is None:
+            y_ijab = self.stack(self.pertAs, 'y_ijab')
+            Avvoo = self.stack(self.Bs, 'Avvoo')
+            linresp += term(self.stack(self.Bs, 'Avo'), 'ai', self.stack(self.pertAs, 'y_ia'), 'ia')
+            linresp += 0.5 * term(Avvoo, 'abij', y_ijab, 'ijab')
+            linresp += 0.5 * term(Avvoo, 'baji', y_ijab, 'ijab')
+        else:
+            linresp += term(self.stack(B_negs, 'x_ia'), 'ia', self.stack(self.pertAs, 'inhmy_ia'), 'ia')
+            linresp += term(self.stack(B_negs, 'x_ijab'), 'ijab', self.stack(self.pertAs, 'inhmy_ijab'), 'ijab')
+
+        linresp *= -1.0
+
+        return linresp
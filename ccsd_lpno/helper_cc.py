@@ -8,6 +8,7 @@ import numpy as np
 import psi4
 from . import diis
 from .diis import *
+from .local import HelperLocal
 from opt_einsum import contract
 
 class HelperCCEnergy(object):
@@ -29,8 +30,34 @@ class HelperCCEnergy(object):
     :type e_cut: double
     :param ppno_correction: Flag to compute the PNO++ correction
     :type ppno_correction: bool
+    :param pno_target: Target MP2-level truncation error, used to select pno_cut if given (pert None, 'mu' or 'l')
+    :type pno_target: double
+    :param target_type: Quantity for pno_target, 'energy' (MP2 correlation energy) or 'polar' (MP2-level polarizability)
+    :type target_type: string
+    :param pair_adaptive: Flag to scale the PNO cutoff of each pair by its share of the MP2 energy (or pseudoresponse)
+    :type pair_adaptive: bool
+    :param merge_cut: Singular value cutoff for dropping linearly dependent PNOs when combining PNO and PNO++ spaces
+    :type merge_cut: double
+    :param presp_cut: Weak pair cutoff on the MP2 pair pseudoresponse, used for the perturbed densities if given
+    :type presp_cut: double
+    :param domain: Pair domain engine, 'pno', 'osv' (orbital-specific virtuals), 'osv+pno' (OSV pair spaces refined into PNOs) or 'pao' (projected atomic orbitals)
+    :type domain: string
+    :param osv_cut: Occupation number cutoff for truncating OSVs, pno_cut is used if not given
+    :type osv_cut: double
+    :param bp_cut: Boughton-Pulay completeness cutoff for the atom domains of PAOs
+    :type bp_cut: double
+    :param pao_dist: Largest distance (bohr) between the PAO domains of a strong pair, replaces e_cut for PAO domains; all pairs are strong if not given
+    :type pao_dist: double
+    :param fvno: Global virtual truncation, 'fvno' (MP2 density) or 'fvno++' (perturbed, dipole density)
+    :type fvno: string
+    :param fvno_cut: Occupation number cutoff for truncating FVNOs
+    :type fvno_cut: double
+    :param lmp2: Flag to solve the local MP2 equations (off-diagonal F_occ) iteratively for localized occupied orbitals
+    :type lmp2: bool
+    :param init_pairs: Flag to build the pair spaces of local, False when they are loaded by a HelperStore
+    :type init_pairs: bool
     '''
-    def __init__(self, rhf_wfn, local=None, local_occ=True, pert=False, pno_cut=0, e_cut=0, omega=0.0774):
+    def __init__(self, rhf_wfn, local=None, local_occ=True, pert=False, pno_cut=0, e_cut=0, omega=0.0774, pno_target=None, target_type='energy', pair_adaptive=False, merge_cut=1e-6, presp_cut=None, domain='pno', osv_cut=None, bp_cut=0.98, pao_dist=None, fvno=None, fvno_cut=0, lmp2=False, init_pairs=True):
         # Set energy and wfn from Psi4
         print(type(rhf_wfn))
         self.wfn = rhf_wfn
@@ -106,6 +133,13 @@ class HelperCCEnergy(object):
         # Need to change ERIs to physicist notation
         self.MO = self.MO.swapaxes(1, 2)
 
+        # Truncate the virtual space shared by all pairs, everything
+        # downstream then runs on the smaller no_vir
+        if fvno:
+            self.truncate_virtuals(fvno, fvno_cut)
+            if local:
+                local.no_vir = self.no_vir
+
         # Need F_occ and F_vir separate (will need F_vir for semi-canonical basis later)
         self.F_occ = self.F[:self.no_occ, :self.no_occ]
         self.F_vir = self.F[self.no_occ:, self.no_occ:]
@@ -128,24 +162,41 @@ class HelperCCEnergy(object):
         self.t_ijab = self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:].copy()
         # T2s matching!
         self.t_ijab /= self.d_ijab
+        # Localized occupied orbitals couple through the off-diagonal F_occ
+        lmp2 = lmp2 and local_occ and init_pairs
+        if lmp2:
+            self.t_ijab = self.do_LMP2(self.t_ijab)
         mp2_e = 2.0 * contract('ijab,ijab->', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
         mp2_e -= contract('ijba,ijab->', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
         print("MP2 energy(without truncation): {}".format(mp2_e))
 
 
-        if local:
+        if local and init_pairs:
             # Initialize PNOs
             print('Local switch on. Initializing PNOs.')
-            # Identify weak pairs using MP2 pair corr energy
-            self.e_ij = np.zeros((self.no_occ, self.no_occ))
-            self.e_ij += 2.0 * contract('ijab,ijab->ij', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
-            self.e_ij -= contract('ijba,ijab->ij', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
-            #print('MP2 correlation energy: {}\n'.format(self.mp2_e))
-            #print('Pair corr energy matrix:\n{}'.format(e_ij))
-            str_pair_list = abs(self.e_ij) > e_cut
-            print('Strong pair list:\n{}'.format(str_pair_list))
-
-            if pert:
+            if domain != 'pao':
+                # Identify weak pairs using MP2 pair corr energy
+                self.e_ij = np.zeros((self.no_occ, self.no_occ))
+                self.e_ij += 2.0 * contract('ijab,ijab->ij', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
+                self.e_ij -= contract('ijba,ijab->ij', self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.t_ijab)
+                #print('MP2 correlation energy: {}\n'.format(self.mp2_e))
+                #print('Pair corr energy matrix:\n{}'.format(e_ij))
+                str_pair_list = abs(self.e_ij) > e_cut
+                print('Strong pair list:\n{}'.format(str_pair_list))
+
+            if domain == 'pao':
+                # PAO domains and their strong pairs only need the orbitals and the geometry,
+                # no densities or MP2 pair energies
+                if pert:
+                    print("Perturbed densities are not used for PAO domains.")
+                C_all = np.asarray(self.C_arr)
+                ao_center = np.array([basis.function_to_center(mu) for mu in range(basis.nbf())])
+                S = np.asarray(self.mints.ao_overlap())
+                geom = np.asarray(self.wfn.molecule().geometry())
+                local.init_PAOs(C_all[:, :(self.no_fz + self.no_occ)], C_all[:, self.no_fz:(self.no_fz + self.no_occ)], C_all[:, (self.no_fz + self.no_occ):], S, ao_center, self.F_vir, geom=geom, pao_dist=pao_dist, bp_cut=bp_cut)
+                local.pno_cut = pno_cut
+                self.pair_args = None
+            elif pert:
                 print("Perturbed density on. Preparing perturbed density PNOs.")
                 # Hbar_ii  = f_ii + t_inef ( 2 * <in|ef> - <in|fe> ) 
                 Hbar_oo = self.F_occ.copy()
@@ -166,7 +217,8 @@ class HelperCCEnergy(object):
 
                 # Prepare the perturbation
                 A_list = {}
-                if pert == 'mu' or pert == 'mu+unpert':
+                A_list_2 = {}
+                if pert == 'mu' or pert == 'mu+unpert' or pert == 'mu+l+unpert':
                     ## Here, perturbation is dipole moment
                     dipole_array = self.mints.ao_dipole()
                     dirn = ['X','Y','Z']
@@ -178,19 +230,152 @@ class HelperCCEnergy(object):
                     dirn = ['X','Y','Z']
                     for i in range(3):
                         A_list[dirn[i]] = np.einsum('uj,vi,uv', self.C_arr, self.C_arr, np.asarray(angular_momentum[i]))
-                local.init_PNOs(pno_cut, self.t_ijab, self.F_vir, pert=pert, A_list=A_list, str_pair_list=str_pair_list, denom=self.denom_tuple)            
+                if pert == 'mu+l+unpert':
+                    # Second operator set, angular momentum
+                    angular_momentum = self.mints.ao_angular_momentum()
+                    dirn = ['X','Y','Z']
+                    for i in range(3):
+                        A_list_2[dirn[i]] = np.einsum('uj,vi,uv', self.C_arr, self.C_arr, np.asarray(angular_momentum[i]))
+                self.pair_args = dict(pert=pert, A_list=A_list, A_list_2=A_list_2, str_pair_list=str_pair_list, denom=self.denom_tuple, MO=self.MO, pno_target=pno_target, target_type=target_type, pair_adaptive=pair_adaptive, merge_cut=merge_cut, presp_cut=presp_cut, domain=domain, osv_cut=osv_cut)
             else:
-                local.init_PNOs(pno_cut, self.t_ijab, self.F_vir, str_pair_list=str_pair_list)            
+                self.pair_args = dict(str_pair_list=str_pair_list, MO=self.MO, pno_target=pno_target, target_type=target_type, pair_adaptive=pair_adaptive, merge_cut=merge_cut, domain=domain, osv_cut=osv_cut)
+            if domain != 'pao':
+                local.init_PNOs(pno_cut, self.t_ijab, self.F_vir, **self.pair_args)
+            # The MP2 amplitudes and settings are kept to rebuild the pair spaces, see rebuild_pair_spaces
+            self.t_mp2 = self.t_ijab
+            self.pno_cut = local.pno_cut
 
             self.pno_correct = local.PNO_correction(self.t_ijab, self.MO)
             print("PNO correction:\n{}".format(self.pno_correct))
             Ria = np.zeros((self.no_occ, self.no_vir))
             self.tia, self.t_ijab = local.increment(Ria, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.F_occ)
+            if lmp2:
+                # LMP2 in the PNO spaces seeds CCSD
+                self.t_ijab = self.do_LMP2(self.t_ijab, local=local)
             #new_tia, new_t_ijab = local.increment(Ria, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.F_occ)
             #print("The local filtered T2 matches original T2: {}".format(np.allclose(self.t_ijab, new_t_ijab)))
             #self.t_ijab = local.increment(Ria, self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], self.F_occ)
         print("MP2 energy here: {}".format(self.corr_energy(self.t_ia, self.t_ijab))) 
 
+    def rebuild_pair_spaces(self, local):
+        '''
+        Rebuild the pair spaces of local from the MP2 amplitudes, as in the constructor,
+        and project the current amplitudes onto them (e.g. at the next frequency of a
+        perturbed pair space calculation)
+
+        :param local: HelperLocal object whose pair spaces were built by this object
+        :type local: class 'ccsd_lpno.HelperLocal'
+        '''
+        if self.pair_args is None:
+            # PAO domains only depend on the orbitals and the geometry
+            return
+        local.init_PNOs(self.pno_cut, self.t_mp2, self.F_vir, **self.pair_args)
+        self.pno_cut = local.pno_cut
+        self.pno_correct = local.PNO_correction(self.t_mp2, self.MO)
+        print("PNO correction:\n{}".format(self.pno_correct))
+        self.t_ia, self.t_ijab = local.project_amplitudes(self.t_ia, self.t_ijab)
+
+    def truncate_virtuals(self, fvno, fvno_cut):
+        '''
+        Frozen virtual natural orbital truncation, the MO integrals, Fock matrix and
+        MO coefficients are transformed to the kept, semicanonical FVNOs
+
+        :param fvno: 'fvno' for the MP2 density, 'fvno++' for the averaged perturbed (dipole) density
+        :type fvno: string
+        :param fvno_cut: Occupation number cutoff for truncating FVNOs
+        :type fvno_cut: double
+        '''
+        o = self.no_occ
+        F_occ = self.F[:o, :o]
+        F_vir = self.F[o:, o:]
+        d_ia = np.diag(F_occ).reshape(-1, 1) - np.diag(F_vir)
+        d_ijab = np.diag(F_occ).reshape(-1, 1, 1, 1) + np.diag(F_occ).reshape(-1, 1, 1) - np.diag(F_vir).reshape(-1, 1) - np.diag(F_vir)
+        t_ijab = self.MO[:o, :o, o:, o:] / d_ijab
+
+        fvno_helper = HelperLocal(o, self.no_vir)
+        if fvno == 'fvno++':
+            # Guess X's with MP2 denominators, one per dipole component
+            dipole_array = self.mints.ao_dipole()
+            A_stack = np.asarray([np.einsum('uj,vi,uv', self.C_arr, self.C_arr, np.asarray(dipole_array[i]))[self.no_fz:, self.no_fz:] for i in range(3)])
+            Abar, X_guess = fvno_helper.pert_guess(t_ijab, A_stack, d_ijab)
+            D_vir = fvno_helper.form_vir_density(X_guess, weights=np.full(3, 1.0 / 3.0), x_ia=A_stack[:, :o, o:] / d_ia)
+        else:
+            D_vir = fvno_helper.form_vir_density(t_ijab)
+        occ_nos, V = fvno_helper.build_FVNOs(fvno_cut, D_vir, F_vir)
+
+        # U = 1 (occupied) + V (virtual)
+        U = np.zeros((o + self.no_vir, o + V.shape[1]))
+        U[:o, :o] = np.eye(o)
+        U[o:, o:] = V
+        self.MO = contract('pqrs,pP,qQ,rR,sS->PQRS', self.MO, U, U, U, U)
+        self.F = contract('pP,pq,qQ->PQ', U, self.F, U)
+        C_arr = np.asarray(self.C_arr)
+        self.C_arr = psi4.core.Matrix.from_array(np.hstack((C_arr[:, :(self.no_fz + o)], np.dot(C_arr[:, (self.no_fz + o):], V))))
+        self.no_vir = V.shape[1]
+        self.no_mo = self.no_fz + o + self.no_vir
+        self.fvno_occ = occ_nos
+
+    def lmp2_residual(self, t_ijab):
+        '''
+        LMP2 residual for non-canonical occupied orbitals
+
+        R_ij = K_ij + F_vir T_ij + T_ij F_vir - sum_k (F_ik T_kj + F_kj T_ik)
+
+        :param t_ijab: Current MP2 doubles
+        :type t_ijab: numpy array
+
+        :return: LMP2 residual
+        :rtype: numpy array
+        '''
+        Rijab = self.MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:].copy()
+        Rijab += contract('ac,ijcb->ijab', self.F_vir, t_ijab)
+        Rijab += contract('ijac,cb->ijab', t_ijab, self.F_vir)
+        Rijab -= contract('ik,kjab->ijab', self.F_occ, t_ijab)
+        Rijab -= contract('ikab,kj->ijab', t_ijab, self.F_occ)
+        return Rijab
+
+    def do_LMP2(self, t_ijab, local=None, r_conv=1e-8, maxiter=50, max_diis=8):
+        '''
+        Iterative LMP2 with the off-diagonal occupied Fock coupling, in the full
+        virtual space or, with local, in the PNO spaces
+
+        :param t_ijab: Guess MP2 doubles
+        :type t_ijab: numpy array
+        :param local: Object containing the increment function for local correlation calculations
+        :type local: class 'ccsd_lpno.HelperLocal'
+        :param r_conv: Convergence threshold for the norm of the doubles update
+        :type r_conv: double
+        :param maxiter: Maximum no. of iterations
+        :type maxiter: integer
+        :param max_diis: Maximum no. of error vectors stored for DIIS
+        :type max_diis: integer
+
+        :return: Converged LMP2 doubles
+        :rtype: numpy array
+        '''
+        # LMP2 has no singles, HelperDIIS and local.increment take them anyway: the zero
+        # singles and residual passed here add nothing to the DIIS error vectors and the
+        # returned singles are discarded
+        zero_ia = np.zeros((self.no_occ, self.no_vir))
+        diis = HelperDIIS(zero_ia, t_ijab, max_diis)
+        print('Iteration\t\t LMP2 energy\t\tNorm')
+        for i in range(maxiter):
+            Rijab = self.lmp2_residual(t_ijab)
+            if local:
+                _, inc2 = local.increment(zero_ia, Rijab, self.F_occ)
+                new_tijab = t_ijab + inc2
+            else:
+                new_tijab = t_ijab + Rijab / self.d_ijab
+            norm = np.linalg.norm(new_tijab - t_ijab)
+            print('LMP2 Iteration: {:3d}\t {:2.12f}\t{:1.12f}'.format(i, self.corr_energy(zero_ia, new_tijab), norm))
+            if norm < r_conv:
+                t_ijab = new_tijab
+                break
+            diis.update_err_list(zero_ia, new_tijab)
+            _, t_ijab = diis.extrapolate(zero_ia, new_tijab)
+        print("LMP2 energy: {}".format(self.corr_energy(zero_ia, t_ijab)))
+        return t_ijab
+
     # Make intermediates, Staunton:1991 eqns 3-11
     # Spin-adapted, every TEI term is modified to include
     # antisymmetrized term
@@ -371,7 +556,7 @@ class HelperCCEnergy(object):
 
         # Update T2s
         if local:
-            inc1, inc2 = local.increment(Ria, Rijab, self.F_occ)
+            inc1, inc2 = local.increment(Ria, Rijab, self.F_occ, freeze=True)
             #inc2 = local.increment(Ria, Rijab, self.F_occ)
             #new_tia += Ria / self.d_ia
             new_tia += inc1
@@ -408,7 +593,7 @@ class HelperCCEnergy(object):
         #print("Doubles contribution: {}".format(doubles_val))
         return E_corr
 
-    def do_CC(self, local=None, e_conv=1e-8, r_conv=1e-7, maxiter=40, max_diis=8, start_diis=0):
+    def do_CC(self, local=None, e_conv=1e-8, r_conv=1e-7, maxiter=40, max_diis=8, start_diis=0, loose_cut=None, switch_conv=1e-4, freeze_conv=None, recheck=5):
         '''
         Do CCSD iterations with DIIS and local options
 
@@ -424,10 +609,32 @@ class HelperCCEnergy(object):
         :type max_diis: integer
         :param start_diis: Which iteration to start storing error vectors for DIIS
         :type start_diis: integer
+        :param loose_cut: If given, PNO cutoff for the first iterations, before switching to PNOs of the corrected CCSD amplitudes with the final cutoff (unperturbed PNOs only)
+        :type loose_cut: double
+        :param switch_conv: RMS below which the loose PNO spaces are replaced by the final ones
+        :type switch_conv: double
+        :param freeze_conv: If given, pairs whose increment norm and pair energy change are below freeze_conv are frozen (local only)
+        :type freeze_conv: double
+        :param recheck: Every recheck-th iteration all pairs are updated and drifting pairs unfrozen
+        :type recheck: integer
 
         :return: Converged pseudoenergy
         :rtype: double
         '''
+        schedule = False
+        switch = False
+        if loose_cut is not None:
+            if local is None or local.domain != 'pno' or local.pert:
+                raise ValueError("The PNO schedule (loose_cut) needs unperturbed PNO pair spaces (domain='pno', no pert).")
+            schedule = True
+            final_cut = local.pno_cut
+            print("PNO schedule on. Loose PNO cutoff: {}, final PNO cutoff: {} from RMS < {}".format(loose_cut, final_cut, switch_conv))
+            local.set_PNO_cut(loose_cut, self.F_vir)
+            self.t_ia, self.t_ijab = local.project_amplitudes(self.t_ia, self.t_ijab)
+
+        if local:
+            local.init_freeze(freeze_conv, recheck)
+
         self.old_e = self.corr_energy(self.t_ia, self.t_ijab)
         print('Iteration\t\t Correlation energy\tDifference\tRMS\nMP2\t\t\t {}'.format(self.old_e))
     # Set up DIIS
@@ -436,23 +643,52 @@ class HelperCCEnergy(object):
         new_e = self.old_e
     # Iterate until convergence
         for i in range(maxiter):
+            if switch:
+                # The loose amplitudes plus a first-order (LMP2 residual) correction in the full
+                # virtual space give the pair densities of the final PNOs, the correction puts
+                # weight outside the loose spaces at MP2 cost; the amplitudes are projected onto
+                # the new spaces and DIIS restarts there
+                print("Switching to PNO cutoff {} with PNOs from the current amplitudes.".format(final_cut))
+                new_tijab = self.t_ijab + self.lmp2_residual(self.t_ijab) / self.d_ijab
+                local.rebuild_PNOs(final_cut, new_tijab, self.F_vir)
+                # The MP2 PNO correction no longer describes these spaces
+                self.pno_correct = local.PNO_correction(new_tijab, self.MO)
+                print("PNO correction (switched PNOs):\n{}".format(self.pno_correct))
+                self.t_ia, self.t_ijab = local.project_amplitudes(self.t_ia, new_tijab)
+                diis = HelperDIIS(self.t_ia, self.t_ijab, max_diis)
+                local.init_freeze(freeze_conv, recheck)
+                self.old_e = self.corr_energy(self.t_ia, self.t_ijab)
+                print('CC Iteration: {:3d}\t {:2.12f}\tPNO switch'.format(i, self.old_e))
+                switch = False
+                schedule = False
+                continue
             tau_t = self.make_taut(self.t_ia, self.t_ijab)
             tau = self.make_tau(self.t_ia, self.t_ijab)
             new_tia, new_tijab = self.update_ts(tau, tau_t, self.t_ia, self.t_ijab, local=local)
             new_e = self.corr_energy(new_tia, new_tijab)
             rms = np.linalg.norm(new_tia - self.t_ia)
             rms += np.linalg.norm(new_tijab - self.t_ijab)
-            print('CC Iteration: {:3d}\t {:2.12f}\t{:1.12f}\t{:1.12f}\tDIIS Size: {}'.format(i, new_e, abs(new_e - self.old_e), rms, diis.diis_size))
-            if(abs(new_e - self.old_e) < e_conv and abs(rms) < r_conv):
-                print('Convergence reached.\n CCSD Correlation energy: {}\n'.format(new_e))
-                self.t_ia = new_tia
-                self.t_ijab = new_tijab
-                break
+            frozen = ''
+            if local and local.freeze_conv is not None:
+                frozen = local.update_freeze(local.pair_energies(self.make_tau(new_tia, new_tijab), self.MO))
+            print('CC Iteration: {:3d}\t {:2.12f}\t{:1.12f}\t{:1.12f}\tDIIS Size: {}{}'.format(i, new_e, abs(new_e - self.old_e), rms, diis.diis_size, frozen))
+            if schedule and rms < switch_conv:
+                switch = True
+            if(not schedule and abs(new_e - self.old_e) < e_conv and abs(rms) < r_conv):
+                if local and local.thaw_pairs():
+                    print('Unfreezing all pairs before convergence.')
+                else:
+                    print('Convergence reached.\n CCSD Correlation energy: {}\n'.format(new_e))
+                    self.t_ia = new_tia
+                    self.t_ijab = new_tijab
+                    break
             # Update error vectors for DIIS
             diis.update_err_list(new_tia, new_tijab)
             # Extrapolate using DIIS
             if(i >= start_diis):
                 new_tia, new_tijab = diis.extrapolate(new_tia, new_tijab)
+            if local:
+                new_tijab = local.keep_frozen(self.t_ijab, new_tijab)
 
             self.t_ia = new_tia
             self.t_ijab = new_tijab
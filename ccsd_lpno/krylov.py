@@ -0,0 +1,68 @@
+'''
+Preconditioned GMRES
+For solving the linear response equations with matrix-free Hbar products
+'''
+
+import numpy as np
+
+def gmres(matvec, precond, b, x, r_conv=1e-7, maxiter=100, restart=20, callback=None):
+    '''
+    Restarted GMRES for A x = b, left-preconditioned with M: minimizes |M (b - A x)|
+
+    Convergence is tested on the preconditioned residual M (b - A x). If M projects
+    onto a subspace (local pair spaces), only the part of the residual inside it is
+    measured, the same measure as the increments of the Jacobi iterations.
+
+    :param matvec: Function returning A v for a flat vector v
+    :param precond: Function returning M r for a flat vector r
+    :param b: Right-hand side
+    :type b: numpy array
+    :param x: Starting guess
+    :type x: numpy array
+    :param r_conv: Convergence threshold on the norm of the preconditioned residual
+    :param maxiter: Maximum number of products with A
+    :param restart: Size of the Krylov subspace before restarting
+    :param callback: Called as callback(niter, norm) with the preconditioned residual norm at every restart
+
+    :returns: solution x, whether it converged
+    '''
+    niter = 0
+    while niter < maxiter:
+        # Preconditioned residual of the current solution starts the subspace
+        r = precond(b - matvec(x))
+        niter += 1
+        beta = np.linalg.norm(r)
+        if callback is not None:
+            callback(niter, beta)
+        if beta < r_conv:
+            return x, True
+
+        V = [r / beta]
+        H = np.zeros((restart + 1, restart))
+        for k in range(restart):
+            w = precond(matvec(V[k]))
+            niter += 1
+            # Modified Gram-Schmidt
+            for j in range(k + 1):
+                H[j, k] = np.dot(w, V[j])
+                w -= H[j, k] * V[j]
+            H[k + 1, k] = np.linalg.norm(w)
+
+            # Small least-squares problem in the subspace
+            e1 = np.zeros(k + 2)
+            e1[0] = beta
+            y = np.linalg.lstsq(H[:k + 2, :k + 1], e1, rcond=None)[0]
+            res = np.linalg.norm(e1 - np.dot(H[:k + 2, :k + 1], y))
+            if res < r_conv or H[k + 1, k] < 1e-14 or niter >= maxiter:
+                break
+            V.append(w / H[k + 1, k])
+
+        for j in range(len(y)):
+            x = x + y[j] * V[j]
+
+    # The last update is only accepted once its residual has been formed
+    r = precond(b - matvec(x))
+    beta = np.linalg.norm(r)
+    if callback is not None:
+        callback(niter + 1, beta)
+    return x, beta < r_conv
@@ -14,27 +14,144 @@ from .cc_hbar import *
 from .cc_lambda import *
 from .cc_pert import *
 from .local import *
+from .store import HelperStore
 from psi4 import constants as pc 
 
-# Bring in wfn from psi4
-def do_linresp(wfn, omega_nm, mol, return_en=False, method='polar', gauge='length', e_conv=1e-10, r_conv=1e-10, localize=False, pert=None, pno_cut=0, e_cut=0): 
-    
-    # Create Helper_local object
-    if localize:
-        no_vir = wfn.nmo() - wfn.doccpi()[0] - wfn.frzcpi()[0]
-        local = HelperLocal(wfn.doccpi()[0], no_vir)
-    else:
-        local=None
-
-    # Set the frequency in hartrees
+def nm_to_hartree(omega_nm):
+    # Frequency in hartrees from a wavelength in nm
     if omega_nm == 0:
-        omega = 0.0
+        return 0.0
+    return (pc.c * pc.h * 1e9) / (pc.hartree2J * omega_nm)
+
+def make_pert(perts, key, hcc, hbar, lda, A, omega, local=None):
+    # HelperPert for operator key, reusing (and moving to omega) the one kept in perts if there is one
+    if key in perts:
+        if perts[key].omega != omega:
+            perts[key].set_omega(omega)
     else:
-        omega = (pc.c * pc.h * 1e9) / (pc.hartree2J * omega_nm)
-
-    # Create Helper_CCenergy object
-    hcc = HelperCCEnergy(wfn, local=local, pert=pert, pno_cut=pno_cut, e_cut=e_cut, omega=omega) 
-    ccsd_e = hcc.do_CC(local=local, e_conv=e_conv, r_conv=r_conv, maxiter=40, start_diis=0)
+        perts[key] = HelperPert(hcc, hbar, lda, A, omega, local=local)
+    return perts[key]
+
+def negative_pert(perts, key, pert, hcc, hbar, lda, local=None):
+    # The operator of pert at -omega, needed by the Y-free response functions
+    if pert.omega == 0.0:
+        return pert
+    return make_pert(perts, (key[0] + '(-omega)', key[1]), hcc, hbar, lda, pert.A, -pert.omega, local=local)
+
+def solve_perts(perts, local=None, r_conv=1e-7, freeze_conv=None, batch=False, solver='jacobi', negs=None):
+    # Solve the right- and left-hand response equations of HelperPert objects sharing a frequency,
+    # one at a time or stacked together in a HelperPertBatch
+    # With negs (the same operators at -omega) only right-hand equations are solved, for the Y-free response functions
+    # Equations already solved (and converged) at this frequency (pert.solved) are skipped
+    if batch and solver != 'jacobi':
+        print('The batched response solver uses Jacobi iterations, solver={} is ignored.'.format(solver))
+    hands = ['right', 'left']
+    groups = [perts]
+    if negs is not None:
+        hands = ['right']
+        groups.append([neg for neg in negs if neg not in perts])
+    for group in groups:
+        for hand in hands:
+            todo = [pert for pert in group if hand not in pert.solved]
+            if len(todo) == 0:
+                continue
+            if batch:
+                if freeze_conv is not None:
+                    print('Pair freezing is not used by the batched response solver.')
+                pseudoresponse, converged = HelperPertBatch(todo).iterate(hand, r_conv=r_conv, local=local)
+            else:
+                for pert in todo:
+                    pseudoresponse = pert.iterate(hand, r_conv=r_conv, local=local, freeze_conv=freeze_conv, solver=solver)
+            # Unconverged equations are solved again when next needed
+            for pert in todo:
+                if pert.converged:
+                    pert.solved.add(hand)
+    if negs is not None:
+        # [eta^A + F X(A)] replaces the left-hand solution in the response functions
+        for pert in perts:
+            if 'inhomogeneous' not in pert.solved:
+                pert.inhmy_ia, pert.inhmy_ijab = pert.inhomogeneous_ys(pert.x_ia, pert.x_ijab)
+                pert.solved.add('inhomogeneous')
+
+def mo_operator(ops, name, hcc):
+    # MO matrices of the X, Y and Z components of operator name ('mu', 'p' or 'L'),
+    # the AO integrals are fetched and transformed once per run and kept in ops
+    if name not in ops:
+        scale = 1.0
+        if name == 'mu':
+            ao_ints = hcc.mints.ao_dipole()
+        elif name == 'p':
+            ao_ints = hcc.mints.ao_nabla()
+        else:
+            ao_ints = hcc.mints.ao_angular_momentum()
+            scale = -0.5
+        ops[name] = [scale * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(ao_ints[i])) for i in range(3)]
+    return ops[name]
+
+def solve_operators(perts, ops, names, hcc, hbar, lda, omega, local=None, r_conv=1e-10, freeze_conv=None, batch=False, solver='jacobi', asym=False, static=False):
+    # Solved HelperPert objects for the X, Y and Z components of the operators in names at omega,
+    # and with asym the same operators at -omega, as dicts name -> component -> HelperPert
+    # The solutions are kept in perts, keyed by operator and component ('0' added to the operator if static),
+    # so an operator shared by two gauges is solved once
+    hpert = {}
+    hneg = {}
+    for name in names:
+        key_name = name + '0' if static else name
+        hpert[name] = {}
+        hneg[name] = {}
+        for i, string in enumerate(['X', 'Y', 'Z']):
+            hpert[name][string] = make_pert(perts, (key_name, string), hcc, hbar, lda, mo_operator(ops, name, hcc)[i], omega, local=local)
+            # Y-free response functions use the X of each operator at -omega instead of the Ys
+            if asym:
+                hneg[name][string] = negative_pert(perts, (key_name, string), hpert[name][string], hcc, hbar, lda, local=local)
+
+    solve_perts([hpert[name][string] for string in ['X', 'Y', 'Z'] for name in names], local=local, r_conv=r_conv, freeze_conv=freeze_conv, batch=batch, solver=solver, negs=[hneg[name][string] for string in ['X', 'Y', 'Z'] for name in names] if asym else None)
+    return hpert, hneg
+
+def rosenfeld_trace(lda, pert1, pert2, neg1, neg2, sign, components='full'):
+    # Isotropic part of the Rosenfeld tensor, 1/2 (<<A;L>> + sign * <<L;A>>)
+    # With components='diag' or 'trace' only the diagonal or trace of the tensors is computed
+    strings = ['X', 'Y', 'Z']
+    beta = HelperRespTensor(lda, [pert1[s] for s in strings], [pert2[s] for s in strings]).linear_resp([neg1[s] for s in strings] if neg1 else None, components=components)
+    betap = HelperRespTensor(lda, [pert2[s] for s in strings], [pert1[s] for s in strings]).linear_resp([neg2[s] for s in strings] if neg2 else None, components=components)
+    if components == 'full':
+        betap = betap.T
+    beta_new = 0.5 * (beta + sign * betap)
+
+    if components == 'full':
+        print('Rosenfeld tensor:')
+        for n1, string1 in enumerate(strings):
+            for n2, string2 in enumerate(strings):
+                print(' {} {} : {}'.format(string1, string2, beta_new[n1, n2]))
+        trace = np.trace(beta_new)
+    elif components == 'diag':
+        print('Rosenfeld tensor, diagonal:')
+        for n, string in enumerate(strings):
+            print(' {} {} : {}'.format(string, string, beta_new[n]))
+        trace = np.sum(beta_new)
+    else:
+        trace = beta_new
+    trace /= 3.0
+    return trace
+
+def make_store(store, wfn, settings, omega, pert=None):
+    # HelperStore for the ground state of a job, None without a store path
+    # Perturbed pair spaces, and with them the ground state, depend on the frequency
+    if store is None:
+        return None
+    if pert:
+        settings = dict(settings, omega=omega)
+    return HelperStore(store, wfn, settings)
+
+def solve_ground_state(hcc, local=None, hstore=None, e_conv=1e-10, r_conv=1e-10, loose_cut=None, switch_conv=1e-4, freeze_conv=None, l_guess=None):
+    # CCSD, Hbar and Lambda, loaded from hstore if it holds them and saved to it otherwise
+    # CCSD starts from the amplitudes in hcc, Lambda from l_guess (l_ia, l_ijab) if given
+    if hstore is not None and hstore.exists():
+        ccsd_e, pseudo_e, hbar, lda = hstore.load(hcc, local=local)
+        print('CCSD correlation energy: {}'.format(ccsd_e))
+        return ccsd_e, hbar, lda
+
+    ccsd_e = hcc.do_CC(local=local, e_conv=e_conv, r_conv=r_conv, maxiter=40, start_diis=0, loose_cut=loose_cut, switch_conv=switch_conv, freeze_conv=freeze_conv)
 
     print('CCSD correlation energy: {}'.format(ccsd_e))
     # Create HelperCCHbar object
@@ -42,45 +159,111 @@ def do_linresp(wfn, omega_nm, mol, return_en=False, method='polar', gauge='lengt
 
     # Create HelperLamdba object
     lda = HelperLambda(hcc, hbar)
-    pseudo_e = lda.iterate(local=local, e_conv=e_conv, r_conv =r_conv, maxiter=30)
+    if l_guess is not None:
+        lda.l_ia, lda.l_ijab = l_guess
+    pseudo_e = lda.iterate(local=local, e_conv=e_conv, r_conv =r_conv, maxiter=30, freeze_conv=freeze_conv)
+
+    if hstore is not None:
+        hstore.save(hcc, hbar, lda, ccsd_e, pseudo_e, local=local)
+    return ccsd_e, hbar, lda
+
+def project_perts(perts, hcc, hbar, lda, local):
+    # HelperPert objects on a new ground state, starting from the X and Y of perts
+    # projected onto the current pair spaces
+    new_perts = {}
+    for key, pert in perts.items():
+        new_perts[key] = HelperPert(hcc, hbar, lda, pert.A, pert.omega, local=local)
+        new_perts[key].x_ia, new_perts[key].x_ijab = local.project_amplitudes(pert.x_ia, pert.x_ijab)
+        new_perts[key].y_ia, new_perts[key].y_ijab = local.project_amplitudes(pert.y_ia, pert.y_ijab)
+    return new_perts
+
+# Bring in wfn from psi4
+def do_linresp(wfn, omega_nm, mol, return_en=False, method='polar', gauge='length', e_conv=1e-10, r_conv=1e-10, localize=False, pert=None, pno_cut=0, e_cut=0, pno_target=None, target_type='energy', pair_adaptive=False, merge_cut=1e-6, presp_cut=None, domain='pno', osv_cut=None, bp_cut=0.98, pao_dist=None, fvno=None, fvno_cut=0, lmp2=False, loose_cut=None, switch_conv=1e-4, freeze_conv=None, store=None, batch=False, solver='jacobi', asym=False, components='full'): 
+    
+    # Create Helper_local object
+    if localize:
+        no_vir = wfn.nmo() - wfn.doccpi()[0] - wfn.frzcpi()[0]
+        local = HelperLocal(wfn.doccpi()[0], no_vir)
+    else:
+        local=None
+
+    # Set the frequency in hartrees, the frequencies are solved in increasing order
+    omega_list = [nm_to_hartree(nm) for nm in np.atleast_1d(omega_nm)]
+    order = np.argsort(omega_list)
+    omega = omega_list[order[0]]
+
+    # Reuse the CCSD, Hbar and Lambda of an earlier job with the same molecule and settings
+    settings = {'localize': localize, 'pert': pert, 'pno_cut': pno_cut, 'e_cut': e_cut, 'pno_target': pno_target, 'target_type': target_type, 'pair_adaptive': pair_adaptive, 'merge_cut': merge_cut, 'presp_cut': presp_cut, 'domain': domain, 'osv_cut': osv_cut, 'bp_cut': bp_cut, 'pao_dist': pao_dist, 'fvno': fvno, 'fvno_cut': fvno_cut, 'lmp2': lmp2, 'loose_cut': loose_cut, 'switch_conv': switch_conv, 'freeze_conv': freeze_conv, 'e_conv': e_conv, 'r_conv': r_conv}
+    hstore = make_store(store, wfn, settings, omega, pert=pert)
+    stored = hstore is not None and hstore.exists()
+
+    # Perturbed pair spaces, and with them the ground state, are rebuilt at each frequency
+    # from the MP2 data kept by hcc, the integrals are built once
+    rebuild = bool(pert) and local is not None and len(omega_list) > 1
+
+    # Create Helper_CCenergy object, the pair spaces of a stored calculation are loaded instead of rebuilt
+    hcc = HelperCCEnergy(wfn, local=local, pert=pert, pno_cut=pno_cut, e_cut=e_cut, omega=omega, pno_target=pno_target, target_type=target_type, pair_adaptive=pair_adaptive, merge_cut=merge_cut, presp_cut=presp_cut, domain=domain, osv_cut=osv_cut, bp_cut=bp_cut, pao_dist=pao_dist, fvno=fvno, fvno_cut=fvno_cut, lmp2=lmp2, init_pairs=rebuild or not stored)
+    ccsd_e, hbar, lda = solve_ground_state(hcc, local=local, hstore=hstore, e_conv=e_conv, r_conv=r_conv, loose_cut=loose_cut, switch_conv=switch_conv, freeze_conv=freeze_conv)
+
+    # Each frequency starts from the response amplitudes of the previous one
+    # Response solutions and operator integrals are kept for the whole run
+    perts = {}
+    ops = {}
+    result = [None] * len(omega_list)
+    for k, n in enumerate(order):
+        if rebuild and k > 0:
+            # The CCSD, Lambda and response amplitudes of the previous frequency,
+            # projected onto the new pair spaces, are the starting guesses
+            hbar.release()
+            hcc.rebuild_pair_spaces(local)
+            l_guess = local.project_amplitudes(lda.l_ia, lda.l_ijab)
+            hstore = make_store(store, wfn, settings, omega_list[n], pert=pert)
+            ccsd_e, hbar, lda = solve_ground_state(hcc, local=local, hstore=hstore, e_conv=e_conv, r_conv=r_conv, freeze_conv=freeze_conv, l_guess=l_guess)
+            perts = project_perts(perts, hcc, hbar, lda, local)
+        result[n] = linresp_omega(hcc, hbar, lda, ccsd_e, omega_list[n], mol, return_en=return_en, method=method, gauge=gauge, r_conv=r_conv, local=local, freeze_conv=freeze_conv, batch=batch, solver=solver, asym=asym, components=components, perts=perts, ops=ops)
+    if np.ndim(omega_nm) == 0:
+        result = result[0]
 
+    if localize:
+        # Hbar elements are not needed once the responses are computed
+        hbar.report()
+        hbar.release()
+
+    return result
+
+def linresp_omega(hcc, hbar, lda, ccsd_e, omega, mol, return_en=False, method='polar', gauge='length', r_conv=1e-10, local=None, freeze_conv=None, batch=False, solver='jacobi', asym=False, components='full', perts=None, ops=None):
+    # Response functions at one frequency (in hartrees) from a converged ground state,
+    # perts holds the HelperPert objects of earlier solves, reused if at the same frequency
+    # and used as starting guesses otherwise, ops the MO operator matrices
+    if perts is None:
+        perts = {}
+    if ops is None:
+        ops = {}
     if method=='polar':
-        # Get the perturbation A for Xs and Ys
-        dipole_array = hcc.mints.ao_dipole()
-
-        # Create HelperPert object and solve for xs and ys
-        Mu = {}
-        hpert = {}
-        hresp = {}
-        polar = {}
-
-        i=0
-        for string in ['X', 'Y', 'Z']:
-            Mu[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(dipole_array[i]))
-            hpert[string] = HelperPert(hcc, hbar, lda, Mu[string], omega, local=local)
-
-            i += 1
-            for hand in ['right', 'left']:
-                pseudoresponse = hpert[string].iterate(hand, r_conv=r_conv, local=local)
-
-        for string in ['X', 'Y', 'Z']:
-            for string2 in ['X', 'Y', 'Z']:
-                hresp[string+string2] = HelperResp(lda, hpert[string], hpert[string2])
-                polar[string+string2] = hresp[string+string2].linear_resp()
-            
-        print('Polarizability tensor:')
-        for string in ['X', 'Y', 'Z']:
-            for string2 in ['X', 'Y', 'Z']:
-                if string != string2:
-                    polar[string+string2+'_new'] = 0.5 * (polar[string+string2] + polar[string2+string])
-                else:
-                    polar[string+string2+'_new'] = polar[string+string2]
-                print("{} {}: {}\n".format(string, string2, polar[string+string2+'_new']))
-
-        trace = polar['XX'] + polar['YY'] + polar['ZZ']
+        # Create HelperPert objects and solve for xs and ys
+        hpert, hneg = solve_operators(perts, ops, ['mu'], hcc, hbar, lda, omega, local=local, r_conv=r_conv, freeze_conv=freeze_conv, batch=batch, solver=solver, asym=asym)
+        hpert = hpert['mu']
+        hneg = hneg['mu']
+        strings = ['X', 'Y', 'Z']
+        polar = HelperRespTensor(lda, [hpert[s] for s in strings], [hpert[s] for s in strings]).linear_resp([hneg[s] for s in strings] if hneg else None, components=components)
+
+        if components == 'full':
+            print('Polarizability tensor:')
+            polar_new = 0.5 * (polar + polar.T)
+            for n, string in enumerate(strings):
+                for n2, string2 in enumerate(strings):
+                    print("{} {}: {}\n".format(string, string2, polar_new[n, n2]))
+            trace = np.trace(polar)
+        elif components == 'diag':
+            print('Polarizability tensor, diagonal:')
+            for n, string in enumerate(strings):
+                print("{} {}: {}\n".format(string, string, polar[n]))
+            trace = np.sum(polar)
+        else:
+            trace = polar
         isotropic_polar = trace / 3.0
 
-        new_x_y = np.reshape(hresp['YY'].x_ijab, (hcc.no_occ*hcc.no_occ, hcc.no_vir, hcc.no_vir))
+        new_x_y = np.reshape(hpert['Y'].x_ijab, (hcc.no_occ*hcc.no_occ, hcc.no_vir, hcc.no_vir))
         
         '''
         # This code block saves amplitudes in order to look at sparsity of the different methods
@@ -116,365 +299,54 @@ def do_linresp(wfn, omega_nm, mol, return_en=False, method='polar', gauge='lengt
         else:
             return isotropic_polar
     elif method=='optrot':
-        if gauge=='both':
-
+        # Calculation of the specific rotation
+        Mass = 0
+        for atom in range(mol.natom()):
+            Mass += mol.mass(atom)
+        h_bar = pc.h / (2.0 * np.pi)
+        prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
+
+        if gauge in ['length', 'both']:
             ### Length gauge OR calculation
             ### Form of linear response function: <<mu;L>>
+            hpert, hneg = solve_operators(perts, ops, ['mu', 'L'], hcc, hbar, lda, omega, local=local, r_conv=r_conv, freeze_conv=freeze_conv, batch=batch, solver=solver, asym=asym)
+            trace = rosenfeld_trace(lda, hpert['mu'], hpert['L'], hneg['mu'], hneg['L'], -1.0, components=components)
 
-            # Get the perturbation mu
-            dipole_array = hcc.mints.ao_dipole()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            Mu = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                Mu[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(dipole_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, Mu[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] - betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
             # Have to multiply with omega for length gauge
             optrot_lg = prefactor * trace * omega
 
+        if gauge in ['velocity', 'both']:
             ### Velocity gauge OR calculation
             ### Form of linear response function: <<p;L>>
+            # With gauge='both' the L solutions are those of the length gauge
+            hpert, hneg = solve_operators(perts, ops, ['p', 'L'], hcc, hbar, lda, omega, local=local, r_conv=r_conv, freeze_conv=freeze_conv, batch=batch, solver=solver, asym=asym)
+            trace = rosenfeld_trace(lda, hpert['p'], hpert['L'], hneg['p'], hneg['L'], 1.0, components=components)
 
-            # Get the momentum P
-            p_array = hcc.mints.ao_nabla()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            P = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                P[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(p_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, P[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] + betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
             optrot_vg = prefactor * trace
             # So velocity gauge is / omega
 
             ### Modified velocity gauge OR calculation
             ### Form of linear response function: <<p;L>> - <<p;L>>_0
             ### Using the velocity gauge OR value and subtracting the static value
-            omega = 0.0
-
-            # Get the perturbation P
-            p_array = hcc.mints.ao_nabla()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            P = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                P[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(p_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, P[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] + betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
+            hpert, hneg = solve_operators(perts, ops, ['p', 'L'], hcc, hbar, lda, 0.0, local=local, r_conv=r_conv, freeze_conv=freeze_conv, batch=batch, solver=solver, asym=asym, static=True)
+            trace = rosenfeld_trace(lda, hpert['p'], hpert['L'], hneg['p'], hneg['L'], 1.0, components=components)
+
             optrot_diff = prefactor * trace
 
             optrot_mvg = optrot_vg - optrot_diff
-            
+
+        if gauge=='both':
             if return_en == True:
                 return ccsd_e, optrot_lg, optrot_mvg
             else:
                 return optrot_lg, optrot_mvg
-            
         elif gauge=='length':
-
-            ### Length gauge OR calculation
-            ### Form of linear response function: <<mu;L>>
-
-            # Get the perturbation mu
-            dipole_array = hcc.mints.ao_dipole()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            Mu = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                Mu[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(dipole_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, Mu[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] - betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
-            # Have to multiply with omega for length gauge
-            optrot_lg = prefactor * trace * omega
-            
             if return_en == True:
                 return ccsd_e, optrot_lg
             else:
                 return optrot_lg
-
         elif gauge=='velocity':
-            ### Velocity gauge OR calculation
-            ### Form of linear response function: <<p;L>>
-
-            # Get the perturbation P
-            p_array = hcc.mints.ao_nabla()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            P = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                P[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(p_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, P[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] + betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
-            optrot_vg = prefactor * trace
-            # So velocity gauge is / omega
-
-            ### Modified velocity gauge OR calculation
-            ### Form of linear response function: <<p;L>> - <<p;L>>_0
-            ### Using the velocity gauge OR value and subtracting the static value
-            omega = 0.0
-
-            # Get the perturbation P
-            p_array = hcc.mints.ao_nabla()
-
-            # Get the angular momentum L
-            angular_momentum = hcc.mints.ao_angular_momentum()
-
-            # Create HelperPert objects for both
-            P = {}
-            pert1 = {}
-            L = {}
-            pert2 = {}
-
-            # Rosenfeld tensor
-            beta = {}
-            betap = {}
-            beta_new = {}
-
-            i=0
-            for string in ['X', 'Y', 'Z']:
-                P[string] = np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(p_array[i]))
-                pert1[string] = HelperPert(hcc, hbar, lda, P[string], omega, local=local)
-                L[string] = -0.5 * np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(angular_momentum[i]))
-                pert2[string] = HelperPert(hcc, hbar, lda, L[string], omega, local=local)
-
-                i+=1
-                for hand in ['right', 'left']:
-                    pseudoresponse1 = pert1[string].iterate(hand, r_conv=r_conv, local=local)
-                for hand in ['right', 'left']:
-                    pseudoresponse2 = pert2[string].iterate(hand, r_conv=r_conv, local=local)
-
-            print('Rosenfeld tensor:')
-            for string1 in ['X', 'Y', 'Z']:
-                for string2 in ['X', 'Y', 'Z']:
-                    beta[string1+string2] = HelperResp(lda, pert1[string1], pert2[string2]).linear_resp()
-                    betap[string1+string2] = HelperResp(lda, pert2[string2], pert1[string1]).linear_resp()
-
-                    beta_new[string1+string2] = 0.5 * (beta[string1+string2] + betap[string1+string2])
-                    print(' {} {} : {}'.format(string1, string2, beta_new[string1+string2]))
-
-            trace = 0.0
-            for string in ['XX','YY','ZZ']:
-                trace += beta_new[string]
-            trace /= 3.0
-
-            # Calculation of the specific rotation
-            Mass = 0
-            for atom in range(mol.natom()):
-                Mass += mol.mass(atom)
-            h_bar = pc.h / (2.0 * np.pi)
-            prefactor = -72e6 * h_bar**2 * pc.na / (pc.c**2 * pc.me**2 * Mass)
-            optrot_diff = prefactor * trace
-
-            optrot_mvg = optrot_vg - optrot_diff
-
             if return_en == True:
                 return ccsd_e, optrot_mvg
             else:
                 return optrot_mvg
-
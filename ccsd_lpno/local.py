@@ -9,27 +9,77 @@ class HelperLocal(object):
         # init
         self.no_occ = no_occ
         self.no_vir = no_vir
+        self.Q_disc_list = None
+        # Pair domain engine: 'pno', 'osv', 'osv+pno' or 'pao'
+        self.domain = 'pno'
+        self.osv_cut = None
+        self.pert = None
+        self.pair_scale = None
+        self.init_freeze()
 
-    def form_density(self, t_ijab):
+    def form_density(self, t_ijab, weights=None):
+        # t_ijab may carry a leading axis of stacked amplitudes (e.g. one guess X
+        # per perturbation component), whose densities are summed with weights:
+        # weights of shape (N,) give one density, (n_sets, N) give one density per set
         # Create Tij and Ttij
-        T_ij = t_ijab.copy().reshape((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
-        #print('T matrix [0]:\n{}'.format(T_ij[0]))
-        Tt_ij = 2.0 * T_ij.copy() 
-        Tt_ij -= T_ij.swapaxes(1, 2)
-        #print("X here: {}".format(T_ij))
-        #print("Xt here: {}".format(Tt_ij))
-
-        # Form pair densities
-        D = np.zeros((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
-        for ij in range(self.no_occ * self.no_occ):
-            i = ij // self.no_occ
-            j = ij % self.no_occ
-            D[ij] = contract('ab,bc->ac', T_ij[ij], Tt_ij[ij].T) + contract('ab,bc->ac', T_ij[ij].T, Tt_ij[ij])
-            D[ij] *= 2.0 / (1.0 + int(i==j))
-            D[ij] += D[ij].T
-            D[ij] *= 0.5
+        T_ij = t_ijab.reshape((-1, self.no_occ * self.no_occ, self.no_vir, self.no_vir))
+        n_amps = T_ij.shape[0]
+        if weights is None:
+            W = np.ones((1, n_amps))
+        else:
+            W = np.reshape(weights, (-1, n_amps))
+        Tt_ij = 2.0 * T_ij - T_ij.swapaxes(2, 3)
+
+        # Form pair densities, D_ij = 2 / (1 + delta_ij) (T_ij Tt_ij^T + T_ij^T Tt_ij), symmetrized
+        D = contract('sN,Npab,Npcb->spac', W, T_ij, Tt_ij)
+        D += contract('sN,Npba,Npbc->spac', W, T_ij, Tt_ij)
+        D *= (2.0 / (1.0 + np.eye(self.no_occ))).reshape(1, -1, 1, 1)
+        D += D.swapaxes(2, 3).copy()
+        D *= 0.5
         #print("Density matrix [1,1]: {}".format(D[1]))
-        return D
+        if weights is not None and np.ndim(weights) == 2:
+            return D
+        return D[0]
+
+    def pert_guess(self, t_ijab, A_stack, denom_ijab):
+        # Build guess Abar and X's for all perturbation components at once
+        # Abar_ijab = P_ij^ab (t_ij^eb A_ae - t_mj^ab A_mi)
+        Abar = contract('ijeb,Nae->Nijab', t_ijab, A_stack[:, self.no_occ:, self.no_occ:])
+        Abar -= contract('mjab,Nmi->Nijab', t_ijab, A_stack[:, :self.no_occ, :self.no_occ])
+        Abar += Abar.transpose(0, 2, 1, 4, 3).copy()
+
+        # Build guess X's
+        # X_ijab = Abar_ijab / Hbar_ii + Hbar_jj - Hbar_aa _ Hbar_bb
+        X_guess = Abar / denom_ijab
+        return Abar, X_guess
+
+    def form_vir_density(self, t_ijab, weights=None, x_ia=None):
+        # Virtual (FVNO) density, D_ab = 2 sum_ij (2 t_ijac - t_ijca) t_ijbc
+        # Stacked amplitudes are summed with weights as in form_density, and the
+        # singles x_ia (FVNO++ guess X1's) add sum_i x_ia x_ib if given
+        T = t_ijab.reshape((-1, self.no_occ, self.no_occ, self.no_vir, self.no_vir))
+        if weights is None:
+            W = np.ones(T.shape[0])
+        else:
+            W = np.reshape(weights, (T.shape[0]))
+        Tt = 2.0 * T - T.swapaxes(3, 4)
+        D = 2.0 * contract('N,Nijac,Nijbc->ab', W, Tt, T)
+        if x_ia is not None:
+            X = x_ia.reshape((-1, self.no_occ, self.no_vir))
+            D += contract('N,Nia,Nib->ab', W, X, X)
+        return 0.5 * (D + D.T)
+
+    def build_FVNOs(self, fvno_cut, D_vir, F_vir):
+        # Truncate the virtual natural orbitals by occ no and semicanonicalize them,
+        # so the kept space is the same for all pairs
+        occ_nos, V = np.linalg.eigh(D_vir)
+        V = V[:, np.absolute(occ_nos) > fvno_cut]
+        F_no = contract('aA,ab,bB->AB', V, F_vir, V)
+        eps_no, L = np.linalg.eigh(F_no)
+        print("Tcut_FVNO : {}".format(fvno_cut))
+        print("No. of FVNOs kept: {} of {}".format(V.shape[1], self.no_vir))
+        print('FVNO occupation numbers:\n {}'.format(occ_nos))
+        return occ_nos, np.dot(V, L)
 
     def form_semicanonical(self, Q_list, F_vir):
         # Get semicanonical transforms
@@ -59,135 +109,573 @@ class HelperLocal(object):
             S_list.append(S_list1)
         return S_list
 
-    def build_PNO_lists(self, pno_cut, D, str_pair_list=None):
-        no_occ_pairs = np.sum(str_pair_list)
-        print("No. of strong pairs: {}".format(no_occ_pairs))
+    def diagonalize_densities(self, D, str_pair_list=None):
         # Diagonalize pair densities to get PNOs (Q) and occ_nos
-        self.occ_nos = np.zeros((self.no_occ * self.no_occ, self.no_vir))
-        self.Q = np.zeros((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
-        #print("Average density: {}".format(D[0]))
-        #print("numpy version: {}". format(np.__version__))
+        # The full (ascending) eigenpairs are kept so that any cutoff
+        # can later be applied by slicing off the leading columns
+        if str_pair_list is None:
+            str_pair_list = np.ones((self.no_occ, self.no_occ), dtype=bool)
+        occ_nos = np.zeros((self.no_occ * self.no_occ, self.no_vir))
+        Q = np.zeros((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
         for ij in range(self.no_occ * self.no_occ):
             i = ij // self.no_occ
             j = ij % self.no_occ
             if str_pair_list[i,j] == True:
-                self.occ_nos[ij], self.Q[ij] = np.linalg.eigh(D[ij])
+                occ_nos[ij], Q[ij] = np.linalg.eigh(D[ij])
+        return occ_nos, Q
 
-        #Q_full = np.load('Q_full.npy')
-        #print("The two Qs are the same: {}".format(np.allclose(Q_full, Q)))
+    def truncate_PNOs(self, pno_cut, occ_nos, Q):
         # Truncate each set of pnos by occ no
-        self.s_pairs = np.zeros(self.no_occ * self.no_occ)
+        # pno_cut is either one global cutoff or an array of per-pair cutoffs
+        # Returns the no. of surviving PNOs per pair and the sliced PNO list
+        survivors = np.absolute(occ_nos) > np.reshape(pno_cut, (-1, 1))
+        s_pairs = np.sum(survivors, axis=1)
         Q_list = []
-        # This list is for the thrown-away PNOs
-        avg = 0.0
-        sq_avg = 0.0
         for ij in range(self.no_occ * self.no_occ):
-            if (self.occ_nos[ij] < 0).any():
-                print("Warning! An occupation number is negative. Using absolute \
-                        values, please check if your input is correct.")
-            survivors = np.absolute(self.occ_nos[ij]) > pno_cut
-            if ij == 0:
-                print("Survivors[0]:\n{}".format(survivors))
-            for a in range(self.no_vir):
-                if survivors[a] == True:
-                    self.s_pairs[ij] += 1
-            avg += self.s_pairs[ij]
-            sq_avg += self.s_pairs[ij] * self.s_pairs[ij]
-            rm_pairs = self.no_vir - int(self.s_pairs[ij])
-            Q_list.append(self.Q[ij, :, rm_pairs:])
-            #if ij == 5:
-            #    print("Here's occ nums and Q: {}\n{}".format(self.occ_nos[ij], Q[ij]))
-            #    print("Here's occ nums and Q: {}\n{}".format(self.occ_nos[ij], Q[ij, :, rm_pairs:]))
-        
+            rm_pairs = self.no_vir - int(s_pairs[ij])
+            Q_list.append(Q[ij, :, rm_pairs:])
+        return s_pairs, Q_list
+
+    def discarded_PNOs(self, s_pairs, Q):
+        # The PNOs thrown away by the truncation, i.e. the leading columns of each Q
+        Q_disc_list = []
+        for ij in range(self.no_occ * self.no_occ):
+            rm_pairs = self.no_vir - int(s_pairs[ij])
+            Q_disc_list.append(Q[ij, :, :rm_pairs])
+        return Q_disc_list
+
+    def strong_pairs(self, str_pair_list=None):
+        # Flattened mask of strong pairs, all pairs are strong if no list is given
+        if str_pair_list is None:
+            return np.ones(self.no_occ * self.no_occ, dtype=bool)
+        return np.reshape(str_pair_list, (self.no_occ * self.no_occ)).astype(bool)
+
+    def PNO_stats(self, s_pairs):
+        # Average no. of PNOs per pair and ratio of T2 size to the canonical T2 size
+        avg = np.sum(s_pairs) / (self.no_occ * self.no_occ)
+        t2_ratio = np.sum(np.square(s_pairs)) / (self.no_occ * self.no_occ * self.no_vir * self.no_vir)
+        return avg, t2_ratio
+
+    def pair_cutoff_scale(self, pair_weights, str_pair_list=None):
+        # Per-pair scaling of the PNO cutoff from each pair's share of the total
+        # (MP2 pair energy, or MP2 pair pseudoresponse for PNO++ densities):
+        # cut_ij = pno_cut / (n_pairs * share_ij), so a pair with an average share
+        # keeps the global cutoff, dominant pairs get a tighter cutoff and keep more
+        # PNOs, marginal pairs get a looser one
+        w = np.absolute(np.reshape(pair_weights, (self.no_occ * self.no_occ)))
+        if str_pair_list is not None:
+            w = w * np.reshape(str_pair_list, (self.no_occ * self.no_occ))
+        if np.sum(w) == 0.0:
+            print("Warning! All pair weights are zero. Using a global cutoff.")
+            return None
+        n_pairs = np.count_nonzero(w)
+        share = np.maximum(w / np.sum(w), 1e-16)
+        return 1.0 / (n_pairs * share)
+
+    def pair_cutoffs(self, pno_cut, pair_scale, occ_nos, min_pnos=1):
+        # Per-pair cutoffs pno_cut * pair_scale, clamped below the min_pnos-th largest
+        # occupation number so that a pair with a tiny share is not truncated to nothing
+        # Pairs without nonzero occupation numbers (weak pairs) still keep none
+        kth = np.sort(occ_nos, axis=1)[:, -min_pnos]
+        return np.minimum(pno_cut * pair_scale, np.nextafter(kth, 0))
+
+    def build_PNO_lists(self, pno_cut, D, str_pair_list=None, pair_scale=None):
+        if self.domain != 'pno':
+            return self.build_OSV_domains(pno_cut, D, str_pair_list=str_pair_list, pair_scale=pair_scale)
+        no_occ_pairs = np.sum(str_pair_list)
+        print("No. of strong pairs: {}".format(no_occ_pairs))
+        self.str_pairs = self.strong_pairs(str_pair_list)
+        self.occ_nos, self.Q = self.diagonalize_densities(D, str_pair_list=str_pair_list)
+
+        if (self.occ_nos < 0).any():
+            print("Warning! An occupation number is negative. Using absolute \
+                    values, please check if your input is correct.")
+        if pair_scale is not None:
+            pair_cut = self.pair_cutoffs(pno_cut, pair_scale, np.absolute(self.occ_nos))
+            print("Pair-adaptive truncation on. Per-pair cutoffs:\n{}".format(pair_cut))
+            self.s_pairs, Q_list = self.truncate_PNOs(pair_cut, self.occ_nos, self.Q)
+        else:
+            self.s_pairs, Q_list = self.truncate_PNOs(pno_cut, self.occ_nos, self.Q)
+        self.Q_disc_list = self.discarded_PNOs(self.s_pairs, self.Q)
+        print("Survivors[0]:\n{}".format(self.s_pairs[0]))
+
+        avg, t2_ratio = self.PNO_stats(self.s_pairs)
         print("Tcut_PNO : {}".format(pno_cut))
-        print("Total no. of PNOs: {}".format(avg))
-        print("T2 ratio: {}".format(sq_avg/(self.no_occ * self.no_occ * self.no_vir * self.no_vir)))
-        avg = avg/(self.no_occ * self.no_occ)
+        print("Total no. of PNOs: {}".format(np.sum(self.s_pairs)))
+        print("T2 ratio: {}".format(t2_ratio))
         print('Occupation numbers [0]:\n {}'.format(self.occ_nos[0]))
         print("Numbers of surviving PNOs:\n{}".format(self.s_pairs))
         print('Average number of PNOs:\n{}'.format(avg))
 
         return Q_list
 
-    def pseudoresponse(self, z_ijab):
-        Avvoo = contract('ijeb,ae->abij', self.t_ijab, self.A[self.no_occ:, self.no_occ:])
-        Avvoo -= contract('mjab,mi->abij', self.t_ijab, self.A[:self.no_occ, :self.no_occ])
-        pertbar_ijab = Avvoo.swapaxes(0,2).swapaxes(1,3)
-        temp = pertbar_ijab + pertbar_ijab.swapaxes(0, 1).swapaxes(2, 3)
-        presp = 2.0 * contract('ijab,ijab->', z_ijab, temp)
-        presp -= contract('ijba,ijab->', z_ijab, temp)
+    def build_OSV_lists(self, osv_cut, D, str_pair_list=None, pno_cut=None, pair_scale=None, merge_cut=1e-6):
+        # Orbital-specific virtuals: only the diagonal pair densities D_ii are diagonalized
+        # The space of pair ij is the union of the OSVs of i and j, refined into
+        # PNOs of D_ij within that space if pno_cut is given
+        str_pairs = self.strong_pairs(str_pair_list)
+        diag = np.arange(self.no_occ) * (self.no_occ + 1)
+        osv_occ, Q_osv = np.linalg.eigh(D[diag])
+        n_osv = np.sum(np.absolute(osv_occ) > osv_cut, axis=1)
+        print("Tcut_OSV : {}".format(osv_cut))
+        print("Numbers of OSVs:\n{}".format(n_osv))
+
+        no_space = np.zeros((self.no_vir, 0))
+        Q_i = []
+        Q_j = []
+        for ij in range(self.no_occ * self.no_occ):
+            i = ij // self.no_occ
+            j = ij % self.no_occ
+            if str_pairs[ij]:
+                Q_i.append(Q_osv[i, :, self.no_vir - n_osv[i]:])
+                Q_j.append(Q_osv[j, :, self.no_vir - n_osv[j]:] if i != j else no_space)
+            else:
+                Q_i.append(no_space)
+                Q_j.append(no_space)
+        s_pairs, Q_list = self.merge_PNO_spaces([Q_i, Q_j], merge_cut=merge_cut)
+
+        if pno_cut is not None:
+            # Diagonalize each pair density in its (zero-padded) OSV pair space
+            # Padding directions get occupation -1 so they are never kept
+            U = self.stack_PNOs(Q_list)
+            D_osv = contract('paA,pab,pbB->pAB', U, D, U)
+            pad_ij, pad_A = np.nonzero(np.arange(U.shape[2]) >= s_pairs.reshape(-1, 1))
+            D_osv[pad_ij, pad_A, pad_A] = -1.0
+            occ_nos, V = np.linalg.eigh(D_osv)
+            if pair_scale is not None:
+                pno_cut = self.pair_cutoffs(pno_cut, pair_scale, occ_nos)
+            s_pairs = np.sum(occ_nos > np.reshape(pno_cut, (-1, 1)), axis=1)
+            Q_list = []
+            for ij in range(self.no_occ * self.no_occ):
+                Q_list.append(np.dot(U[ij], V[ij, :, U.shape[2] - s_pairs[ij]:]))
+        return s_pairs, Q_list
+
+    def build_OSV_domains(self, pno_cut, D, str_pair_list=None, pair_scale=None):
+        # OSV counterpart of build_PNO_lists
+        # 'osv': pair spaces are unions of OSVs with occ. no. above osv_cut (pno_cut if not set)
+        # 'osv+pno': the OSV pair spaces are refined into PNOs with pno_cut
+        osv_cut = pno_cut if self.osv_cut is None else self.osv_cut
+        print("No. of strong pairs: {}".format(np.sum(str_pair_list)))
+        if self.domain == 'osv+pno':
+            self.s_pairs, Q_list = self.build_OSV_lists(osv_cut, D, str_pair_list=str_pair_list, pno_cut=pno_cut, pair_scale=pair_scale)
+        else:
+            if pair_scale is not None:
+                print("Pair-adaptive truncation needs PNOs, ignored for OSV pair spaces.")
+            self.s_pairs, Q_list = self.build_OSV_lists(osv_cut, D, str_pair_list=str_pair_list)
+        self.str_pairs = self.strong_pairs(str_pair_list)
+        # The discarded space of an OSV pair space is not a set of PNOs
+        self.Q_disc_list = None
+
+        avg, t2_ratio = self.PNO_stats(self.s_pairs)
+        print("Domain : {}".format(self.domain))
+        print("Total no. of pair virtuals: {}".format(np.sum(self.s_pairs)))
+        print("T2 ratio: {}".format(t2_ratio))
+        print("Numbers of surviving pair virtuals:\n{}".format(self.s_pairs))
+        print('Average number of pair virtuals:\n{}'.format(avg))
+
+        return Q_list
+
+    def PAO_domains(self, C_loc, S, ao_center, bp_cut=0.98):
+        # Boughton-Pulay atom domains of the localized occupied orbitals C_loc (AO x occ)
+        # Atoms are added in order of decreasing Mulliken charge of the orbital until the
+        # least squares fit of the orbital on the domain AOs reaches completeness bp_cut
+        natom = np.max(ao_center) + 1
+        SC = np.dot(S, C_loc)
+        domains = []
+        for i in range(self.no_occ):
+            charges = np.bincount(ao_center, weights=C_loc[:, i] * SC[:, i], minlength=natom)
+            order = np.argsort(charges)[::-1]
+            for n in range(1, natom + 1):
+                ao_idx = np.isin(ao_center, order[:n])
+                fit = np.linalg.solve(S[np.ix_(ao_idx, ao_idx)], SC[ao_idx, i])
+                completeness = np.dot(SC[ao_idx, i], fit)
+                if completeness >= bp_cut:
+                    break
+            domains.append(np.sort(order[:n]))
+        print("BP completeness cutoff: {}".format(bp_cut))
+        print("PAO domain sizes (atoms):\n{}".format([len(dom) for dom in domains]))
+        return domains
+
+    def build_PAO_lists(self, C_occ, C_vir, S, ao_center, domains, str_pair_list=None, pao_cut=1e-3):
+        # PAOs chi = (1 - D_occ S) phi, written in the MO virtual basis, normalized
+        # The pair space ij holds the PAOs of the atoms in the union of the domains of
+        # i and j, orthonormalized with singular value cutoff pao_cut (linear dependencies)
+        P = np.eye(S.shape[0]) - contract('ui,vi,vw->uw', C_occ, C_occ, S)
+        X = contract('ua,uv,vw->aw', C_vir, S, P)
+        X_norm = np.linalg.norm(X, axis=0)
+        X = X / np.where(X_norm > 1e-10, X_norm, 1.0)
+
+        str_pairs = self.strong_pairs(str_pair_list)
+        X_list = []
+        for ij in range(self.no_occ * self.no_occ):
+            i = ij // self.no_occ
+            j = ij % self.no_occ
+            if str_pairs[ij]:
+                ao_idx = np.isin(ao_center, np.union1d(domains[i], domains[j]))
+                X_list.append(X[:, ao_idx])
+            else:
+                X_list.append(np.zeros((self.no_vir, 0)))
+        return self.merge_PNO_spaces([X_list], merge_cut=pao_cut)
+
+    def PAO_pairs(self, domains, geom, pao_dist):
+        # Strong pairs from the PAO domains: the closest atoms of the domains of i and j
+        # are at most pao_dist (bohr) apart
+        str_pair_list = np.zeros((self.no_occ, self.no_occ), dtype=bool)
+        for i in range(self.no_occ):
+            for j in range(self.no_occ):
+                dist = np.linalg.norm(geom[domains[i]][:, None, :] - geom[domains[j]][None, :, :], axis=2)
+                str_pair_list[i, j] = np.min(dist) <= pao_dist
+        print('Strong pair list:\n{}'.format(str_pair_list))
+        return str_pair_list
+
+    def init_PAOs(self, C_occ, C_loc, C_vir, S, ao_center, F_vir, geom=None, pao_dist=None, bp_cut=0.98, pao_cut=1e-3):
+        # PAO domains need no amplitudes, only the orbitals, the AO overlap and for
+        # the pair screening the geometry; all pairs are strong without pao_dist
+        self.domain = 'pao'
+        self.PAO_dom = self.PAO_domains(C_loc, S, ao_center, bp_cut=bp_cut)
+        str_pair_list = None
+        if pao_dist is not None:
+            str_pair_list = self.PAO_pairs(self.PAO_dom, geom, pao_dist)
+        self.s_pairs, self.Q_list = self.build_PAO_lists(C_occ, C_vir, S, ao_center, self.PAO_dom, str_pair_list=str_pair_list, pao_cut=pao_cut)
+        self.str_pairs = self.strong_pairs(str_pair_list)
+        # The discarded space of a PAO domain is not a set of PNOs
+        self.Q_disc_list = None
+
+        avg, t2_ratio = self.PNO_stats(self.s_pairs)
+        print("Total no. of pair virtuals: {}".format(np.sum(self.s_pairs)))
+        print("T2 ratio: {}".format(t2_ratio))
+        print("Numbers of surviving pair virtuals:\n{}".format(self.s_pairs))
+        print('Average number of pair virtuals:\n{}'.format(avg))
+        self.L_list, self.eps_pno_list = self.form_semicanonical(self.Q_list, F_vir)
+
+    def truncated_pair_table(self, M_ijab, T_ijab, Q):
+        # Pair contributions 2 M_ab T_ab - M_ba T_ab in the PNO basis, restricted to the leading k PNOs
+        # table[ij, k] = contribution of pair ij using the k most occupied PNOs
+        # so the truncated value for any cutoff is a lookup with s_pairs
+        new_M = np.reshape(M_ijab, (self.no_occ*self.no_occ, self.no_vir, self.no_vir))
+        new_T = np.reshape(T_ijab, (self.no_occ*self.no_occ, self.no_vir, self.no_vir))
+        trans_M = contract('pAa,pab,pbB->pAB', Q.swapaxes(1, 2), new_M, Q)
+        trans_T = contract('pAa,pab,pbB->pAB', Q.swapaxes(1, 2), new_T, Q)
+        e_ab = 2.0 * trans_M * trans_T - trans_M.swapaxes(1, 2) * trans_T
+        # PNOs are in ascending order, so the kept block is the trailing k x k block
+        e_ab = e_ab[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)
+        table = np.zeros((self.no_occ * self.no_occ, self.no_vir + 1))
+        table[:, 1:] = np.diagonal(e_ab, axis1=1, axis2=2)
+        return table
+
+    def truncated_pair_energies(self, t_ijab, MO, Q):
+        # MP2 pair energies in the PNO basis, e_table[ij, k] uses the k most occupied PNOs
+        return self.truncated_pair_table(MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], t_ijab, Q)
+
+    def select_PNO_cut(self, pno_target, D, M_list, T_list, str_pair_list=None, factor=1.0, cut_range=(1e-12, 1e-2), maxiter=50, pair_scale=None):
+        '''
+        Bisect the PNO cutoff for the loosest value whose MP2-level truncation
+        error stays below the target
+
+        The truncation error is factor * sum_ij (2 M_ab T_ab - M_ba T_ab) summed over
+        the M_list, T_list pairs and evaluated in the discarded PNO space, e.g. the
+        MP2 correlation energy (M = <ij|ab>, T = t_ijab) or the MP2-level
+        pseudoresponse (M = Abar, T = X_guess)
+
+        :param pno_target: Target truncation error
+        :type pno_target: double
+        :param D: Pair densities to build the PNOs from
+        :type D: numpy array
+        :param M_list: Integral-like pair quantities
+        :type M_list: list of numpy arrays
+        :param T_list: Amplitude-like pair quantities
+        :type T_list: list of numpy arrays
+        :param factor: Prefactor converting the pair sum to the target quantity
+        :type factor: double
+        :param cut_range: Loosest and tightest cutoffs to bisect between
+        :type cut_range: tuple of doubles
+        :param pair_scale: Per-pair scaling of the cutoff for pair-adaptive truncation
+        :type pair_scale: numpy array
+
+        :returns: Selected PNO cutoff
+        :rtype: double
+        '''
+        self.occ_nos, self.Q = self.diagonalize_densities(D, str_pair_list=str_pair_list)
+        table = np.zeros((self.no_occ * self.no_occ, self.no_vir + 1))
+        for M, T in zip(M_list, T_list):
+            table += factor * self.truncated_pair_table(M, T, self.Q)
+        # Kept for target_error, so the error at other cutoffs can be checked
+        self.target_table = (np.absolute(self.occ_nos), table, pair_scale)
+        trunc_error = self.target_error
+
+        # Bisect in log10(cutoff); lo always meets the target, hi never does
+        lo = np.log10(min(cut_range))
+        hi = np.log10(max(cut_range))
+        if trunc_error(10**hi) <= pno_target:
+            lo = hi
+        elif trunc_error(10**lo) > pno_target:
+            print("Warning! Target truncation error {} not reached at cutoff {}. Using this cutoff.".format(pno_target, 10**lo))
+        else:
+            for i in range(maxiter):
+                mid = 0.5 * (lo + hi)
+                if trunc_error(10**mid) <= pno_target:
+                    lo = mid
+                else:
+                    hi = mid
+                if hi - lo < 1e-3:
+                    break
+        pno_cut = 10**lo
+        print("Target truncation error: {}".format(pno_target))
+        print("Selected Tcut_PNO: {}\tEstimated truncation error: {}".format(pno_cut, trunc_error(pno_cut)))
+        return pno_cut
+
+    def target_error(self, pno_cut):
+        # Estimated truncation error at pno_cut, from the table of the last select_PNO_cut
+        occ_nos, table, pair_scale = self.target_table
+        if pair_scale is not None:
+            pno_cut = self.pair_cutoffs(pno_cut, pair_scale, occ_nos)
+        s_pairs = np.sum(occ_nos > np.reshape(pno_cut, (-1, 1)), axis=1)
+        return abs(np.sum(table[:, -1] - table[np.arange(self.no_occ * self.no_occ), s_pairs]))
+
+    def PNO_sweep(self, cutoffs, t_ijab, MO, D=None, str_pair_list=None):
+        '''
+        Truncate the PNO space for a list of cutoffs using a single
+        diagonalization of the pair densities
+
+        :param cutoffs: Occupation number cutoffs to truncate with
+        :type cutoffs: list of doubles
+        :param t_ijab: T2 amplitudes used for the density and the PNO correction
+        :type t_ijab: numpy array
+        :param MO: MO basis ERIs (physicist notation)
+        :type MO: numpy array
+        :param D: Pair densities, built from t_ijab if not given
+        :type D: numpy array
+        :param str_pair_list: Strong pair list
+        :type str_pair_list: numpy array of bools
+
+        :returns: For each cutoff, a dict with the PNO list ('Q_list'), no. of surviving PNOs
+                  per pair ('s_pairs'), average no. of PNOs ('avg'), T2 ratio ('t2_ratio')
+                  and the MP2 PNO correction ('pno_correct')
+        :rtype: dict
+        '''
+        if D is None:
+            D = self.form_density(t_ijab)
+        self.occ_nos, self.Q = self.diagonalize_densities(D, str_pair_list=str_pair_list)
+        e_table = self.truncated_pair_energies(t_ijab, MO, self.Q)
+
+        pairs = np.arange(self.no_occ * self.no_occ)
+        sweep = {}
+        print("Tcut_PNO\tAvg. PNOs\tT2 ratio\tPNO correction")
+        for pno_cut in cutoffs:
+            s_pairs, Q_list = self.truncate_PNOs(pno_cut, self.occ_nos, self.Q)
+            avg, t2_ratio = self.PNO_stats(s_pairs)
+            pno_correct = np.sum(e_table[:, -1] - e_table[pairs, s_pairs])
+            print("{}\t{}\t{}\t{}".format(pno_cut, avg, t2_ratio, pno_correct))
+            sweep[pno_cut] = {'Q_list': Q_list, 's_pairs': s_pairs, 'avg': avg,
+                              't2_ratio': t2_ratio, 'pno_correct': pno_correct}
+        return sweep
+
+    def set_PNO_cut(self, pno_cut, F_vir):
+        # Switch to a new cutoff using the eigenpairs kept from the last diagonalization,
+        # scaled per pair as in init_PNOs for pair-adaptive truncation
+        if self.pair_scale is not None:
+            pno_cut = self.pair_cutoffs(pno_cut, self.pair_scale, np.absolute(self.occ_nos))
+        self.s_pairs, self.Q_list = self.truncate_PNOs(pno_cut, self.occ_nos, self.Q)
+        self.Q_disc_list = self.discarded_PNOs(self.s_pairs, self.Q)
+        self.L_list, self.eps_pno_list = self.form_semicanonical(self.Q_list, F_vir)
+
+    def rebuild_PNOs(self, pno_cut, t_ijab, F_vir):
+        # Rebuild the PNOs from the pair densities of the current (e.g. CCSD) amplitudes
+        D = self.form_density(t_ijab)
+        self.Q_list = self.build_PNO_lists(pno_cut, D, str_pair_list=self.str_pairs.reshape(self.no_occ, self.no_occ), pair_scale=self.pair_scale)
+        self.pno_cut = pno_cut
+        self.L_list, self.eps_pno_list = self.form_semicanonical(self.Q_list, F_vir)
+
+    def project_amplitudes(self, t_ia, t_ijab):
+        # Project amplitudes onto the current pair spaces
+        # t_ij -> Q_ij Q_ij^T t_ij Q_ij Q_ij^T, t_i -> Q_ii Q_ii^T t_i
+        Q_stack = self.stack_PNOs(self.Q_list)
+        P = contract('paA,pbA->pab', Q_stack, Q_stack)
+        new_t = t_ijab.reshape((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
+        new_t = contract('pac,pcd,pdb->pab', P, new_t, P)
+        diag = np.arange(self.no_occ) * (self.no_occ + 1)
+        new_tia = contract('iab,ib->ia', P[diag], t_ia)
+        return new_tia, new_t.reshape((self.no_occ, self.no_occ, self.no_vir, self.no_vir))
+
+    def pseudoresponse_pairs(self, X_guess, Abar_guess, W, presp_cut):
+        # Weak pair screening for the perturbed densities: one strong pair list per
+        # operator set, from the pair contributions to its averaged MP2 pseudoresponse
+        # The pair pseudoresponses are kept in self.presp_pairs, one array per operator set
+        pert_pair_lists = []
+        self.presp_pairs = []
+        for n in range(W.shape[0]):
+            presp_ij = self.pair_pseudoresponse(X_guess, Abar_guess, W[n])
+            self.presp_pairs.append(presp_ij)
+            pert_pair_lists.append(abs(presp_ij) > presp_cut)
+            print('Pseudoresponse strong pair list:\n{}'.format(pert_pair_lists[n]))
+        return pert_pair_lists
+
+    def pair_energies(self, t_ijab, MO):
+        # MP2 pair correlation energies
+        e_ij = 2.0 * contract('ijab,ijab->ij', MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], t_ijab)
+        e_ij -= contract('ijba,ijab->ij', MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], t_ijab)
+        return e_ij
+
+    def pair_pseudoresponse(self, X_guess, Abar_guess, weights):
+        # MP2-level pair contributions to the averaged pseudoresponse of the stacked guess X's
+        # -4 sum_A w_A (2 X_ijab - X_ijba) Abar_ijab, as in HelperPert.pseudo_response
+        presp_ij = 2.0 * contract('N,Nijab,Nijab->ij', weights, X_guess, Abar_guess)
+        presp_ij -= contract('N,Nijba,Nijab->ij', weights, X_guess, Abar_guess)
+        presp_ij *= -4.0
+        return presp_ij
 
-    def init_PNOs(self, pno_cut, t_ijab, F_vir, pert=None, str_pair_list=None, A_list=None, A_list_2=None, denom=None):
+    def init_PNOs(self, pno_cut, t_ijab, F_vir, pert=None, str_pair_list=None, A_list=None, A_list_2=None, denom=None, MO=None, pno_target=None, target_type='energy', pair_adaptive=False, pert_weights=None, merge_cut=1e-6, presp_cut=None, domain='pno', osv_cut=None):
+        # Pair domain engine and OSV cutoff, see build_OSV_domains
+        self.domain = domain
+        self.osv_cut = osv_cut
+        self.pert = pert
+        # Per-pair cutoff scaling of the single-density PNOs, reused when the cutoff changes
+        self.pair_scale = None
+
+        # Per-pair cutoff scaling, from pair energies (unperturbed densities)
+        # and pair pseudoresponses (perturbed densities)
+        scale_unpert = None
+        scale_pert = None
+        scale_l = None
+        if pair_adaptive:
+            if MO is None:
+                print("MO integrals are needed for pair-adaptive truncation. Using a global cutoff.")
+            else:
+                scale_unpert = self.pair_cutoff_scale(self.pair_energies(t_ijab, MO), str_pair_list=str_pair_list)
 
         if pert:
             print('Pert switch on. Initializing pert PNOs')
 
-            X_guess = {}
-            i = 0
-            D = np.zeros((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
             denom_ia = denom[0]
             denom_ijab = denom[1]
 
-            for A in A_list.values():
-                # Build guess Abar
-                # Abar_ijab = P_ij^ab (t_ij^eb A_ae - t_mj^ab A_mi)
-                Avvoo = contract('ijeb,ae->abij', t_ijab, A[self.no_occ:, self.no_occ:])
-                Avvoo -= contract('mjab,mi->abij', t_ijab, A[:self.no_occ, :self.no_occ])
-                Abar = Avvoo.swapaxes(0,2).swapaxes(1,3)
-                Abar += Abar.swapaxes(0,1).swapaxes(2,3)
-
-                # Build guess X's
-                # X_ijab = Abar_ijab / Hbar_ii + Hbar_jj - Hbar_aa _ Hbar_bb
-                X_guess[i] = Abar.copy()
-                X_guess[i] /= denom_ijab
-
-                D += self.form_density(X_guess[i])
-                i += 1
-            #print("X_guess [0]: {}".format(X_guess[0]))
-            D /= 3.0
+            # Stack all perturbation components (A_list, then A_list_2 for 'mu+l+unpert')
+            # along a leading axis, each operator set gets its own density
+            A_sets = [np.asarray(list(A_list.values()) if isinstance(A_list, dict) else A_list)]
+            if pert == 'mu+l+unpert':
+                A_sets.append(np.asarray(list(A_list_2.values()) if isinstance(A_list_2, dict) else A_list_2))
+            A_stack = np.concatenate(A_sets)
+            n_pert = A_stack.shape[0]
+
+            # Weights of each component in the averaged density of its set, equal by default
+            if pert_weights is None:
+                pert_weights = np.concatenate([np.full(len(A), 1.0 / len(A)) for A in A_sets])
+            W = np.zeros((len(A_sets), n_pert))
+            start = 0
+            for n, A in enumerate(A_sets):
+                W[n, start:start + len(A)] = pert_weights[start:start + len(A)]
+                start += len(A)
+
+            Abar_guess, X_guess = self.pert_guess(t_ijab, A_stack, denom_ijab)
+            D_sets = self.form_density(X_guess, weights=W)
+            D = D_sets[0]
             #print('Average density: {}'.format(D))
-            # Identify weak pairs using MP2 pseudoresponse
-            # Todo
+            # Identify weak pairs using MP2 pseudoresponse, if presp_cut is given
+            # Otherwise the perturbed densities use the (energy based) str_pair_list
+            if presp_cut is not None:
+                pert_pair_lists = self.pseudoresponse_pairs(X_guess, Abar_guess, W, presp_cut)
+            else:
+                pert_pair_lists = [str_pair_list] * len(A_sets)
 
+            if pair_adaptive:
+                scale_pert = self.pair_cutoff_scale(self.pair_pseudoresponse(X_guess, Abar_guess, W[0]), str_pair_list=pert_pair_lists[0])
+            if pno_target is not None:
+                pno_cut = self.target_PNO_cut(pno_cut, pno_target, target_type, D, t_ijab, MO, pert=pert, str_pair_list=pert_pair_lists[0], X_guess=X_guess, Abar_guess=Abar_guess, pert_weights=W[0], scale_pert=scale_pert, scale_unpert=scale_unpert)
             if pert == 'mu' or pert == 'l':
-                self.Q_list = self.build_PNO_lists(pno_cut, D, str_pair_list=str_pair_list)
+                self.Q_list = self.build_PNO_lists(pno_cut, D, str_pair_list=pert_pair_lists[0], pair_scale=scale_pert)
+                self.pair_scale = scale_pert
             if pert == 'mu+unpert' or pert == 'l+unpert':
                 D_unpert = self.form_density(t_ijab)
-                self.Q_list = self.combine_PNO_lists(pno_cut, D, D_unpert, str_pair_list=str_pair_list)
+                self.Q_list = self.combine_PNO_lists(pno_cut, D, D_unpert, str_pair_list=str_pair_list, pair_scale=[scale_pert, scale_unpert], merge_cut=merge_cut, pert_pair_lists=pert_pair_lists)
             if pert == 'mu+l+unpert':
-                i = 0
-                D_l = np.zeros((self.no_occ * self.no_occ, self.no_vir, self.no_vir))
-                for A in A_list_2.values():
-                    # Build guess Abar
-                    # Abar_ijab = P_ij^ab (t_ij^eb A_ae - t_mj^ab A_mi)
-                    Avvoo = contract('ijeb,ae->abij', t_ijab, A[self.no_occ:, self.no_occ:])
-                    Avvoo -= contract('mjab,mi->abij', t_ijab, A[:self.no_occ, :self.no_occ])
-                    Abar = Avvoo.swapaxes(0,2).swapaxes(1,3)
-                    Abar += Abar.swapaxes(0,1).swapaxes(2,3)
-
-                    # Build guess X's
-                    # X_ijab = Abar_ijab / Hbar_ii + Hbar_jj - Hbar_aa _ Hbar_bb
-                    X_guess[i] = Abar.copy()
-                    X_guess[i] /= denom_ijab
-
-                    D_l += self.form_density(X_guess[i])
-                    i += 1
-                    #print("X_guess [0]: {}".format(X_guess[0]))
-                D_l /= 3.0
-                #print('Average density: {}'.format(D))
-                # Identify weak pairs using MP2 pseudoresponse
-                # requires the building of the guess Abar matrix and guess X's
+                D_l = D_sets[1]
+                if pair_adaptive:
+                    scale_l = self.pair_cutoff_scale(self.pair_pseudoresponse(X_guess, Abar_guess, W[1]), str_pair_list=pert_pair_lists[1])
                 D_unpert = self.form_density(t_ijab)
-                self.Q_list = self.combine_3_PNO_lists(pno_cut, D, D_l, D_unpert, str_pair_list=str_pair_list)
+                self.Q_list = self.combine_3_PNO_lists(pno_cut, D, D_l, D_unpert, str_pair_list=str_pair_list, pair_scale=[scale_pert, scale_l, scale_unpert], merge_cut=merge_cut, pert_pair_lists=pert_pair_lists)
         else:
             print('Pert switch off. Initializing ground PNOs')
             D = self.form_density(t_ijab)
-            self.Q_list = self.build_PNO_lists(pno_cut, D, str_pair_list=str_pair_list)
+            if pno_target is not None:
+                pno_cut = self.target_PNO_cut(pno_cut, pno_target, target_type, D, t_ijab, MO, str_pair_list=str_pair_list, scale_unpert=scale_unpert)
+            self.Q_list = self.build_PNO_lists(pno_cut, D, str_pair_list=str_pair_list, pair_scale=scale_unpert)
+            self.pair_scale = scale_unpert
+        self.pno_cut = pno_cut
         self.L_list, self.eps_pno_list = self.form_semicanonical(self.Q_list, F_vir)
 
-    def increment(self, Ria, Rijab, F_occ): 
+    def target_PNO_cut(self, pno_cut, pno_target, target_type, D, t_ijab, MO, pert=None, str_pair_list=None, X_guess=None, Abar_guess=None, pert_weights=None, scale_pert=None, scale_unpert=None):
+        # Pick the PNO cutoff from a target MP2-level truncation error
+        # 'energy': MP2 correlation energy, the quantity PNO_correction computes
+        # 'polar': MP2-level averaged pseudoresponse of the guess X's, -4 sum_A w_A (2 X_ijab - X_ijba) Abar_ijab
+        if pert not in (None, 'mu', 'l'):
+            raise ValueError("Target truncation error is not available for pert = {}, use pno_cut.".format(pert))
+        if target_type == 'polar':
+            if X_guess is None:
+                print("Target type 'polar' needs perturbed PNOs. Using target type 'energy'.")
+            else:
+                M_list = pert_weights.reshape(-1, 1, 1, 1, 1) * Abar_guess
+                return self.select_PNO_cut(pno_target, D, M_list, X_guess, str_pair_list=str_pair_list, factor=-4.0, pair_scale=scale_pert)
+        if MO is None:
+            print("MO integrals are needed for target type 'energy'. Using pno_cut = {}.".format(pno_cut))
+            return pno_cut
+        if pert is None:
+            pair_scale = scale_unpert
+        else:
+            pair_scale = scale_pert
+        return self.select_PNO_cut(pno_target, D, [MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:]], [t_ijab], str_pair_list=str_pair_list, pair_scale=pair_scale)
+
+    def init_freeze(self, freeze_conv=None, recheck=5):
+        # Pair freezing for one solver run: a pair is frozen once its increment norm and the
+        # change of its pair energy (pseudoenergy, pseudoresponse) over the last iteration are
+        # both below freeze_conv. The residual blocks of frozen pairs are not transformed to
+        # the pair spaces (increment), and their amplitudes are put back after the DIIS
+        # extrapolation (keep_frozen), so they stay fixed until the next recheck
+        # Every recheck-th solver iteration all pairs are unfrozen and tested again
+        self.freeze_conv = freeze_conv
+        self.recheck = recheck
+        self.frozen = np.zeros(self.no_occ * self.no_occ, dtype=bool)
+        self.skipped = np.zeros(self.no_occ * self.no_occ, dtype=bool)
+        self.pair_res = np.zeros(self.no_occ * self.no_occ)
+        self.pair_e = None
+        self.freeze_iter = 0
+
+    def update_freeze(self, pair_e):
+        # Called once per solver iteration with the pair energies of the new amplitudes,
+        # returns the frozen pair count for the solver's iteration line
+        pair_e = np.reshape(pair_e, (self.no_occ * self.no_occ))
+        self.freeze_iter += 1
+        if self.freeze_iter % self.recheck == 0:
+            self.frozen[:] = False
+        elif self.pair_e is not None:
+            converged = (self.pair_res < self.freeze_conv) & (np.absolute(pair_e - self.pair_e) < self.freeze_conv)
+            self.frozen |= converged
+        self.pair_e = pair_e
+        return '\tFrozen pairs: {}'.format(np.sum(self.frozen))
+
+    def keep_frozen(self, old_tijab, new_tijab):
+        # Restore the amplitudes of the pairs skipped by the last increment
+        if not np.any(self.skipped):
+            return new_tijab
+        skipped = self.skipped.reshape(self.no_occ, self.no_occ)
+        new_tijab = new_tijab.copy()
+        new_tijab[skipped] = old_tijab[skipped]
+        return new_tijab
+
+    def thaw_pairs(self):
+        # Unfreeze all pairs for the rest of the solver run (final full iterations),
+        # returns whether any pair was frozen
+        was_frozen = np.any(self.frozen)
+        self.frozen[:] = False
+        self.freeze_conv = None
+        return was_frozen
+
+    def increment(self, Ria, Rijab, F_occ, freeze=False): 
     #def increment(self, Rijab, F_occ): 
         # Q[i, b, a] is diff from Q[i, i, b, a]!
+        # With freeze, frozen pairs (see init_freeze) get no T2 increment
+        freeze = freeze and self.freeze_conv is not None
+        skip = self.frozen.copy() if freeze else np.zeros(self.no_occ * self.no_occ, dtype=bool)
+        self.skipped = skip
         # Update T1s
         new_tia = np.zeros((self.no_occ, self.no_vir))
         for i in range(self.no_occ):
@@ -213,6 +701,8 @@ class HelperLocal(object):
         # Update T2s
         new_tijab = np.zeros((self.no_occ, self.no_occ, self.no_vir, self.no_vir))
         for ij in range(self.no_occ * self.no_occ):
+            if skip[ij]:
+                continue
             tmp1 = self.Q_list[ij]
             # Transform Rs using Q
             R2Q = contract('ca,ab,bd->cd', tmp1.T, Rijab[ij // self.no_occ, ij % self.no_occ], tmp1)
@@ -227,91 +717,113 @@ class HelperLocal(object):
                     d2_QL[a, b] = F_occ[ij // self.no_occ, ij // self.no_occ ] + F_occ[ij % self.no_occ, ij % self.no_occ] - tmp3[a] - tmp3[b]
             #print('denom in semi-canonical PNO basis:\n{}\n'.format(d_QL.shape))
             T2QL = R2QL / d2_QL
+            self.pair_res[ij] = np.linalg.norm(T2QL)
             # Back transform to TQs
             T2Q = contract('ca,ab,bd->cd', tmp2, T2QL, tmp2.T)
             # Back transform to Ts
             new_tijab[ij // self.no_occ, ij % self.no_occ] += contract('ca,ab,bd->cd', tmp1, T2Q, tmp1.T)
-            
+
         return new_tia, new_tijab
         #return new_tijab
 
+    def stack_PNOs(self, Q_list):
+        # Zero-pad the pair PNO spaces to a common width, for batched transformations
+        # Zero columns do not contribute to any transformed quantity
+        widths = [Q_list[ij].shape[1] for ij in range(self.no_occ * self.no_occ)]
+        Q_stack = np.zeros((self.no_occ * self.no_occ, self.no_vir, max(max(widths), 1)))
+        for ij in range(self.no_occ * self.no_occ):
+            Q_stack[ij, :, :widths[ij]] = Q_list[ij]
+        return Q_stack
+
     # MP2 energy correction = Full space MP2 value - PNO value
     def PNO_correction(self, t_ijab, MO):
-        total = 0
+        # Per-pair corrections are kept in self.pno_correct_ij
         new_MO = np.reshape(MO[:self.no_occ, :self.no_occ, self.no_occ:, self.no_occ:], (self.no_occ*self.no_occ, self.no_vir, self.no_vir))
         new_t = np.reshape(t_ijab, (self.no_occ*self.no_occ, self.no_vir, self.no_vir))
-        for ij in range(self.no_occ * self.no_occ):
-            rm_pairs = self.no_vir - int(self.s_pairs[ij])
-            #if rm_pairs == 0:
-            #    continue
-            Q_compute = self.Q_list[ij]
-            print("Shape of Q_list[{}]: {}".format(ij, Q_compute.shape))
-            trans_MO = contract('Aa,ab,bB->AB', Q_compute.T, new_MO[ij], Q_compute)
-            trans_t = contract('Aa,ab,bB->AB', Q_compute.T, new_t[ij], Q_compute)
-            trans_MO_full = contract('Aa,ab,bB->AB', self.Q[ij].T, new_MO[ij], self.Q[ij])
-            trans_t_full = contract('Aa,ab,bB->AB', self.Q[ij].T, new_t[ij], self.Q[ij])
-            #print("Shapes: {} \n{}".format(trans_MO.shape, trans_t.shape))
-            total += 2.0 * contract('ab,ab->', trans_MO_full, trans_t_full)
-            total -= contract('ba,ab->', trans_MO_full, trans_t_full)
-            total -= 2.0 * contract('ab,ab->', trans_MO, trans_t)
-            total += contract('ba,ab->', trans_MO, trans_t)
+        L = 2.0 * new_MO - new_MO.swapaxes(1, 2)
+
+        if self.Q_disc_list is not None:
+            # Only the discarded PNOs (Qd) are transformed:
+            # <L,T> - <P L P,T> = <Qd^T L, Qd^T T> + <L Qd, T Qd> - <Qd^T L Qd, Qd^T T Qd>
+            Qd = self.stack_PNOs(self.Q_disc_list)
+            QL = contract('pad,pab->pdb', Qd, L)
+            Qt = contract('pad,pab->pdb', Qd, new_t)
+            LQ = contract('pab,pbd->pad', L, Qd)
+            tQ = contract('pab,pbd->pad', new_t, Qd)
+            QLQ = contract('pdb,pbe->pde', QL, Qd)
+            QtQ = contract('pdb,pbe->pde', Qt, Qd)
+            pno_correct_ij = contract('pdb,pdb->p', QL, Qt) + contract('pad,pad->p', LQ, tQ) - contract('pde,pde->p', QLQ, QtQ)
+        else:
+            # Full space value is the untruncated MP2 pair energy (strong pairs only),
+            # the PNO value is transformed with the zero-padded stacked PNOs
+            e_full = contract('pab,pab->p', L, new_t) * self.str_pairs
+            Q_stack = self.stack_PNOs(self.Q_list)
+            trans_L = contract('paA,pab,pbB->pAB', Q_stack, L, Q_stack)
+            trans_t = contract('paA,pab,pbB->pAB', Q_stack, new_t, Q_stack)
+            pno_correct_ij = e_full - contract('pAB,pAB->p', trans_L, trans_t)
 
+        self.pno_correct_ij = pno_correct_ij.reshape(self.no_occ, self.no_occ)
+        total = np.sum(pno_correct_ij)
         print("Total: {}".format(total))
 
         return total
 
-    def combine_PNO_lists(self, pno_cut, D, D_unpert, str_pair_list=None):
-        try:
-            print("Pert PNO cutoff: {}".format(pno_cut[0]))
-            Q_pert = self.build_PNO_lists(pno_cut[0], D, str_pair_list=str_pair_list)
-            print("Unpert PNO cutoff: {}".format(pno_cut[1]))
-            Q_unpert = self.build_PNO_lists(pno_cut[1], D_unpert, str_pair_list=str_pair_list)
-            Q_list = []
-        except:
-            print("PNO cut is not a list with the right dimensions.")
-        avg = 0.0
-        sq_avg = 0.0
+    def merge_PNO_spaces(self, Q_lists, merge_cut=1e-6):
+        # Merge separately truncated PNO spaces into one orthonormal space per pair
+        # The hstacked spaces of all pairs are zero-padded to a common width and
+        # orthogonalized with one batched SVD; directions with singular values below
+        # merge_cut are linear dependencies between the spaces and are dropped
+        Q_combined = [np.hstack([Q_list[ij] for Q_list in Q_lists]) for ij in range(self.no_occ * self.no_occ)]
+        widths = [Q.shape[1] for Q in Q_combined]
+        Q_stack = self.stack_PNOs(Q_combined)
+        U, sigma, Vt = np.linalg.svd(Q_stack, full_matrices=False)
+        s_pairs = np.sum(sigma > merge_cut, axis=1)
+        Q_list = []
         for ij in range(self.no_occ * self.no_occ):
-            #print("Shapes of Q_pert[{}] and Q_unpert[{}]: ({},{}) and ({},{})".format(ij, ij, len(Q_pert[ij]), len(Q_pert[ij][0]), len(Q_unpert[ij]), len(Q_unpert[ij][0]))) 
-            Q_combined = np.hstack((Q_pert[ij], Q_unpert[ij]))
-            #print("Norm list [{}]: {}".format(ij, np.linalg.norm(Q_combined, axis=0)))
-            Q_ortho, trash = np.linalg.qr(Q_combined)
-            #print("Norm list [{}]: {}".format(ij, np.linalg.norm(Q_ortho, axis=0)))
-            #print("Shape of Q_ortho[{}]: {}".format(ij, Q_ortho.shape))
-            Q_list.append(Q_ortho)
-            avg += Q_ortho.shape[1]
-            sq_avg += Q_ortho.shape[1] * Q_ortho.shape[1]
-            
-        avg = avg / (self.no_occ * self.no_occ)
-        t2_ratio = sq_avg /(self.no_occ * self.no_occ * self.no_vir * self.no_vir)
+            Q_list.append(U[ij, :, :s_pairs[ij]])
+        print("No. of linearly dependent PNOs dropped: {}".format(np.sum(widths) - np.sum(s_pairs)))
+        return s_pairs, Q_list
+
+    def combine_PNO_lists(self, pno_cut, D, D_unpert, str_pair_list=None, pair_scale=None, merge_cut=1e-6, pert_pair_lists=None):
+        if pair_scale is None:
+            pair_scale = [None, None]
+        if pert_pair_lists is None:
+            pert_pair_lists = [str_pair_list]
+        if np.ndim(pno_cut) != 1 or len(pno_cut) != 2:
+            raise ValueError("PNO cut must be a list of 2 cutoffs (pert, unpert), got {}".format(pno_cut))
+        print("Pert PNO cutoff: {}".format(pno_cut[0]))
+        Q_pert = self.build_PNO_lists(pno_cut[0], D, str_pair_list=pert_pair_lists[0], pair_scale=pair_scale[0])
+        print("Unpert PNO cutoff: {}".format(pno_cut[1]))
+        Q_unpert = self.build_PNO_lists(pno_cut[1], D_unpert, str_pair_list=str_pair_list, pair_scale=pair_scale[1])
+        self.s_pairs, Q_list = self.merge_PNO_spaces([Q_pert, Q_unpert], merge_cut=merge_cut)
+        # The discarded space of a merged list is not a set of PNOs
+        self.Q_disc_list = None
+        self.str_pairs = np.any([self.strong_pairs(str_pair_list)] + [self.strong_pairs(l) for l in pert_pair_lists], axis=0)
+
+        avg, t2_ratio = self.PNO_stats(self.s_pairs)
         print("Average no. of combined PNOs: {}".format(avg))
         print("T2 ratio: {}".format(t2_ratio))
         return Q_list
 
-    def combine_3_PNO_lists(self, pno_cut, D_mu, D_l, D_unpert, str_pair_list=None):
-        try:
-            print("Pert_mu PNO cutoff: {}".format(pno_cut[0]))
-            Q_mu = self.build_PNO_lists(pno_cut[0], D_mu, str_pair_list=str_pair_list)
-            print("Pert_l PNO cutoff: {}".format(pno_cut[1]))
-            Q_l = self.build_PNO_lists(pno_cut[1], D_l, str_pair_list=str_pair_list)
-            print("Unpert PNO cutoff: {}".format(pno_cut[2]))
-            Q_unpert = self.build_PNO_lists(pno_cut[2], D_unpert, str_pair_list=str_pair_list)
-            Q_list = []
-        except:
-            print("PNO cut is not a list with the right dimensions.")
-        avg = 0.0
-        sq_avg = 0.0
-        for ij in range(self.no_occ * self.no_occ):
-            Q_combined = np.hstack((Q_mu[ij], Q_l[ij], Q_unpert[ij]))
-            Q_ortho, trash = np.linalg.qr(Q_combined)
-            print("Shape of Q_ortho[{}]: {}".format(ij, Q_ortho.shape))
-            Q_list.append(Q_ortho)
-            avg += Q_ortho.shape[1]
-            sq_avg += Q_ortho.shape[1] * Q_ortho.shape[1]
-            
-        avg = avg / (self.no_occ * self.no_occ)
-        t2_ratio = sq_avg /(self.no_occ * self.no_occ * self.no_vir * self.no_vir)
+    def combine_3_PNO_lists(self, pno_cut, D_mu, D_l, D_unpert, str_pair_list=None, pair_scale=None, merge_cut=1e-6, pert_pair_lists=None):
+        if pair_scale is None:
+            pair_scale = [None, None, None]
+        if pert_pair_lists is None:
+            pert_pair_lists = [str_pair_list, str_pair_list]
+        if np.ndim(pno_cut) != 1 or len(pno_cut) != 3:
+            raise ValueError("PNO cut must be a list of 3 cutoffs (mu, l, unpert), got {}".format(pno_cut))
+        print("Pert_mu PNO cutoff: {}".format(pno_cut[0]))
+        Q_mu = self.build_PNO_lists(pno_cut[0], D_mu, str_pair_list=pert_pair_lists[0], pair_scale=pair_scale[0])
+        print("Pert_l PNO cutoff: {}".format(pno_cut[1]))
+        Q_l = self.build_PNO_lists(pno_cut[1], D_l, str_pair_list=pert_pair_lists[1], pair_scale=pair_scale[1])
+        print("Unpert PNO cutoff: {}".format(pno_cut[2]))
+        Q_unpert = self.build_PNO_lists(pno_cut[2], D_unpert, str_pair_list=str_pair_list, pair_scale=pair_scale[2])
+        self.s_pairs, Q_list = self.merge_PNO_spaces([Q_mu, Q_l, Q_unpert], merge_cut=merge_cut)
+        # The discarded space of a merged list is not a set of PNOs
+        self.Q_disc_list = None
+        self.str_pairs = np.any([self.strong_pairs(str_pair_list)] + [self.strong_pairs(l) for l in pert_pair_lists], axis=0)
+
+        avg, t2_ratio = self.PNO_stats(self.s_pairs)
         print("Average no. of combined PNOs: {}".format(avg))
         print("T2 ratio: {}".format(t2_ratio))
         return Q_list
-
@@ -0,0 +1,146 @@
+'''
+HelperStore class definition
+For saving converged CCSD/Lambda amplitudes, Hbar elements and
+local pair spaces to disk, and reusing them in later response jobs
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+from .cc_hbar import HelperHbar, HBAR_ELEMENTS
+from .cc_lambda import HelperLambda
+
+
+class HelperStore(object):
+    '''
+    On-disk store of the ground state data needed by the response solvers.
+
+    Each calculation gets its own directory, named by a hash of the geometry,
+    basis set and the settings that determine the ground state. Arrays are saved
+    as .npy files and the Hbar elements are memory-mapped when loaded.
+
+    :param path: Directory holding the stored calculations
+    :type path: string
+    :param wfn: RHF wavefunction from psi4
+    :type wfn: class 'psi4.core.Wavefunction'
+    :param settings: Cutoffs and convergence settings of the ground state calculation
+    :type settings: dict
+    '''
+    def __init__(self, path, wfn, settings):
+        self.key = self.make_key(wfn, settings)
+        self.dir = os.path.join(path, self.key)
+        self.manifest = os.path.join(self.dir, 'manifest.json')
+
+    def make_key(self, wfn, settings):
+        # Hash of geometry, basis and settings, identifies the calculation
+        basis = wfn.basisset()
+        geom = np.round(np.asarray(wfn.molecule().geometry()), 8)
+        sha = hashlib.sha1()
+        sha.update(geom.tobytes())
+        sha.update(basis.name().encode())
+        sha.update(json.dumps([wfn.nmo(), wfn.doccpi()[0], wfn.frzcpi()[0]]).encode())
+        sha.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+    def exists(self):
+        # The manifest is written last, so a calculation is only reused when completely saved
+        return os.path.isfile(self.manifest)
+
+    def save_array(self, name, array):
+        np.save(os.path.join(self.dir, name + '.npy'), np.asarray(array))
+
+    def load_array(self, name, mmap_mode=None):
+        return np.load(os.path.join(self.dir, name + '.npy'), mmap_mode=mmap_mode)
+
+    def save(self, hcc, hbar, lda, ccsd_e, pseudo_e, local=None):
+        '''
+        Save the converged ground state
+
+        :param hcc: HelperCCEnergy object after the CCSD calculation
+        :type hcc: class 'ccsd_lpno.HelperCCEnergy'
+        :param hbar: HelperHbar object
+        :type hbar: class 'ccsd_lpno.HelperHbar'
+        :param lda: HelperLambda object after the lambda calculation
+        :type lda: class 'ccsd_lpno.HelperLambda'
+        :param ccsd_e: CCSD correlation energy
+        :type ccsd_e: float
+        :param pseudo_e: Lambda pseudoenergy
+        :type pseudo_e: float
+        :param local: HelperLocal object holding the pair spaces the amplitudes were solved in
+        :type local: class 'ccsd_lpno.HelperLocal'
+        '''
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+        self.save_array('t_ia', hcc.t_ia)
+        self.save_array('t_ijab', hcc.t_ijab)
+        self.save_array('l_ia', lda.l_ia)
+        self.save_array('l_ijab', lda.l_ijab)
+
+        # Only the Hbar elements built so far, the rest stay lazy in later jobs
+        # W_abef is only contracted in factorized form
+        elements = [name for name in HBAR_ELEMENTS if name in hbar.elements and name != 'Hvvvv']
+        for name in elements:
+            self.save_array(name, hbar.elements[name])
+
+        # Pair spaces, zero-padded to a common width
+        widths = None
+        if local is not None:
+            widths = [local.Q_list[ij].shape[1] for ij in range(local.no_occ * local.no_occ)]
+            self.save_array('s_pairs', local.s_pairs)
+            self.save_array('Q_stack', local.stack_PNOs(local.Q_list))
+            L_stack = np.zeros((len(widths), max(max(widths), 1), max(max(widths), 1)))
+            eps_stack = np.zeros((len(widths), max(max(widths), 1)))
+            for ij, width in enumerate(widths):
+                L_stack[ij, :width, :width] = local.L_list[ij]
+                eps_stack[ij, :width] = local.eps_pno_list[ij]
+            self.save_array('L_stack', L_stack)
+            self.save_array('eps_stack', eps_stack)
+
+        with open(self.manifest, 'w') as f:
+            json.dump({'ccsd_e': ccsd_e, 'pseudo_e': pseudo_e, 'elements': elements, 'widths': widths}, f)
+        print('Saved CCSD, Lambda and Hbar to {}'.format(self.dir))
+
+    def load(self, hcc, local=None):
+        '''
+        Load a saved ground state into hcc (and local), skipping the CCSD and lambda iterations
+
+        :param hcc: HelperCCEnergy object for the same molecule and settings, built with init_pairs=False
+        :type hcc: class 'ccsd_lpno.HelperCCEnergy'
+        :param local: HelperLocal object, its pair spaces are replaced by the saved ones
+        :type local: class 'ccsd_lpno.HelperLocal'
+
+        :returns: ccsd_e, pseudo_e, hbar, lda
+        '''
+        with open(self.manifest) as f:
+            manifest = json.load(f)
+
+        hcc.t_ia = self.load_array('t_ia')
+        hcc.t_ijab = self.load_array('t_ijab')
+
+        if local is not None:
+            if manifest['widths'] is None:
+                print('Warning: stored calculation has no pair spaces, keeping the current ones')
+            else:
+                local.s_pairs = self.load_array('s_pairs')
+                Q_stack = self.load_array('Q_stack')
+                L_stack = self.load_array('L_stack')
+                eps_stack = self.load_array('eps_stack')
+                widths = manifest['widths']
+                local.Q_list = [Q_stack[ij, :, :width] for ij, width in enumerate(widths)]
+                local.L_list = [L_stack[ij, :width, :width] for ij, width in enumerate(widths)]
+                local.eps_pno_list = [eps_stack[ij, :width] for ij, width in enumerate(widths)]
+                local.Q_disc_list = None
+
+        hbar = HelperHbar(hcc, manifest['ccsd_e'])
+        for name in manifest['elements']:
+            hbar.elements[name] = self.load_array(name, mmap_mode='r')
+            hbar.registry[name] = {'memory': hbar.elements[name].nbytes, 'time': 0.0}
+
+        lda = HelperLambda(hcc, hbar)
+        lda.l_ia = self.load_array('l_ia')
+        lda.l_ijab = self.load_array('l_ijab')
+
+        print('Loaded CCSD, Lambda and Hbar from {}'.format(self.dir))
+        return manifest['ccsd_e'], manifest['pseudo_e'], hbar, lda
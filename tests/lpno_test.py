@@ -6,7 +6,10 @@ References used:
     - https://github.com/psi4/psi4numpy
 '''
 
+import json
+import time
 import numpy as np
+import pytest
 import psi4
 import ccsd_lpno
 
@@ -90,3 +93,228 @@ def test_polar():
         assert np.allclose(polar, polar_compare_list[i], atol=1e-4)
         print("Polarizability = {}".format(polar))
         i += 1
+
+def test_pno_sweep():
+    no_occ = wfn.doccpi()[0]
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=cutoffs[0])
+    MO_oovv = hcc.MO[:no_occ, :no_occ, no_occ:, no_occ:]
+    t_ijab = MO_oovv / hcc.d_ijab
+
+    # One diagonalization for all cutoffs
+    sweep = local.PNO_sweep(cutoffs, t_ijab, hcc.MO)
+    for cut in cutoffs:
+        local_cut = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc_cut = ccsd_lpno.HelperCCEnergy(wfn, local=local_cut, pno_cut=cut)
+        assert np.array_equal(sweep[cut]['s_pairs'], local_cut.s_pairs)
+        assert np.allclose(sweep[cut]['pno_correct'], hcc_cut.pno_correct, atol=1e-10)
+
+def test_pno_target():
+    # The selected cutoff is the loosest meeting the target: ten times looser misses it
+    no_occ = wfn.doccpi()[0]
+    for target in [1e-3, 1e-4]:
+        local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_target=target)
+        print("Selected cutoff: {}, PNO correction: {}".format(hcc.pno_cut, hcc.pno_correct))
+        assert abs(hcc.pno_correct) <= target
+        MO_oovv = hcc.MO[:no_occ, :no_occ, no_occ:, no_occ:]
+        looser = local.PNO_sweep([10 * hcc.pno_cut], MO_oovv / hcc.d_ijab, hcc.MO)[10 * hcc.pno_cut]
+        assert abs(looser['pno_correct']) > target
+
+        # Same for the MP2-level pseudoresponse of perturbed PNOs
+        local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pert='mu', pno_target=target, target_type='polar')
+        assert local.target_error(hcc.pno_cut) <= target
+        assert local.target_error(10 * hcc.pno_cut) > target
+
+    # Combined perturbed and unperturbed PNOs have no single target quantity
+    with pytest.raises(ValueError):
+        ccsd_lpno.HelperCCEnergy(wfn, local=ccsd_lpno.HelperLocal(no_occ, no_vir), pert='mu+unpert', pno_target=1e-3)
+
+def test_osv_domains():
+    # With a tight OSV cutoff the refined OSV pair spaces span the PNOs
+    i = 0
+    for cut in cutoffs:
+        polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cut, domain='osv+pno', osv_cut=1e-12)
+        print("Polarizability = {}".format(polar))
+        assert np.allclose(polar, polar_compare_list[i], atol=1e-4)
+        i += 1
+
+def test_pao_domains():
+    # Complete Boughton-Pulay domains span the full virtual space
+    polar_can = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar')
+    polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, domain='pao', bp_cut=1.0)
+    print("Polarizability = {}".format(polar))
+    assert np.allclose(polar, polar_can, atol=1e-6)
+    assert np.allclose(polar, polar_compare_list[0], atol=1e-4)
+
+    # Truncated domains: smaller pair spaces, polarizability close to the canonical one
+    no_occ = wfn.doccpi()[0]
+    natom = wfn.basisset().molecule().natom()
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    ccsd_lpno.HelperCCEnergy(wfn, local=local, domain='pao', bp_cut=0.98)
+    sizes = np.array([len(dom) for dom in local.PAO_dom])
+    assert np.all(sizes >= 1) and np.any(sizes < natom)
+    assert np.any(local.s_pairs < no_vir)
+    polar_trunc = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, domain='pao', bp_cut=0.98)
+    print("Polarizability (bp_cut = 0.98) = {}".format(polar_trunc))
+    assert np.allclose(polar_trunc, polar_can, rtol=1e-1)
+
+    # Pairs screened by domain distance: only pairs with touching domains are kept
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    ccsd_lpno.HelperCCEnergy(wfn, local=local, domain='pao', bp_cut=0.98, pao_dist=0.0)
+    assert np.all(np.diag(np.reshape(local.str_pairs, (no_occ, no_occ))))
+    assert np.all(local.s_pairs[~local.str_pairs] == 0)
+
+def test_fvno():
+    # Keeping all FVNOs only rotates the virtuals
+    polar_can = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar')
+    polar_fvno = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', fvno='fvno', fvno_cut=0)
+    polar_fvnopp = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', fvno='fvno++', fvno_cut=0)
+    assert np.allclose(polar_fvno, polar_can, atol=1e-6)
+    assert np.allclose(polar_fvnopp, polar_can, atol=1e-6)
+
+def test_store(tmpdir, monkeypatch):
+    # The second job loads the CCSD, Lambda and Hbar saved by the first
+    polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cutoffs[1], store=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    # Only the Hbar elements built during CCSD and Lambda are saved
+    with open(str(tmpdir.listdir()[0].join('manifest.json'))) as f:
+        elements = json.load(f)['elements']
+    assert 'Hvvvv' not in elements
+    assert set(elements) < set(ccsd_lpno.cc_hbar.HBAR_ELEMENTS)
+
+    # The pair spaces are loaded, not rebuilt
+    def no_PNOs(*args, **kwargs):
+        raise AssertionError('PNOs rebuilt for a stored calculation')
+    monkeypatch.setattr(ccsd_lpno.HelperLocal, 'init_PNOs', no_PNOs)
+    polar_stored = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cutoffs[1], store=str(tmpdir))
+    assert len(tmpdir.listdir()) == 1
+    assert np.allclose(polar_stored, polar_compare_list[1], atol=1e-4)
+    assert np.allclose(polar_stored, polar, atol=1e-8)
+
+def test_multi_frequency():
+    # Frequencies solved together match separate calculations
+    i = 0
+    for cut in cutoffs:
+        polar_list = ccsd_lpno.do_linresp(wfn, [589, 355], mol, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        polar_355 = ccsd_lpno.do_linresp(wfn, 355, mol, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        assert np.allclose(polar_list[0], polar_compare_list[i], atol=1e-4)
+        assert np.allclose(polar_list[1], polar_355, atol=1e-6)
+        i += 1
+
+def test_pair_adaptive():
+    # The PNOs are redistributed towards the pairs with the largest MP2 pair energies
+    no_occ = wfn.doccpi()[0]
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=cutoffs[1], pair_adaptive=True)
+    local_global = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc_global = ccsd_lpno.HelperCCEnergy(wfn, local=local_global, pno_cut=cutoffs[1])
+
+    MO_oovv = hcc.MO[:no_occ, :no_occ, no_occ:, no_occ:]
+    e_ij = np.absolute(local.pair_energies(MO_oovv / hcc.d_ijab, hcc.MO)).reshape(-1)
+    dominant = np.argmax(e_ij)
+    weakest = np.argmin(e_ij)
+    assert local.s_pairs[dominant] >= local_global.s_pairs[dominant]
+    assert local.s_pairs[weakest] <= local_global.s_pairs[weakest]
+    # Every pair keeps at least one PNO, and the truncation error stays small
+    assert np.all(local.s_pairs >= 1)
+    assert np.isfinite(hcc.pno_correct)
+    assert abs(hcc.pno_correct) <= 0.01 * abs(np.sum(e_ij))
+
+def test_pno_schedule():
+    # Loose-to-tight PNO schedule against fixed PNO spaces at the final cutoff
+    for cut, e_atol, rtol in zip(cutoffs, [1e-8, 1e-3], [1e-6, 1e-2]):
+        ccsd_e, polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, return_en=True, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        ccsd_e_loose, polar_loose = ccsd_lpno.do_linresp(wfn, omega_nm, mol, return_en=True, method='polar', localize=localize, pert=pert, pno_cut=cut, loose_cut=1e-3)
+        print("CCSD energy = {}, {}; Polarizability = {}, {}".format(ccsd_e, ccsd_e_loose, polar, polar_loose))
+        assert np.allclose(ccsd_e_loose, ccsd_e, atol=e_atol)
+        assert np.allclose(polar_loose, polar, rtol=rtol)
+    # The schedule is only defined for unperturbed PNOs
+    with pytest.raises(ValueError):
+        ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert='mu', pno_cut=cutoffs[1], loose_cut=1e-3)
+
+def test_pno_schedule_pair_adaptive():
+    # Loose and rebuilt PNO spaces keep the pair-adaptive cutoffs
+    no_occ = wfn.doccpi()[0]
+    for cut in cutoffs:
+        local_loose = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local_loose, pno_cut=1e-3, pair_adaptive=True)
+        s_pairs_loose = local_loose.s_pairs.copy()
+        local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=cut, pair_adaptive=True)
+        s_pairs = local.s_pairs.copy()
+
+        # Rebuilding from the MP2 amplitudes at the final cutoff gives the pair-adaptive spaces,
+        # and moving to the loose cutoff gives the loose pair-adaptive spaces
+        t_mp2 = hcc.MO[:no_occ, :no_occ, no_occ:, no_occ:] / hcc.d_ijab
+        local_loose.rebuild_PNOs(cut, t_mp2, hcc.F_vir)
+        assert np.array_equal(local_loose.s_pairs, s_pairs)
+        local.set_PNO_cut(1e-3, hcc.F_vir)
+        assert np.array_equal(local.s_pairs, s_pairs_loose)
+
+        # With the schedule the final spaces come from the CCSD amplitudes, close to the MP2 ones
+        local_sched = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc_sched = ccsd_lpno.HelperCCEnergy(wfn, local=local_sched, pno_cut=cut, pair_adaptive=True)
+        hcc_sched.do_CC(local=local_sched, e_conv=1e-10, r_conv=1e-10, loose_cut=1e-3)
+        print("PNOs per pair: {} (schedule), {} (fixed)".format(local_sched.s_pairs, s_pairs))
+        assert np.all(np.absolute(local_sched.s_pairs - s_pairs) <= 1)
+
+def test_freeze():
+    # Frozen pairs are thawed before convergence, CCSD, Lambda and the response match
+    i = 0
+    for cut in cutoffs:
+        ccsd_e, polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, return_en=True, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        ccsd_e_frz, polar_frz = ccsd_lpno.do_linresp(wfn, omega_nm, mol, return_en=True, method='polar', localize=localize, pert=pert, pno_cut=cut, freeze_conv=1e-6)
+        optrot_frz = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='velocity', localize=localize, pert=pert, pno_cut=cut, freeze_conv=1e-6)
+        print("CCSD energy = {}, {}; Polarizability = {}, {}".format(ccsd_e, ccsd_e_frz, polar, polar_frz))
+        assert np.allclose(ccsd_e_frz, ccsd_e, atol=1e-8)
+        assert np.allclose(polar_frz, polar, atol=1e-6)
+        assert np.allclose(polar_frz, polar_compare_list[i], atol=1e-4)
+        assert np.allclose(optrot_frz, optrot_compare_list_mvg[i], atol=1e-4)
+        i += 1
+
+def test_frozen_amplitudes():
+    # A frozen pair keeps its amplitudes, DIIS included, until the pairs are rechecked
+    no_occ = wfn.doccpi()[0]
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=cutoffs[1])
+    history = []
+    update_freeze = local.update_freeze
+    def record(pair_e):
+        # Amplitudes entering this iteration and the pairs skipped in it
+        history.append((hcc.t_ijab.copy(), local.skipped.reshape(no_occ, no_occ).copy()))
+        return update_freeze(pair_e)
+    local.update_freeze = record
+    hcc.do_CC(local=local, e_conv=1e-10, r_conv=1e-10, freeze_conv=1e-5)
+
+    assert any(np.any(skipped) for t_ijab, skipped in history)
+    for (t_old, skipped), (t_new, _) in zip(history[:-1], history[1:]):
+        assert np.array_equal(t_new[skipped], t_old[skipped])
+
+def test_lmp2():
+    # LMP2 is invariant to occupied rotations: canonical orbitals keep the MP2 doubles,
+    # and localized orbitals without truncation recover the canonical MP2 energy
+    no_occ = wfn.doccpi()[0]
+    zero_ia = np.zeros((no_occ, no_vir))
+    hcc_can = ccsd_lpno.HelperCCEnergy(wfn)
+    mp2_e = hcc_can.corr_energy(zero_ia, hcc_can.t_ijab)
+    lmp2_can = hcc_can.do_LMP2(hcc_can.t_ijab.copy())
+    assert np.allclose(hcc_can.corr_energy(zero_ia, lmp2_can), mp2_e, atol=1e-10)
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc_loc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=0, lmp2=True)
+    print("MP2 energy = {}, LMP2 energy = {}".format(mp2_e, hcc_loc.corr_energy(zero_ia, hcc_loc.t_ijab)))
+    assert np.allclose(hcc_loc.corr_energy(zero_ia, hcc_loc.t_ijab), mp2_e, atol=1e-8)
+
+def test_hbar_registry():
+    # Each element reports only its own build time, so the times add up to the total
+    no_occ = wfn.doccpi()[0]
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pno_cut=cutoffs[1])
+    ccsd_e = hcc.do_CC(local=local, e_conv=1e-8, r_conv=1e-7)
+    hbar = ccsd_lpno.HelperHbar(hcc, ccsd_e)
+    start = time.time()
+    hbar.Hovoo
+    total = time.time() - start
+    assert len(hbar.registry) > 1
+    assert sum(entry['time'] for entry in hbar.registry.values()) <= total
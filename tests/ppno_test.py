@@ -90,3 +90,156 @@ def test_polar():
         assert np.allclose(polar, polar_compare_list[i], atol=1e-4)
         print("Polarizability = {}".format(polar))
         i += 1
+
+def test_presp_screening():
+    # A pseudoresponse cutoff just above the weakest pair drops it from the perturbed spaces
+    no_occ = wfn.doccpi()[0]
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pert=pert, pno_cut=cutoffs[0], presp_cut=0.0)
+    presp = np.unique(np.absolute(local.presp_pairs[0]))
+    presp_cut = 0.5 * (presp[0] + presp[1])
+
+    local_screened = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc_screened = ccsd_lpno.HelperCCEnergy(wfn, local=local_screened, pert=pert, pno_cut=cutoffs[0], presp_cut=presp_cut)
+    dropped = ~local_screened.str_pairs
+    assert np.any(dropped)
+    assert np.all(local_screened.s_pairs[dropped] == 0)
+
+    polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cutoffs[0], presp_cut=presp_cut)
+    print("Polarizability = {}".format(polar))
+    assert np.allclose(polar, polar_compare_list[0], rtol=1e-2)
+
+def test_batch():
+    # Solving all components together gives the same response, the velocity gauge
+    # also solves its static block in a batch
+    i = 0
+    for cut in cutoffs:
+        polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cut, batch=True)
+        optrot_lg = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='length', localize=localize, pert=pert, pno_cut=cut, batch=True)
+        optrot_mvg = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='velocity', localize=localize, pert=pert, pno_cut=cut, batch=True)
+        print("Polarizability = {}; Optical rotation(LG) = {}, (MVG) = {}".format(polar, optrot_lg, optrot_mvg))
+        assert np.allclose(polar, polar_compare_list[i], atol=1e-4)
+        assert np.allclose(optrot_lg, optrot_compare_list_lg[i], atol=1e-4)
+        assert np.allclose(optrot_mvg, optrot_compare_list_mvg[i], atol=1e-4)
+        i += 1
+
+    # Each perturbation converges to its own solution, and equations that did not
+    # converge are not marked as solved
+    no_occ = wfn.doccpi()[0]
+    omega = ccsd_lpno.linresp.nm_to_hartree(omega_nm)
+    local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+    hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pert=pert, pno_cut=cutoffs[1], omega=omega)
+    ccsd_e = hcc.do_CC(local=local, e_conv=E_conv, r_conv=R_conv)
+    hbar = ccsd_lpno.HelperHbar(hcc, ccsd_e)
+    lda = ccsd_lpno.HelperLambda(hcc, hbar)
+    lda.iterate(local=local, e_conv=E_conv, r_conv=R_conv)
+    mu = [np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(ints)) for ints in hcc.mints.ao_dipole()]
+    perts = [ccsd_lpno.HelperPert(hcc, hbar, lda, A, omega, local=local) for A in mu]
+    presp, converged = ccsd_lpno.HelperPertBatch(perts).iterate('right', local=local, r_conv=R_conv)
+    assert np.all(converged)
+    for n in range(len(mu)):
+        single = ccsd_lpno.HelperPert(hcc, hbar, lda, mu[n], omega, local=local)
+        single.iterate('right', local=local, r_conv=R_conv)
+        assert np.allclose(perts[n].x_ijab, single.x_ijab, atol=1e-6)
+
+    perts = [ccsd_lpno.HelperPert(hcc, hbar, lda, A, omega, local=local) for A in mu]
+    presp, converged = ccsd_lpno.HelperPertBatch(perts).iterate('right', local=local, r_conv=R_conv, maxiter=2)
+    assert not np.any(converged)
+    ccsd_lpno.linresp.solve_perts(perts, local=local, r_conv=0.0, batch=True)
+    assert all(len(p.solved) == 0 for p in perts)
+
+def test_gmres():
+    # GMRES converges to the same response as the Jacobi/DIIS iterations
+    i = 0
+    for cut in cutoffs:
+        polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cut, solver='gmres')
+        print("Polarizability = {}".format(polar))
+        assert np.allclose(polar, polar_compare_list[i], atol=1e-4)
+        i += 1
+
+def test_asym():
+    # The Y-free response functions agree with the X/Y form
+    i = 0
+    for cut in cutoffs:
+        polar = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        polar_asym = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='polar', localize=localize, pert=pert, pno_cut=cut, asym=True)
+        optrot = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='both', localize=localize, pert=pert, pno_cut=cut)
+        optrot_asym = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='both', localize=localize, pert=pert, pno_cut=cut, asym=True)
+        print("Polarizability = {}, {}; Optical rotation(LG, MVG) = {}, {}".format(polar, polar_asym, optrot, optrot_asym))
+        assert np.allclose(polar_asym, polar, atol=1e-6)
+        assert np.allclose(optrot_asym, optrot, atol=1e-4)
+        assert np.allclose(polar_asym, polar_compare_list[i], atol=1e-4)
+        assert np.allclose(optrot_asym, [optrot_compare_list_lg[i], optrot_compare_list_mvg[i]], atol=1e-4)
+        i += 1
+
+def test_or_both(monkeypatch):
+    # Both gauges in one run, the L solutions are shared between them
+    solves = []
+    iterate = ccsd_lpno.HelperPert.iterate
+    def counted_iterate(self, hand, *args, **kwargs):
+        solves.append(hand)
+        return iterate(self, hand, *args, **kwargs)
+    monkeypatch.setattr(ccsd_lpno.HelperPert, 'iterate', counted_iterate)
+
+    i = 0
+    for cut in cutoffs:
+        del solves[:]
+        optrot_lg, optrot_mvg = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='both', localize=localize, pert=pert, pno_cut=cut)
+        n_both = len(solves)
+        ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='length', localize=localize, pert=pert, pno_cut=cut)
+        ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='velocity', localize=localize, pert=pert, pno_cut=cut)
+        n_separate = len(solves) - n_both
+        print("Optical rotation(LG) = {}, (MVG) = {}; solves: {} together, {} separately".format(optrot_lg, optrot_mvg, n_both, n_separate))
+        assert n_both < n_separate
+        assert np.allclose(optrot_lg, optrot_compare_list_lg[i], atol=1e-4)
+        assert np.allclose(optrot_mvg, optrot_compare_list_mvg[i], atol=1e-4)
+        i += 1
+
+def test_components():
+    # The diagonal and trace of the response tensor match the full tensor
+    no_occ = wfn.doccpi()[0]
+    omega = ccsd_lpno.linresp.nm_to_hartree(omega_nm)
+    i = 0
+    for cut in cutoffs:
+        local = ccsd_lpno.HelperLocal(no_occ, no_vir)
+        hcc = ccsd_lpno.HelperCCEnergy(wfn, local=local, pert=pert, pno_cut=cut, omega=omega)
+        ccsd_e = hcc.do_CC(local=local, e_conv=E_conv, r_conv=R_conv)
+        hbar = ccsd_lpno.HelperHbar(hcc, ccsd_e)
+        lda = ccsd_lpno.HelperLambda(hcc, hbar)
+        lda.iterate(local=local, e_conv=E_conv, r_conv=R_conv)
+        mu = [np.einsum('uj,vi,uv', hcc.C_arr, hcc.C_arr, np.asarray(ints)) for ints in hcc.mints.ao_dipole()]
+        perts = [ccsd_lpno.HelperPert(hcc, hbar, lda, A, omega, local=local) for A in mu]
+        for p in perts:
+            p.iterate('right', local=local, r_conv=R_conv)
+            p.iterate('left', local=local, r_conv=R_conv)
+        tensor = ccsd_lpno.HelperRespTensor(lda, perts, perts)
+        full = tensor.linear_resp()
+        assert np.allclose(tensor.linear_resp(components='diag'), np.diag(full), atol=1e-10)
+        assert np.allclose(tensor.linear_resp(components='trace'), np.trace(full), atol=1e-10)
+
+        # Only the trace of the Rosenfeld tensors is evaluated
+        optrot_lg = ccsd_lpno.do_linresp(wfn, omega_nm, mol, method='optrot', gauge='length', localize=localize, pert=pert, pno_cut=cut, components='trace')
+        print("Optical rotation(LG) = {}".format(optrot_lg))
+        assert np.allclose(optrot_lg, optrot_compare_list_lg[i], atol=1e-4)
+        i += 1
+
+def test_multi_frequency(monkeypatch):
+    # The integrals are built once, and the perturbed pair spaces are rebuilt at each
+    # frequency, which then agrees with a separate calculation
+    built = []
+    HelperCCEnergy = ccsd_lpno.linresp.HelperCCEnergy
+    def counted(*args, **kwargs):
+        built.append(1)
+        return HelperCCEnergy(*args, **kwargs)
+    monkeypatch.setattr(ccsd_lpno.linresp, 'HelperCCEnergy', counted)
+
+    i = 0
+    for cut in cutoffs:
+        del built[:]
+        polar_list = ccsd_lpno.do_linresp(wfn, [589, 355], mol, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        assert len(built) == 1
+        polar_355 = ccsd_lpno.do_linresp(wfn, 355, mol, method='polar', localize=localize, pert=pert, pno_cut=cut)
+        print("Polarizability = {}; 355 nm separately = {}".format(polar_list, polar_355))
+        assert np.allclose(polar_list[0], polar_compare_list[i], atol=1e-4)
+        assert np.allclose(polar_list[1], polar_355, atol=1e-8)
+        i += 1